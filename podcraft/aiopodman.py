@@ -0,0 +1,208 @@
+"""
+asyncio client for the podman varlink API.
+
+Covers the operations podcraft uses, so independent ones (removing several
+containers, inspecting several images) can be done concurrently instead of
+one round trip at a time.
+"""
+import asyncio
+import copy
+import json
+import logging
+
+from .varlink import (
+    FRAME_HEADER, EXIT_CODE, STDOUT, STDERR, QUIT, HANG_UP,
+    encode_call, decode_reply, exec_opts, fold_keys, split_address,
+)
+
+from .tracing import span
+
+log = logging.getLogger(__name__)
+
+
+class AsyncClient:
+    """
+    Talks to a podman varlink server.
+
+    Idle connections are kept for reuse, so use this as an async context
+    manager (or call close()) when done.
+    """
+    def __init__(self, address):
+        self.address = address
+        self._path = split_address(address)
+        self._idle = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        await self.close()
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    async def _open(self):
+        if self._idle:
+            return self._idle.pop()
+        return await asyncio.open_unix_connection(self._path)
+
+    async def call(self, method, _upgrade=False, **parameters):
+        """
+        Call a varlink method, returning the reply parameters.
+
+        If _upgrade, the connection is returned as well, and not reused.
+        """
+        reader, writer = await self._open()
+        try:
+            with span(f'varlink io.podman.{method}'):
+                writer.write(encode_call(f'io.podman.{method}', parameters, upgrade=_upgrade))
+                await writer.drain()
+                reply = decode_reply((await reader.readuntil(b'\0'))[:-1])
+        except BaseException:
+            writer.close()
+            raise
+        if _upgrade:
+            return reply, (reader, writer)
+        self._idle.append((reader, writer))
+        return reply
+
+    # Pods
+
+    async def create_pod(self, ident=None, cgroupparent=None, labels=None, share=None,
+                         infra=False, publish=[]):
+        """
+        Create a new empty pod, returning its ID. Same as pods.create_pod().
+        """
+        infra = infra or bool(publish)
+        if not share and infra:
+            share = ['cgroup', 'ipc', 'net', 'uts']
+        config = {
+            'name': ident,
+            'cgroupParent': cgroupparent,
+            'labels': labels,
+            'share': share,
+            'infra': infra,
+            'publish': publish,
+        }
+        config = {k: v for k, v in config.items() if v is not None}
+        return (await self.call('CreatePod', create=config))['pod']
+
+    async def get_pod(self, ident):
+        return (await self.call('GetPod', name=ident))['pod']
+
+    async def start_pod(self, ident):
+        return (await self.call('StartPod', name=ident))['pod']
+
+    async def stop_pod(self, ident, timeout=-1):
+        return (await self.call('StopPod', name=ident, timeout=timeout))['pod']
+
+    async def remove_pod(self, ident, force=False):
+        return (await self.call('RemovePod', name=ident, force=force))['pod']
+
+    # Images
+
+    async def get_image(self, ident):
+        return (await self.call('GetImage', id=ident))['image']
+
+    async def inspect_image(self, ident, *, state=None):
+        """
+        Get the inspection details of an image, in the same shape as
+        images.inspect_image(), caching them in state if given.
+        """
+        details = state.get_inspect(ident) if state is not None else None
+        if details is None:
+            raw = (await self.call('InspectImage', name=ident))['image']
+            details = json.loads(raw, object_hook=fold_keys)
+            if state is not None:
+                state.save_inspect(ident, details)
+        return details
+
+    async def remove_image(self, ident, force=False):
+        return (await self.call('RemoveImage', name=ident, force=force))['image']
+
+    # Containers
+
+    async def create_container(self, image_id, pod_id, volumes, *, state=None, **opts):
+        """
+        Create a container in a pod, returning its ID. Same as
+        containers.create_container().
+        """
+        details = await self.inspect_image(image_id, state=state)
+        img_volumes = set(details['config'].get('volumes') or {})
+        config = dict(
+            opts,
+            image_id=image_id,
+            pod=pod_id,
+            mount=[
+                f"type=bind,source={h},destination={c}"
+                for c, h in volumes.items() if c in img_volumes
+            ],
+        )
+        config['command'] = details['config'].get('cmd')
+        config['env'] = dict(
+            (v.split('=', 1) for v in details['config'].get('env') or []),
+            **opts.get('env', {})
+        )
+        config['image'] = copy.deepcopy(details['repotags'][0])
+        config['labels'] = copy.deepcopy(details['labels'])
+        config['args'] = [config['image'], *(config['command'] or [])]
+        config = {k: v for k, v in config.items() if v is not None}
+        log.debug("Image %s: create config: %s", image_id, config)
+        return (await self.call('CreateContainer', create=config))['container']
+
+    async def get_container(self, ident):
+        return (await self.call('GetContainer', id=ident))['container']
+
+    async def inspect_container(self, ident):
+        """
+        Get the inspection details of a container, with the keys case-folded.
+        """
+        raw = (await self.call('InspectContainer', name=ident))['container']
+        return json.loads(raw, object_hook=fold_keys)
+
+    async def start_container(self, ident):
+        return (await self.call('StartContainer', name=ident))['container']
+
+    async def stop_container(self, ident, timeout=25):
+        return (await self.call('StopContainer', name=ident, timeout=timeout))['container']
+
+    async def remove_container(self, ident, force=False):
+        return (await self.call('RemoveContainer', name=ident, force=force))['container']
+
+    async def wait_container(self, ident, interval=500):
+        """
+        Wait for a container to exit, returning its exit code.
+
+        interval is how often podman checks, in milliseconds.
+        """
+        return (await self.call('WaitContainer', name=ident, interval=interval))['exitcode']
+
+    async def get_container_stats(self, ident):
+        return (await self.call('GetContainerStats', name=ident))['container']
+
+    async def exec(self, ident, cmd, *, output=None, user=None, workdir=None, env=None):
+        """
+        Run a command in a running container, returning its exit code.
+
+        output is called with (stream, data) as output arrives, where stream
+        is varlink.STDOUT or varlink.STDERR.
+        """
+        opts = exec_opts(ident, cmd, user=user, workdir=workdir, env=env)
+        _, (reader, writer) = await self.call('ExecContainer', _upgrade=True, opts=opts)
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    raise ConnectionError("Exec stream ended without an exit code")
+                dest, length = FRAME_HEADER.unpack(header)
+                data = await reader.readexactly(length)
+                if dest in (STDOUT, STDERR):
+                    if output is not None:
+                        output(dest, data)
+                elif dest in (QUIT, HANG_UP):
+                    return EXIT_CODE.unpack(data)[0] if len(data) == EXIT_CODE.size else 0
+        finally:
+            writer.close()
@@ -0,0 +1,358 @@
+"""
+A deduplicating backup store for worlds.
+
+Region files (.mca) are split into their chunks, and each chunk is stored by
+the hash of its uncompressed NBT, so a chunk that didn't change since the last
+backup costs nothing. Other files are stored whole, the same way.
+
+A region file is:
+
+* 1024 4-byte locations: a 3-byte offset and a 1-byte length, in 4KiB sectors
+* 1024 4-byte timestamps
+* The chunks, each a 4-byte length, a compression type byte, and the data
+
+The store is a directory of:
+
+* objects/ab/cdef...: lzma-compressed chunk NBT and whole files
+* manifests/NAME.json: what went where in each backup
+
+Restoring lays the chunks back out into region files, recompressed the way
+they were. Pruning deletes old manifests, and then any objects they were the
+last to use. Backups and restores share a lock on the store, which pruning
+takes exclusively, so it can't delete an object a backup is counting on.
+
+zlib and lzma release the GIL, so compression runs in parallel on threads.
+"""
+import concurrent.futures
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import lzma
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+SECTOR = 4096
+CHUNKS = 1024
+
+#: The most sectors a chunk can take up in a region file
+MAX_SECTORS = 0xFF
+
+#: Chunks taking up this many sectors are kept as they are, since
+#: recompressing them might not fit in MAX_SECTORS any more
+RAW_SECTORS = MAX_SECTORS - 15
+
+GZIP = 1
+ZLIB = 2
+UNCOMPRESSED = 3
+
+DECOMPRESS = {
+    GZIP: gzip.decompress,
+    ZLIB: zlib.decompress,
+    UNCOMPRESSED: bytes,
+}
+
+COMPRESS = {
+    GZIP: gzip.compress,
+    ZLIB: zlib.compress,
+    UNCOMPRESSED: bytes,
+}
+
+
+def read_region(data):
+    """
+    Split a region file into chunks.
+
+    Returns the timestamps, and {index: (compression type, payload)}. Chunks
+    using a compression we don't know (eg LZ4, or stored in an external .mcc
+    file), or too close to the size limit to recompress, are given as type
+    None with their raw bytes, type byte included.
+    """
+    if len(data) < 2 * SECTOR:
+        raise ValueError("Region file is too short")
+    locations = struct.unpack_from(f'>{CHUNKS}I', data, 0)
+    timestamps = list(struct.unpack_from(f'>{CHUNKS}I', data, SECTOR))
+    chunks = {}
+    for index, loc in enumerate(locations):
+        offset = loc >> 8
+        if not offset:
+            continue
+        start = offset * SECTOR
+        length, = struct.unpack_from('>I', data, start)
+        if not length or start + 4 + length > len(data):
+            log.warning("Chunk %d is damaged, skipping it", index)
+            continue
+        ctype = data[start + 4]
+        raw = data[start + 5:start + 4 + length]
+        if ctype in DECOMPRESS and loc & 0xFF < RAW_SECTORS:
+            chunks[index] = (ctype, DECOMPRESS[ctype](raw))
+        else:
+            chunks[index] = (None, data[start + 4:start + 4 + length])
+    return timestamps, chunks
+
+
+def write_region(timestamps, chunks):
+    """
+    Lay out chunks ({index: (compression type, payload)}, as from
+    read_region()) into a region file.
+
+    Raises ValueError if a chunk is too big for one.
+    """
+    locations = [0] * CHUNKS
+    body = bytearray()
+    for index in sorted(chunks):
+        ctype, payload = chunks[index]
+        if ctype is None:
+            blob = payload
+        else:
+            blob = bytes([ctype]) + COMPRESS[ctype](payload)
+        blob = struct.pack('>I', len(blob)) + blob
+        sectors = -(-len(blob) // SECTOR)
+        if sectors > MAX_SECTORS:
+            raise ValueError(f"Chunk {index} is too big for a region file")
+        locations[index] = ((2 + len(body) // SECTOR) << 8) | sectors
+        body += blob + bytes(sectors * SECTOR - len(blob))
+    return (
+        struct.pack(f'>{CHUNKS}I', *locations)
+        + struct.pack(f'>{CHUNKS}I', *timestamps)
+        + bytes(body)
+    )
+
+
+class BackupStore:
+    """
+    A backup store in a local directory.
+    """
+    def __init__(self, root, *, workers=None):
+        self.root = root
+        self.workers = workers or os.cpu_count()
+        self._known = None
+        self._lock = threading.Lock()
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:])
+
+    def _manifest_path(self, name):
+        return os.path.join(self.root, 'manifests', f'{name}.json')
+
+    @contextlib.contextmanager
+    def _locked(self, mode):
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(os.path.join(self.root, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log.info("Waiting for another backup or prune to finish")
+                fcntl.flock(fd, mode)
+            yield
+        finally:
+            os.close(fd)
+
+    def _reserve(self, name):
+        """
+        Claim a backup name, by creating its manifest's temporary file. Without
+        a name, one is made from the time.
+
+        Returns the name and the temporary file.
+        """
+        os.makedirs(os.path.join(self.root, 'manifests'), exist_ok=True)
+        base = name or time.strftime('%Y%m%d-%H%M%S')
+        for n in itertools.count(1):
+            candidate = base if n == 1 else f"{base}-{n}"
+            path = self._manifest_path(candidate)
+            tmp = f"{path}.tmp"
+            if not os.path.exists(path):
+                try:
+                    open(tmp, 'x').close()
+                except FileExistsError:
+                    pass
+                else:
+                    # It might have been finished just before we claimed it
+                    if not os.path.exists(path):
+                        return candidate, tmp
+                    os.unlink(tmp)
+            if name:
+                raise FileExistsError(f"Backup {name} already exists")
+
+    def _load_known(self):
+        known = set()
+        objects = os.path.join(self.root, 'objects')
+        if os.path.isdir(objects):
+            for prefix in os.listdir(objects):
+                for rest in os.listdir(os.path.join(objects, prefix)):
+                    if not rest.endswith('.tmp'):
+                        known.add(prefix + rest)
+        return known
+
+    def _claim(self, digest):
+        """
+        Is this a new object that the caller should write?
+        """
+        with self._lock:
+            if digest in self._known:
+                return False
+            self._known.add(digest)
+            return True
+
+    def _write_object(self, digest, data):
+        path = self._object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(lzma.compress(data))
+        os.replace(tmp, path)
+        return len(data)
+
+    def _read_object(self, digest):
+        with open(self._object_path(digest), 'rb') as f:
+            return lzma.decompress(f.read())
+
+    def _store(self, pool, futures, data):
+        digest = hashlib.sha256(data).hexdigest()
+        if self._claim(digest):
+            futures.append(pool.submit(self._write_object, digest, data))
+        return digest
+
+    def backup(self, source, name=None):
+        """
+        Back up a directory, returning the manifest name and some stats.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            name, tmp = self._reserve(name)
+            try:
+                return name, self._backup(source, name, tmp)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+    def _backup(self, source, name, tmp):
+        self._known = self._load_known()
+        start = time.monotonic()
+        files = {}
+        futures = []
+        total = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for dirpath, _, filenames in os.walk(source):
+                for fname in sorted(filenames):
+                    path = os.path.join(dirpath, fname)
+                    rel = os.path.relpath(path, source)
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    total += len(data)
+                    entry = {'mtime': os.stat(path).st_mtime}
+                    if fname.endswith('.mca'):
+                        try:
+                            timestamps, chunks = read_region(data)
+                        except ValueError:
+                            # Empty or truncated, keep it as it is
+                            chunks = None
+                        if chunks is not None:
+                            entry['timestamps'] = timestamps
+                            entry['chunks'] = {
+                                str(index): [ctype, self._store(pool, futures, payload)]
+                                for index, (ctype, payload) in chunks.items()
+                            }
+                    if 'chunks' not in entry:
+                        entry['object'] = self._store(pool, futures, data)
+                    files[rel] = entry
+            written = sum(f.result() for f in futures)
+
+        manifest = {'name': name, 'created': time.time(), 'files': files}
+        with open(tmp, 'wt') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._manifest_path(name))
+        return {
+            'files': len(files),
+            'bytes': total,
+            'new_objects': len(futures),
+            'new_bytes': written,
+            'seconds': time.monotonic() - start,
+        }
+
+    def manifests(self):
+        """
+        The names of the backups, oldest first.
+        """
+        try:
+            names = os.listdir(os.path.join(self.root, 'manifests'))
+        except FileNotFoundError:
+            return []
+        # Naturally, so 20200101-120000-10 comes after 20200101-120000-9
+        return sorted(
+            (n[:-len('.json')] for n in names if n.endswith('.json')),
+            key=lambda n: [int(p) if p.isdigit() else p for p in re.split(r'(\d+)', n)],
+        )
+
+    def load_manifest(self, name):
+        with open(self._manifest_path(name), 'rt') as f:
+            return json.load(f)
+
+    def _rebuild(self, entry):
+        if 'object' in entry:
+            return self._read_object(entry['object'])
+        return write_region(entry['timestamps'], {
+            int(index): (ctype, self._read_object(digest))
+            for index, (ctype, digest) in entry['chunks'].items()
+        })
+
+    def restore(self, name, dest):
+        """
+        Recreate a backup in a directory.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            self._restore(name, dest)
+
+    def _restore(self, name, dest):
+        manifest = self.load_manifest(name)
+
+        def restore_one(rel, entry):
+            path = os.path.join(dest, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(self._rebuild(entry))
+            os.utime(path, (entry['mtime'], entry['mtime']))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(restore_one, rel, e) for rel, e in manifest['files'].items()]:
+                future.result()
+
+    def prune(self, keep):
+        """
+        Delete all but the newest keep backups, and the objects only they used.
+
+        Returns (backups deleted, objects deleted).
+        """
+        if keep < 1:
+            raise ValueError(f"Pruning has to keep at least one backup, not {keep}")
+        with self._locked(fcntl.LOCK_EX):
+            return self._prune(keep)
+
+    def _prune(self, keep):
+        names = self.manifests()
+        doomed = names[:-keep]
+        for name in doomed:
+            os.unlink(self._manifest_path(name))
+
+        referenced = set()
+        for name in self.manifests():
+            for entry in self.load_manifest(name)['files'].values():
+                if 'object' in entry:
+                    referenced.add(entry['object'])
+                else:
+                    referenced.update(digest for _, digest in entry['chunks'].values())
+
+        removed = 0
+        for digest in self._load_known() - referenced:
+            os.unlink(self._object_path(digest))
+            removed += 1
+        return len(doomed), removed
@@ -0,0 +1,135 @@
+"""
+Turns podman build output into per-step records as it streams.
+
+podman (via buildah) announces each step with a line like "STEP 3: RUN ..."
+(or "STEP 3/7: RUN ..." in newer versions), and says "--> Using cache <id>"
+when a step's result was already cached. A step is timed from its line to the
+next one, or to the end of the build.
+"""
+import os
+import re
+import time
+
+STEP = re.compile(r'^STEP (\d+)(?:/(\d+))?: (.*)$')
+CACHE_HIT = re.compile(r'^--> Using cache\b')
+
+
+class BuildLog:
+    """
+    The output of one image build, and its steps.
+
+    If path is given, the output is also written there, and kept only if the
+    build failed.
+    """
+    def __init__(self, path=None, *, clock=time.monotonic):
+        self.path = path
+        self.steps = []
+        self.outcome = None
+        self.seconds = None
+        self._clock = clock
+        self._started = None
+        self._step_started = None
+        self._file = None
+
+    def start(self):
+        self._started = self._clock()
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, 'wt', encoding='utf-8')
+
+    def _end_step(self, now):
+        if self._step_started is not None:
+            self.steps[-1]['seconds'] = now - self._step_started
+            self._step_started = None
+
+    def feed(self, line):
+        """
+        Take a line of output (without the newline).
+        """
+        now = self._clock()
+        if self._started is None:
+            self._started = now
+        if self._file is not None:
+            self._file.write(line + '\n')
+        m = STEP.match(line)
+        if m:
+            self._end_step(now)
+            self.steps.append({
+                'step': int(m.group(1)),
+                'total': int(m.group(2)) if m.group(2) else None,
+                'instruction': m.group(3),
+                'seconds': None,
+                'cached': False,
+            })
+            self._step_started = now
+        elif CACHE_HIT.match(line) and self.steps:
+            self.steps[-1]['cached'] = True
+
+    def finish(self, outcome):
+        """
+        Record how the build went: built, failed or cancelled.
+        """
+        now = self._clock()
+        self._end_step(now)
+        self.outcome = outcome
+        self.seconds = now - self._started if self._started is not None else 0
+        # Older podmans don't say how many steps there are
+        for step in self.steps:
+            if step['total'] is None:
+                step['total'] = len(self.steps)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if outcome != 'failed':
+                os.unlink(self.path)
+
+    def record(self):
+        """
+        The results, for keeping in the state.
+        """
+        return {
+            'outcome': self.outcome,
+            'seconds': self.seconds,
+            'steps': self.steps,
+        }
+
+
+def compare(current, previous):
+    """
+    Match up the steps of two build records, generating
+    (step, previous seconds or None) for each step of current.
+
+    Steps are matched by position and instruction, so a step that changed
+    has nothing to compare against.
+    """
+    before = {
+        (s['step'], s['instruction']): s['seconds']
+        for s in (previous or {}).get('steps', [])
+    }
+    for step in current['steps']:
+        yield step, before.get((step['step'], step['instruction']))
+
+
+def report(name, records):
+    """
+    Generates lines comparing the last build of an image with the one before,
+    given the records newest first.
+    """
+    if not records:
+        yield f"{name}: no builds recorded"
+        return
+    current = records[0]
+    previous = records[1] if len(records) > 1 else None
+    line = f"{name}: {current['outcome']} in {current['seconds']:.1f}s"
+    if previous is not None:
+        line += f" (before: {previous['outcome']} in {previous['seconds']:.1f}s)"
+    yield line
+    for step, before in compare(current, previous):
+        change = f"{step['seconds'] - before:+7.1f}s" if before is not None else ' ' * 8
+        cached = 'cached' if step['cached'] else '      '
+        yield (
+            f"  {step['step']:>3}/{step['total']:<3} {step['seconds']:7.1f}s {change} {cached}"
+            f"  {step['instruction'][:60]}"
+        )
+    if current.get('log'):
+        yield f"  full output: {current['log']}"
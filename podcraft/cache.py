@@ -0,0 +1,268 @@
+"""
+Local cache of downloaded build contexts.
+
+Tarballs are stored by the digest of their content, and an index maps each
+URL to its digest and ETag so that it can be revalidated with a conditional
+request instead of downloaded again.
+"""
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import requests
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+
+class NotCached(Exception):
+    """
+    Running offline, and the URL isn't in the cache.
+    """
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return pathlib.Path(base) / 'podcraft' / 'contexts'
+
+
+def default_index():
+    return {
+        'urls': {},
+        'blobs': {},
+    }
+
+
+class ContextCache:
+    """
+    Content-addressed download cache with LRU eviction.
+
+    If offline, nothing is requested and only cached content is used.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, root=None, *, max_size=DEFAULT_MAX_SIZE, offline=False):
+        self.root = pathlib.Path(root) if root is not None else default_cache_dir()
+        self.max_size = max_size
+        self.offline = offline
+        self._lock = threading.Lock()
+
+    @property
+    def index_file(self):
+        return self.root / 'index.json'
+
+    def blob_path(self, digest):
+        return self.root / 'blobs' / digest
+
+    def _load_index(self):
+        try:
+            with self.index_file.open('rt') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default_index()
+        except ValueError:
+            log.warning("Download cache index is corrupt, starting over")
+            return default_index()
+
+    def _save_index(self, index):
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.index-')
+        with os.fdopen(fd, 'wt') as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_file)
+
+    def _lookup(self, url):
+        """
+        Get the cached digest and etag for a URL, if the blob still exists.
+        """
+        with self._lock:
+            entry = self._load_index()['urls'].get(url)
+        if entry and self.blob_path(entry['digest']).exists():
+            return entry['digest'], entry.get('etag')
+        return None, None
+
+    def _record(self, url, digest, etag=None, *, refresh=True):
+        """
+        Note that url was just used, and evict whatever no longer fits.
+        """
+        with self._lock:
+            index = self._load_index()
+            if refresh:
+                index['urls'][url] = {'digest': digest, 'etag': etag, 'fetched': time.time()}
+            index['blobs'][digest] = {
+                'size': self.blob_path(digest).stat().st_size,
+                'used': time.time(),
+            }
+            self._evict(index, keep=digest)
+            self._save_index(index)
+
+    def _evict(self, index, *, keep):
+        blobs = index['blobs']
+        total = sum(b['size'] for b in blobs.values())
+        for digest in sorted(blobs, key=lambda d: blobs[d]['used']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            log.debug("Evicting %s from the download cache", digest)
+            total -= blobs.pop(digest)['size']
+            try:
+                self.blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+            index['urls'] = {
+                u: e for u, e in index['urls'].items() if e['digest'] != digest
+            }
+
+    def _revalidate(self, url):
+        """
+        Work out if the URL needs downloading.
+
+        Returns (digest, response), where response is None if the cached copy
+        can be used as-is.
+        """
+        digest, etag = self._lookup(url)
+
+        if self.offline:
+            if digest is None:
+                raise NotCached(url)
+            self._record(url, digest, refresh=False)
+            return digest, None
+
+        headers = {}
+        if digest is not None and etag:
+            headers['If-None-Match'] = etag
+
+        try:
+            resp = requests.get(url, headers=headers, stream=True)
+        except requests.ConnectionError:
+            if digest is None:
+                raise
+            log.warning("Could not reach %s, using cached copy", url)
+            self._record(url, digest, refresh=False)
+            return digest, None
+
+        if resp.status_code == 304:
+            log.debug("%s unchanged", url)
+            resp.close()
+            self._record(url, digest, etag)
+            return digest, None
+        try:
+            resp.raise_for_status()
+        except Exception:
+            resp.close()
+            raise
+        return None, resp
+
+    @contextlib.contextmanager
+    def _download(self, url, resp, cancel):
+        """
+        Yields a file-like reading the response body, saving it to the cache
+        as it is read. Whatever isn't read is drained at the end.
+        """
+        blobdir = self.blob_path('x').parent
+        blobdir.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=blobdir, prefix='.download-')
+        try:
+            with resp, os.fdopen(fd, 'wb') as f:
+                tee = _Tee(resp.iter_content(chunk_size=self.chunk_size), f, cancel)
+                yield io.BufferedReader(tee, self.chunk_size)
+                tee.drain()
+            digest = f'sha256-{tee.hasher.hexdigest()}'
+            os.replace(tmp, self.blob_path(digest))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._record(url, digest, resp.headers.get('ETag'))
+
+    @contextlib.contextmanager
+    def open(self, url, *, cancel=None):
+        """
+        Open the content of the URL as a binary file.
+
+        If it needs downloading, it is streamed from the network as it is read
+        (and cached as a side effect), so it's never all in memory at once.
+        cancel is checked between chunks.
+        """
+        digest, resp = self._revalidate(url)
+        if resp is None:
+            with self.blob_path(digest).open('rb') as f:
+                yield f
+        else:
+            with self._download(url, resp, cancel) as f:
+                yield f
+
+    def fetch(self, url, *, cancel=None):
+        """
+        Get a local copy of the given URL, downloading it if it changed.
+
+        Returns the path to the cached file. cancel is checked between chunks.
+        """
+        digest, resp = self._revalidate(url)
+        if resp is not None:
+            with self._download(url, resp, cancel):
+                pass
+            digest, _ = self._lookup(url)
+        return self.blob_path(digest)
+
+    def digest(self, url):
+        """
+        Get the digest of the current content of the URL, fetching if needed.
+        """
+        return self.fetch(url).name
+
+    def cached_digest(self, url):
+        """
+        Get the digest of the cached content of the URL without going to the
+        network, or None if it isn't cached.
+        """
+        return self._lookup(url)[0]
+
+
+class _Tee(io.RawIOBase):
+    """
+    Reads from an iterator of chunks, copying them to a file and a hash.
+    """
+    def __init__(self, chunks, copy, cancel=None):
+        self.chunks = chunks
+        self.copy = copy
+        self.cancel = cancel
+        self.hasher = hashlib.sha256()
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        for chunk in self.chunks:
+            if self.cancel is not None:
+                self.cancel.check()
+            if chunk:  # Filter out keep-alive new chunks
+                self.hasher.update(chunk)
+                self.copy.write(chunk)
+                return chunk
+        return b''
+
+    def readinto(self, buf):
+        if not self.pending:
+            self.pending = self._next_chunk()
+        n = min(len(buf), len(self.pending))
+        buf[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def drain(self):
+        """
+        Consume the rest of the stream, so the copy is complete.
+        """
+        self.pending = b''
+        while self._next_chunk():
+            pass
@@ -0,0 +1,12 @@
+"""
+Names the CLI offers as choices.
+
+They live here rather than next to what implements them, so the CLI can
+list them without importing those modules.
+"""
+
+#: What podcraft fleet can do to every project
+FLEET_OPERATIONS = ('build', 'rcon', 'start', 'status', 'stop')
+
+#: What each podcraft loadtest connection does
+LOADTEST_SCENARIOS = ('login', 'status')
@@ -2,43 +2,174 @@ import json
 import os
 import sys
 import logging
+import time
 
 import click
 
-from .mainobj import Podcraft, NoProjectError
+from .choices import FLEET_OPERATIONS, LOADTEST_SCENARIOS
+from .config import ConfigError, MINECRAFT_PORT
+from .mainobj import CONFIG_FILE_NAME, Podcraft, NoProjectError
 
+# Anything more than what every command needs is imported in the commands
+# that use it, to keep startup quick.
 
-@click.group()
+
+class Main(click.Group):
+    """
+    Reports mistakes in podcraft.toml as a message, not a traceback.
+    """
+    def invoke(self, ctx):
+        try:
+            return super().invoke(ctx)
+        except ConfigError as exc:
+            sys.exit(f"Error in {CONFIG_FILE_NAME}: {exc}")
+
+
+@click.group(cls=Main)
+@click.option('--profile', is_flag=True,
+              help="Time the phases of the command, and write them out as a Chrome trace")
+@click.option('--trace-file', type=click.Path(dir_okay=False), default='podcraft-trace.json',
+              help="Where --profile writes the trace")
 @click.pass_context
-def main(ctx):
+def main(ctx, profile, trace_file):
     logging.basicConfig(format='%(message)s', level=logging.DEBUG)
+    if profile:
+        _start_profile(ctx, trace_file)
+    if ctx.invoked_subcommand == 'fleet':
+        # Works on many projects, not the one we're in
+        return
     try:
         ctx.obj = Podcraft.find_project(os.getcwd())
     except NoProjectError:
         sys.exit("No podcraft.toml found")
 
 
+def _start_profile(ctx, trace_file):
+    """
+    Trace the command, writing out the spans when it's done.
+    """
+    from . import tracing
+
+    recorder = tracing.start()
+    start = recorder.clock()
+
+    def finish():
+        recorder.add(f'podcraft {ctx.invoked_subcommand}', start, recorder.clock(), {})
+        tracing.stop()
+        with open(trace_file, 'wt') as f:
+            json.dump({'traceEvents': recorder.trace_events(), 'displayTimeUnit': 'ms'}, f)
+        for line in tracing.format_summary(recorder):
+            click.echo(line, err=True)
+        click.echo(f"Trace written to {trace_file}", err=True)
+
+    ctx.call_on_close(finish)
+
+
 @main.command()
+@click.option('--jobs', '-j', type=int, default=None,
+              help="How many images to build at once (default: one per CPU)")
+@click.option('--offline', is_flag=True,
+              help="Build from previously downloaded sources, without network access")
+@click.option('--context', type=click.Choice(['extract', 'stdin']), default='extract',
+              help="Unpack build contexts to disk, or pipe them to podman build as a tar")
+@click.option('--plan', 'dry_run', is_flag=True,
+              help="Show what would be rebuilt (going by the cached build contexts), without doing it")
+@click.option('--full', is_flag=True,
+              help="Tear everything down and rebuild it, even if it's up to date")
+@click.option('--keep-images', is_flag=True,
+              help="With --full, keep the old images (until the next unbuild) so their layers "
+                   "can be reused")
+@click.option('--blue-green', is_flag=True,
+              help="Build a new pod alongside the running one and swap over to it")
+@click.option('--report', is_flag=True,
+              help="Show how long each step of the last build took, compared to the one before")
 @click.pass_obj
-def build(pc):
+def build(pc, jobs, offline, context, dry_run, full, keep_images, blue_green, report):
     """
     (Re)build containers and related resources.
+
+    Only what changed since the last build is rebuilt.
+
+    With --blue-green, the server keeps running while everything is built
+    in a new pod, and is only down while it's swapped over. The old pod is
+    kept for rollback.
     """
-    with pc:
-        pc.cleanup()
-        pc.rebuild_everything()
+    if report:
+        from .buildlog import report as build_report
+
+        builds = pc.state.peek().get('builds', {})
+        if not builds:
+            click.echo("No builds recorded")
+        for name in sorted(builds):
+            for line in build_report(name, builds[name]):
+                click.echo(line)
+        return
+    if keep_images and not full:
+        raise click.UsageError("--keep-images only makes sense with --full")
+    with pc.exclusive():
+        if full and not dry_run and not blue_green:
+            # Old images go in the background while the new ones build
+            pc.cleanup(keep_images=keep_images, wait=False)
+        # A dry run doesn't download anything, so it goes by the cached contexts
+        plan = pc.plan(offline=offline, force=full, check_upstream=not dry_run)
+        if dry_run:
+            for line in plan.describe():
+                click.echo(line)
+            return
+        from .cache import NotCached
+
+        try:
+            if not blue_green:
+                pc.apply_plan(
+                    plan, jobs=jobs, offline=offline, context=context, keep_images=keep_images,
+                )
+            elif not plan:
+                click.echo("Everything is up to date")
+            else:
+                _report_swap(pc.blue_green(plan, jobs=jobs, offline=offline, context=context))
+        except NotCached as exc:
+            sys.exit(f"{exc} isn't in the download cache, so it can't be built with --offline")
+
+
+def _report_swap(downtime):
+    if downtime is None:
+        click.echo("Swapped (the server wasn't running)")
+    else:
+        click.echo(f"Swapped with {downtime:.2f}s of downtime")
+
+
+@main.command()
+@click.pass_obj
+def rollback(pc):
+    """
+    Swap back to the pod from before the last blue/green build.
+
+    Running it again swaps forward again.
+    """
+    with pc.exclusive():
+        try:
+            downtime = pc.rollback()
+        except ValueError as exc:
+            sys.exit(str(exc))
+        _report_swap(downtime)
 
 
 @main.command()
+@click.option('--keep-images', is_flag=True,
+              help="Leave the images, so the next build can reuse them")
 @click.pass_obj
-def unbuild(pc):
+def unbuild(pc, keep_images):
     """
     Clean up container-related resources.
 
     Does not delete volume data.
     """
-    with pc:
-        pc.cleanup()
+    with pc.exclusive():
+        results = pc.cleanup(keep_images=keep_images)
+    failed = [r for r in results if r.outcome == r.FAILED]
+    for r in failed:
+        click.echo(f"Could not remove {r.name} {r.kind} {r.id}: {r.error}", err=True)
+    sys.exit(1 if failed else 0)
 
 
 @main.command()
@@ -49,20 +180,41 @@ def start(pc):
 
     Will fail if it's not built.
     """
-    with pc:
+    with pc.exclusive():
         pc.start()
 
 
+def _format_limit(setting, value):
+    if value is None:
+        return "unlimited" if setting != 'cgroup-parent' else "default"
+    if setting == 'memory':
+        return f"{value / 2**20:.0f} MiB"
+    return str(value)
+
+
 @main.command()
+@click.option('--verbose', '-v', is_flag=True, help="Show the containers' resource limits too")
 @click.pass_obj
-def status(pc):
+def status(pc, verbose):
     """
     Checks if the server is running.
 
     0 if it is, 1 if it isn't.
     """
     with pc:
-        sys.exit(0 if pc.is_running() else 1)
+        running = pc.is_running()
+        if verbose:
+            import asyncio
+
+            click.echo("running" if running else "not running")
+            for name, limits in asyncio.run(pc.alimits()).items():
+                if isinstance(limits, Exception):
+                    click.echo(f"{name}: can't inspect ({limits})")
+                    continue
+                click.echo(f"{name}:")
+                for setting, value in limits.items():
+                    click.echo(f"  {setting}: {_format_limit(setting, value)}")
+        sys.exit(0 if running else 1)
 
 
 @main.command()
@@ -71,51 +223,420 @@ def stop(pc):
     """
     Stop the server.
     """
-    with pc:
+    with pc.exclusive():
         pc.stop()
 
 
+@main.command('exec')
+@click.option('--user', '-u', help="User to run as")
+@click.option('--workdir', '-w', help="Working directory in the container")
+@click.argument('cname')
+@click.argument('cmd', nargs=-1, required=True)
+@click.pass_obj
+def exec_(pc, cname, cmd, user, workdir):
+    """
+    Run a command in one of the containers, streaming its output
+    """
+    from . import varlink
+
+    outs = {
+        varlink.STDOUT: click.get_binary_stream('stdout'),
+        varlink.STDERR: click.get_binary_stream('stderr'),
+    }
+
+    def output(stream, data):
+        outs[stream].write(data)
+        outs[stream].flush()
+
+    with pc:
+        sys.exit(pc.exec_streamed(cname, cmd, output, user=user, workdir=workdir))
+
+
 @main.command()
+@click.option('--batch', '-b', type=click.File('rt'),
+              help="Run the commands in this file (- for stdin), one per line")
+@click.option('--window', type=int, default=1,
+              help="Send this many commands before waiting for responses (not for vanilla)")
 @click.argument('cmd', nargs=-1)
 @click.pass_obj
-def rcon(pc, cmd):
+def rcon(pc, cmd, batch, window):
     """
     Run an rcon command
     """
-    with pc:
-        rc, out = pc.exec('server', ['cmd', ' '.join(cmd)])
-        print(out)
+    from .rcon import RconError, RconUnavailable
+
+    commands = [' '.join(cmd)] if cmd else []
+    if batch is not None:
+        commands += [
+            line.strip() for line in batch
+            if line.strip() and not line.lstrip().startswith('#')
+        ]
+    try:
+        client = pc.rcon()
+    except RconUnavailable:
+        # Fall back to running the command inside the container
+        rc = 0
+        with pc:
+            for c in commands:
+                rc, out = pc.exec('server', ['cmd', c])
+                print(out)
+                if rc:
+                    break
         sys.exit(rc)
 
+    try:
+        with client:
+            for out in client.batch(commands, window=window):
+                print(out)
+    except (RconError, OSError) as exc:
+        sys.exit(f"RCON failed: {exc}")
+
+
+def _print_status(data):
+    from . import slp
+
+    # This bit adapted from mcstatus
+    click.echo(f"version: v{data['version']['name']} (protocol {data['version']['protocol']})")
+    click.echo(f"description: {slp.description_text(data['description'])}")
+    click.echo(
+        "players: {}/{} {}".format(
+            data['players']['online'],
+            data['players']['max'],
+            [
+                "{} ({})".format(player['name'], player['id'])
+                for player in data['players']['sample']
+            ] if data.get('players', {}).get('sample') else "No players online"
+        )
+    )
+
 
 @main.command()
-@click.argument('cmd', nargs=-1)
+@click.option('--watch', '-w', is_flag=True, help="Keep pinging until interrupted")
+@click.option('--interval', '-i', type=float, default=1.0, help="Seconds between pings when watching")
+@click.option('--timeout', type=float, default=5.0)
 @click.pass_obj
-def ping(pc, cmd):
+def ping(pc, watch, interval, timeout):
     """
     Do a server list ping
     """
-    with pc:
-        rc, out = pc.exec('server', ['status'])
+    from . import slp
+
+    if not watch:
         try:
-            data = json.loads(out)
-        except Exception:
-            click.echo(out)
-        else:
-            # This bit adapted from mcstatus
-            click.echo(f"version: v{data['version']['name']} (protocol {data['version']['protocol']})")
-            click.echo(f"description: {data['description']['text']}")
-            click.echo(
-                "players: {}/{} {}".format(
-                    data['players']['online'],
-                    data['players']['max'],
-                    [
-                        "{} ({})".format(player['name'], player['id'])
-                        for player in data['players']['sample']
-                    ] if data.get('players', {}).get('sample') else "No players online"
+            data, latency = pc.ping(timeout=timeout)
+        except (slp.SlpError, OSError) as exc:
+            sys.exit(f"Ping failed: {exc}")
+        _print_status(data)
+        click.echo(f"latency: {latency * 1000:.1f}ms")
+        return
+
+    samples = []
+    failed = 0
+    try:
+        while True:
+            try:
+                data, latency = pc.ping(timeout=timeout)
+            except (slp.SlpError, OSError) as exc:
+                failed += 1
+                click.echo(f"failed: {exc}")
+            else:
+                samples.append(latency)
+                click.echo(
+                    f"time={latency * 1000:.1f}ms "
+                    f"players={data['players']['online']}/{data['players']['max']}"
                 )
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    click.echo(f"{len(samples) + failed} pings, {failed} failed")
+    if samples:
+        low, avg, p99 = slp.latency_stats(samples)
+        click.echo(f"min/avg/p99 = {low * 1000:.1f}/{avg * 1000:.1f}/{p99 * 1000:.1f} ms")
+    if failed:
+        sys.exit(1)
+
+
+@main.command()
+@click.option('--full', is_flag=True, help="Copy everything, not just what changed")
+@click.pass_obj
+def snapshot(pc, full):
+    """
+    Copy the live world to the snapshot volume.
+
+    Saving is only paused for the final catch-up copy.
+    """
+    with pc:
+        stats = pc.snapshot(full=full)
+    final = stats['final']
+    changed = stats['warm']['changed'] + final['changed']
+    copied = stats['warm']['bytes'] + final['bytes']
+    click.echo(
+        f"{changed} of {final['files']} files copied ({copied / 2**20:.1f} MiB), "
+        f"{stats['warm']['removed'] + final['removed']} removed"
+    )
+    click.echo(f"saving paused for {stats['pause']:.2f}s")
+
+
+@main.group()
+@click.option('--store', '-s', type=click.Path(file_okay=False),
+              help="Backup store directory (default: store in [management.backup])")
+@click.pass_context
+def backup(ctx, store):
+    """
+    Deduplicating world backups.
+    """
+    ctx.obj = (ctx.obj, store)
+
+
+@backup.command('create')
+@click.option('--no-snapshot', is_flag=True, help="Back up the existing snapshot as it is")
+@click.option('--keep', type=click.IntRange(min=1), help="Then prune down to this many backups")
+@click.pass_obj
+def backup_create(obj, no_snapshot, keep):
+    """
+    Snapshot the world and back it up.
+    """
+    pc, store = obj
+    with pc:
+        name, stats = pc.backup(pc.backup_store(store), snapshot=not no_snapshot, keep=keep)
+    click.echo(
+        f"{name}: {stats['files']} files, {stats['bytes'] / 2**20:.1f} MiB, "
+        f"{stats['new_objects']} new objects ({stats['new_bytes'] / 2**20:.1f} MiB) "
+        f"in {stats['seconds']:.1f}s"
+    )
+
+
+@backup.command('list')
+@click.pass_obj
+def backup_list(obj):
+    """
+    List the backups, oldest first.
+    """
+    pc, store = obj
+    for name in pc.backup_store(store).manifests():
+        click.echo(name)
+
+
+@backup.command('restore')
+@click.argument('name')
+@click.argument('dest', type=click.Path(file_okay=False))
+@click.pass_obj
+def backup_restore(obj, name, dest):
+    """
+    Restore a backup into a directory.
+    """
+    pc, store = obj
+    pc.backup_store(store).restore(name, dest)
+
+
+@backup.command('prune')
+@click.option('--keep', type=click.IntRange(min=1), required=True, help="How many backups to keep")
+@click.pass_obj
+def backup_prune(obj, keep):
+    """
+    Delete old backups, and the data only they used.
+    """
+    pc, store = obj
+    backups, objects = pc.backup_store(store).prune(keep)
+    click.echo(f"Deleted {backups} backups and {objects} objects")
+
+
+@main.command()
+@click.option('--once', is_flag=True, help="Run one cycle now, instead of on the schedule")
+@click.option('--force', is_flag=True, help="Run even if the world hasn't changed")
+@click.option('--jobs', '-j', type=int, help="How many jobs to run at once")
+@click.option('--report', is_flag=True, help="Show how the jobs did last time, and exit")
+@click.pass_obj
+def schedule(pc, once, force, jobs, report):
+    """
+    Run the backup snapshots and jobs from [management.backup].
+    """
+    if report:
+        records = pc.state.peek().get('jobs', {})
+        for name, r in sorted(records.items()):
+            avg = sum(r['history']) / len(r['history'])
+            outcome = r['error'] or f"exit {r['rc']}"
+            click.echo(
+                f"{name}: {r['seconds']:.1f}s (avg {avg:.1f}s), "
+                f"{r.get('bytes', 0) / 2**20:.1f} MiB, {outcome}"
             )
-        sys.exit(rc)
+        return
+
+    from .scheduler import Scheduler
+
+    scheduler = Scheduler(pc, concurrency=jobs)
+    if not once:
+        try:
+            scheduler.run_forever()
+        except KeyboardInterrupt:
+            click.echo("Stopped")
+        return
+    records = scheduler.cycle(force=force)
+    if records is None:
+        click.echo("Nothing changed, skipped")
+        return
+    failed = [n for n, r in records.items() if r['error'] or r['rc']]
+    sys.exit(1 if failed else 0)
+
+
+@main.command()
+@click.option('--follow', '-f', is_flag=True, help="Keep printing lines as they're logged")
+@click.option('--all', 'all_logs', is_flag=True, help="Include the rotated logs")
+@click.option('--player', help="Find when a player joined and left")
+@click.option('--since', help="Only find events this recent (eg 3d, 12h)")
+@click.option('--lag', is_flag=True, help="Find tick lag warnings")
+@click.option('--errors', is_flag=True, help="Find errors")
+@click.option('--crashes', is_flag=True, help="Find crash reports")
+@click.pass_obj
+def logs(pc, follow, all_logs, player, since, lag, errors, crashes):
+    """
+    Show the server logs, or search the events in them.
+
+    Searches use an index that's brought up to date each time, rather than
+    reading all the logs.
+    """
+    from . import logs as logs_
+    from .scheduler import parse_frequency
+
+    logdir = pc.root / 'logs'
+    kinds = [k for k, on in [('lag', lag), ('error', errors), ('crash', crashes)] if on]
+    if player is not None:
+        kinds += ['join', 'leave']
+    if kinds or since:
+        cutoff = time.time() - parse_frequency(since) if since else None
+        with pc.log_index() as index:
+            index.update()
+            for ts, kind, who, detail in index.search(kinds=kinds, player=player, since=cutoff):
+                stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+                click.echo(f"{stamp} {kind:5} {detail}")
+        return
+
+    if all_logs:
+        for name in logs_.rotated_logs(logdir):
+            with logs_.open_log(str(logdir / name)) as f:
+                for line in f:
+                    click.echo(line, nl=False)
+    if follow:
+        try:
+            for line in logs_.follow(str(logdir), from_start=True):
+                click.echo(line)
+        except KeyboardInterrupt:
+            pass
+    elif (logdir / 'latest.log').exists():
+        with logs_.open_log(str(logdir / 'latest.log')) as f:
+            for line in f:
+                click.echo(line, nl=False)
+    elif not all_logs:
+        sys.exit("No logs yet, the server hasn't been started")
+
+
+@main.command()
+@click.option('--bind', default='127.0.0.1', help="Address to listen on")
+@click.option('--port', type=int, default=9225, help="Port to listen on")
+@click.option('--interval', type=float, default=15.0, help="Seconds between refreshes")
+@click.pass_obj
+def metrics(pc, bind, port, interval):
+    """
+    Serve Prometheus metrics for the server at /metrics.
+
+    Metrics are gathered in the background, so scrapes don't reach the
+    game server.
+    """
+    from .metrics import Collector, make_server
+
+    collector = Collector(pc, interval=interval)
+    collector.start()
+    server = make_server(collector, (bind, port))
+    click.echo(f"Serving metrics on http://{bind}:{port}/metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        collector.stop()
+
+
+@main.command()
+@click.option('--explain', is_flag=True, help="Show how each value was worked out")
+@click.pass_obj
+def jvm(pc, explain):
+    """
+    Show the JVM options the server is given.
+
+    They're worked out from the memory and CPUs the server can use, when
+    [jvm] auto = true.
+    """
+    from . import jvm as jvm_
+
+    if not jvm_.enabled(pc.config):
+        click.echo("Automatic JVM options are off, set [jvm] auto = true to turn them on")
+        return
+    options, steps = jvm_.derive(pc.config)
+    if explain:
+        for step in steps:
+            click.echo(f"{step.setting}: {step.value}  ({step.reason})")
+        click.echo()
+    click.echo(' '.join(options))
+
+
+@main.command()
+@click.option('--scenario', '-s', type=click.Choice(LOADTEST_SCENARIOS), default='status',
+              help="Status pings, or handshakes up to the start of login")
+@click.option('--connections', '-n', type=int, default=1000, help="Total connections to make")
+@click.option('--concurrency', '-c', type=int, default=100, help="Connections to have open at once")
+@click.option('--processes', '-p', type=int, default=1, help="Spread the load over this many processes")
+@click.option('--timeout', type=float, default=10.0)
+@click.option('--output', '-o', type=click.File('wt'), default='-', help="Where to write the JSON report")
+@click.pass_obj
+def loadtest(pc, scenario, connections, concurrency, processes, timeout, output):
+    """
+    Put synthetic load on the server and report how it coped, as JSON.
+    """
+    from . import loadtest as loadtest_, slp
+
+    port = pc.config.host_port('server', MINECRAFT_PORT)
+    try:
+        report = loadtest_.run(
+            '127.0.0.1', port, scenario=scenario, connections=connections,
+            concurrency=concurrency, processes=processes, timeout=timeout,
+        )
+    except (slp.SlpError, OSError) as exc:
+        sys.exit(f"Server did not answer a ping: {exc}")
+    json.dump(report, output, indent=2)
+    output.write('\n')
+    sys.exit(1 if report['failed'] else 0)
+
+
+@main.command()
+@click.option('--root', '-r', 'roots', multiple=True, type=click.Path(exists=True, file_okay=False),
+              help="Directory to look for projects under (default: the current one)")
+@click.option('--jobs', '-j', type=int, default=8, help="How many projects to work on at once")
+@click.option('--json', 'as_json', is_flag=True, help="Print the results as JSON")
+@click.argument('operation', type=click.Choice(FLEET_OPERATIONS))
+@click.argument('args', nargs=-1)
+def fleet(roots, jobs, as_json, operation, args):
+    """
+    Run an operation on every project under some directories.
+
+    Exits with 0 if it went fine everywhere, 1 if any server is stopped or any
+    command failed, and 2 if there were any errors.
+    """
+    from . import fleet as fleet_
+    from .podman import server as podman_server
+
+    projects = list(fleet_.find_projects(roots or [os.getcwd()]))
+    if not projects:
+        sys.exit("No podcraft.toml found")
+    with podman_server() as address:
+        results = list(fleet_.run(projects, operation, args, address=address, workers=jobs))
+    if as_json:
+        click.echo(json.dumps([r._asdict() for r in results], indent=2))
+    else:
+        for line in fleet_.format_table(results):
+            click.echo(line)
+    sys.exit(fleet_.summarize(results))
+
 
 # init/new
 # Whitelist
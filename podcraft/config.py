@@ -4,6 +4,7 @@ Do all the calculations for config stuff.
 This does no work, just manages config and computes values.
 """
 import json
+import re
 import secrets
 
 MINECRAFT_PORT = 25565
@@ -11,6 +12,40 @@ RCON_PORT = 25575
 QUERY_PORT = 25565
 
 
+class ConfigError(ValueError):
+    """
+    Something in podcraft.toml is wrong.
+    """
+
+
+def read_properties(path):
+    """
+    Read a server.properties file into a dict of strings.
+    """
+    props = {}
+    with open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(('#', '!')):
+                continue
+            key, _, value = line.partition('=')
+            props[key.strip()] = value.strip()
+    return props
+
+
+#: [resources.<container>] keys -> (Create field, conversion)
+RESOURCE_FIELDS = {
+    'memory': ('memory', str),
+    'cpus': ('cpus', float),
+    'cpuset': ('cpuSetCpus', str),
+    'blkio-weight': ('blkioWeight', str),
+    'pids-limit': ('pidsLimit', int),
+}
+
+SIZE = re.compile(r'^\d+(\.\d+)?[bkmg]?$', re.IGNORECASE)
+CPUSET = re.compile(r'^\d+(-\d+)?(,\d+(-\d+)?)*$')
+
+
 # A lot of assumptions are encoded here (Especially those shared with various Dockerfiles)
 class Config(dict):
     podman_dir = '.tmp/podman'
@@ -38,6 +73,13 @@ class Config(dict):
             'extra_pkgs': json.dumps(self['management'].get('plugins')),
         }
 
+    def addons(self):
+        """
+        Generates (name, image) for each addon container
+        """
+        for i, addon in enumerate(self.get('addon', [])):
+            yield f'addon-{i}', addon['image']
+
     def server_properties(self):
         """
         Compute the values of server.properties for use inside the pod.
@@ -87,6 +129,63 @@ class Config(dict):
 
         return rv
 
+    def host_port(self, cname, port, proto='tcp'):
+        """
+        Find the port on the host that forwards to the given container port.
+
+        Returns None if it isn't exposed.
+        """
+        for outter, (name, inner) in self.exposed_ports().items():
+            hport, _, hproto = outter.partition('/')
+            if name == cname and inner == port and hproto == proto:
+                return int(hport)
+
+    def _check_resources(self):
+        """
+        Catch misspelled container names in [resources], which would otherwise
+        quietly set no limits
+        """
+        containers = ['server', 'manager'] + [name for name, _ in self.addons()]
+        for key in self.get('resources', {}):
+            if key != 'cgroup-parent' and key not in containers:
+                raise ConfigError(
+                    f"Unknown container {key} in [resources], should be one of {', '.join(containers)}"
+                )
+
+    def pod_options(self):
+        """
+        The extra options for creating the pod, from [resources]
+        """
+        self._check_resources()
+        parent = self.get('resources', {}).get('cgroup-parent')
+        return {'cgroupparent': parent} if parent else {}
+
+    def container_options(self, name):
+        """
+        The extra Create fields for a container, from [resources.<name>]
+        """
+        self._check_resources()
+        settings = self.get('resources', {}).get(name, {})
+        opts = {}
+        for key, value in settings.items():
+            if key not in RESOURCE_FIELDS:
+                raise ConfigError(f"Unknown setting {key} in [resources.{name}]")
+            field, convert = RESOURCE_FIELDS[key]
+            opts[field] = convert(value)
+        if 'memory' in opts and not SIZE.match(opts['memory']):
+            raise ConfigError(f"[resources.{name}] memory should be like 512m or 6g, not {opts['memory']}")
+        if 'cpuSetCpus' in opts and not CPUSET.match(opts['cpuSetCpus']):
+            raise ConfigError(f"[resources.{name}] cpuset should be like 0-3 or 2,4,6, not {opts['cpuSetCpus']}")
+        if 'blkioWeight' in opts and not 10 <= int(opts['blkioWeight']) <= 1000:
+            raise ConfigError(f"[resources.{name}] blkio-weight should be from 10 to 1000")
+        return opts
+
+    def backup_store(self):
+        """
+        The directory of the deduplicating backup store, or None.
+        """
+        return self['management'].get('backup', {}).get('store')
+
     def volumes(self):
         """
         Generates (host location, mount point) of all the volumes in the config.
@@ -7,11 +7,12 @@ import logging
 from podman.libs import ConfigDict, flatten
 from podman.libs.containers import Container
 
-from .images import get_volumes
+from .images import get_volumes, inspect_image
+from .tracing import span
 
 
-def create_container(image, pod, volumes, **opts):
-    img_volumes = set(get_volumes(image))
+def create_container(image, pod, volumes, *, state=None, **opts):
+    img_volumes = set(get_volumes(image, state=state))
     c_mounts = [
         f"type=bind,source={h},destination={c}"
         for c, h in volumes.items() if c in img_volumes
@@ -21,26 +22,27 @@ def create_container(image, pod, volumes, **opts):
         image,
         pod=pod.id,
         mount=c_mounts,
+        state=state,
         **opts
     )
 
 
 # Exists because bug work-arounds
-def _create(self, *args, **kwargs):
+def _create(self, *args, state=None, **kwargs):
     """Create container from image.
     Pulls defaults from image.inspect()
     """
-    details = self.inspect()
+    details = inspect_image(self, state=state)
 
     config = ConfigDict(image_id=self._id, **kwargs)
     config["command"] = details.config.get("cmd")
-    config["env"] = self._split_token(details.config.get("env"))
+    config["env"] = dict(self._split_token(details.config.get("env")), **kwargs.get("env", {}))
     config["image"] = copy.deepcopy(details.repotags[0])  # Falls to https://github.com/containers/python-podman/issues/65
     config["labels"] = copy.deepcopy(details.labels)
     config["args"] = [config["image"], *config["command"]]
 
     logging.debug("Image %s: create config: %s", self._id, config)
-    with self._client() as podman:
+    with span('create container'), self._client() as podman:
         id_ = podman.CreateContainer(config)["container"]
         cntr = podman.GetContainer(id_)
     return Container(self._client, id_, cntr["container"])
@@ -0,0 +1,141 @@
+"""
+Running an operation across many podcraft projects at once.
+
+Projects are found by looking for podcraft.toml under some roots. They all
+share one podman varlink server, and are worked on by a bounded pool of
+threads.
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import time
+
+from .mainobj import Podcraft, CONFIG_FILE_NAME
+from .podman import persistent_server
+
+log = logging.getLogger(__name__)
+
+#: Exit codes, worst last
+OK = 0
+NOT_OK = 1  # Eg, the server isn't running or the command failed
+ERROR = 2  # Something went wrong doing the operation
+
+Result = collections.namedtuple('Result', ['project', 'rc', 'detail', 'elapsed'])
+
+
+def find_projects(roots):
+    """
+    Find the projects under the given directories, in order.
+
+    Projects are not looked for inside other projects.
+    """
+    seen = set()
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            if CONFIG_FILE_NAME in filenames:
+                dirnames[:] = []
+                path = os.path.realpath(dirpath)
+                if path not in seen:
+                    seen.add(path)
+                    yield dirpath
+            else:
+                dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+
+
+def _status(pc, args):
+    running = pc.is_running()
+    return (OK if running else NOT_OK), "running" if running else "stopped"
+
+
+def _start(pc, args):
+    # The manager talks to podman through the project's own server
+    persistent_server(
+        pc.root / pc.config.podman_socket,
+        pc.root / pc.config.podman_pidfile,
+    )
+    pc.start()
+    return OK, "started"
+
+
+def _stop(pc, args):
+    pc.stop()
+    return OK, "stopped"
+
+
+def _build(pc, args):
+    plan = pc.plan()
+    if not plan:
+        return OK, "up to date"
+    # Each project gets one build at a time, the fleet is the parallelism
+    pc.apply_plan(plan, jobs=1)
+    return OK, f"{len(plan.steps)} steps"
+
+
+def _rcon(pc, args):
+    with pc.rcon() as client:
+        return OK, client.command(' '.join(args))
+
+
+#: The operations that change the project, so need it to themselves
+EXCLUSIVE = {'build', 'start', 'stop'}
+
+OPERATIONS = {
+    'status': _status,
+    'start': _start,
+    'stop': _stop,
+    'build': _build,
+    'rcon': _rcon,
+}
+
+
+def _run_one(path, operation, args, address):
+    start = time.monotonic()
+    pc = Podcraft(path, podman_address=address)
+    try:
+        with (pc.exclusive() if operation in EXCLUSIVE else pc):
+            rc, detail = OPERATIONS[operation](pc, args)
+    except Exception as exc:
+        log.debug("%s: %s failed", path, operation, exc_info=True)
+        rc, detail = ERROR, f"{type(exc).__name__}: {exc}"
+    return Result(str(path), rc, detail, time.monotonic() - start)
+
+
+def run(projects, operation, args=(), *, address, workers=8):
+    """
+    Run an operation on each project, generating Results in project order.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_run_one, path, operation, args, address)
+            for path in projects
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def summarize(results):
+    """
+    The exit code for the whole fleet: the worst of the individual ones.
+    """
+    return max((r.rc for r in results), default=OK)
+
+
+def format_table(results):
+    """
+    Generates the lines of a table of results, with a summary at the end.
+    """
+    rows = [('PROJECT', 'RESULT', 'TIME', 'DETAIL')]
+    for r in results:
+        rows.append((
+            r.project, {OK: 'ok', NOT_OK: 'not ok', ERROR: 'error'}[r.rc],
+            f"{r.elapsed:.2f}s", ' / '.join(str(r.detail).splitlines()),
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    for row in rows:
+        yield '  '.join([c.ljust(w) for c, w in zip(row, widths)] + [row[3]]).rstrip()
+    counts = collections.Counter(r.rc for r in results)
+    yield (
+        f"{len(results)} projects: {counts[OK]} ok, {counts[NOT_OK]} not ok, "
+        f"{counts[ERROR]} errors"
+    )
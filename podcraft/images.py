@@ -11,20 +11,28 @@ Host-level stuff
 # * snapshot: The most recent snapshot of live
 # * Whatever additional persistent volumes are defined in server.toml
 # Only the first thing needs to be present
-import requests
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import logging
 import tempfile
 import tarfile
-import io
+import threading
 import os.path
 import subprocess
 
+from .cache import ContextCache
 from .namegen import generate_name
+from .tracing import span
 
 CONTAINER_REPOS = {
     'server': "https://github.com/minecraft-podman/docker-server/archive/master.tar.gz",
     'manage': "https://github.com/minecraft-podman/manage/archive/master.tar.gz",
 }
 
+log = logging.getLogger(__name__)
+
 
 # def build_img_from_url(podman, url buildargs):
 #     with tempfile.TemporaryDirectory() as tempdir:
@@ -65,47 +73,226 @@ CONTAINER_REPOS = {
 #         )
 
 
+class BuildCancelled(Exception):
+    """
+    The build was stopped because another one in the same batch failed.
+    """
+
+
+class Cancellation:
+    """
+    Shared between concurrent builds so that one failure can stop the rest.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._procs = set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """
+        Stop everything using this, including running subprocesses.
+        """
+        with self._lock:
+            self._event.set()
+            for proc in self._procs:
+                proc.terminate()
+
+    def check(self):
+        """
+        Raise BuildCancelled if cancelled.
+        """
+        if self.cancelled:
+            raise BuildCancelled
+
+    @contextlib.contextmanager
+    def process(self, proc):
+        """
+        Terminate the given process if cancelled while in this context.
+        """
+        with self._lock:
+            if self.cancelled:
+                proc.terminate()
+            self._procs.add(proc)
+        try:
+            yield proc
+        finally:
+            with self._lock:
+                self._procs.discard(proc)
+
+
+#: How much output to show when a command fails
+ERROR_TAIL = 20
+
+
+def _run_streamed(cli, *, name, cancel=None, verbose=False, feed=None, buildlog=None):
+    """
+    Run a command, logging its output line by line prefixed with name.
+
+    If given, feed is called in a thread with the process's stdin, and each
+    line is given to buildlog. If the command fails and its output wasn't
+    already being shown, the last of it is logged as an error.
+    """
+    if cancel is None:
+        cancel = Cancellation()
+    cancel.check()
+    proc = subprocess.Popen(
+        cli, stdin=subprocess.DEVNULL if feed is None else subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        encoding='utf-8', errors='replace',
+    )
+    feed_errors = []
+    if feed is not None:
+        def feeder():
+            try:
+                feed(proc.stdin.buffer)
+                proc.stdin.close()
+            except Exception as exc:
+                feed_errors.append(exc)
+                proc.terminate()
+        feed_thread = threading.Thread(target=feeder, name=f'{name}-feed', daemon=True)
+        feed_thread.start()
+
+    tail = collections.deque(maxlen=ERROR_TAIL)
+    with span(f'podman {cli[1]}', image=name), cancel.process(proc):
+        for line in proc.stdout:
+            line = line.rstrip()
+            log.log(logging.INFO if verbose else logging.DEBUG, "[%s] %s", name, line)
+            tail.append(line)
+            if buildlog is not None:
+                buildlog.feed(line)
+        proc.wait()
+    if feed is not None:
+        feed_thread.join()
+    cancel.check()
+    if feed_errors and not isinstance(feed_errors[0], BrokenPipeError):
+        raise feed_errors[0]
+    if proc.returncode:
+        if not verbose and not cancel.cancelled:
+            for line in tail:
+                log.error("[%s] %s", name, line)
+        raise subprocess.CalledProcessError(proc.returncode, cli)
+
+
+def _strip_root(member):
+    """
+    Strip the leading directory (which GitHub archives have) off a tar member.
+
+    Returns None if nothing is left, or if the name would escape the context.
+    """
+    name = member.name.split('/', 1)[1] if '/' in member.name else ''
+    if not name or name.startswith('/') or '..' in name.split('/'):
+        return None
+    member.name = name
+    if member.islnk():
+        member.linkname = member.linkname.split('/', 1)[-1]
+    return member
+
+
+def extract_stream(fileobj, dest):
+    """
+    Extract a .tar.gz as it is read, stripping the leading directory.
+
+    Only one member is held in memory at a time.
+    """
+    # The data filter is only in newer Pythons (and security backports)
+    extract_args = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as src:
+        for member in src:
+            member = _strip_root(member)
+            if member is not None:
+                src.extract(member, dest, **extract_args)
+
+
+def restream(fileobj, out):
+    """
+    Convert a .tar.gz into a plain tar as it is read, stripping the leading
+    directory.
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as src:
+        with tarfile.open(fileobj=out, mode='w|') as dest:
+            for member in src:
+                member = _strip_root(member)
+                if member is not None:
+                    dest.addfile(member, src.extractfile(member) if member.isreg() else None)
+
+
 # https://github.com/containers/python-podman/issues/63
-def build_img_from_url(podman, url, buildargs, *, verbose=False):
+def build_id_from_url(url, buildargs, *, name=None, cancel=None, cache=None, context='extract',
+                      verbose=False, buildlog=None):
     """
     Downloads a tarball from the given URL and uses it to build an image.
-    """
-    with tempfile.TemporaryDirectory() as tempdir:
-        # 1. Download repo
-        tarbuf = io.BytesIO()
-        with requests.get(url, stream=True) as resp:
-            resp.raise_for_status()
-            for chunk in resp.iter_content(chunk_size=8192):
-                if chunk:  # Filter out keep-alive new chunks
-                    tarbuf.write(chunk)
 
-        tarbuf.seek(0)
-        with tarfile.open(fileobj=tarbuf, mode='r:gz') as src:
-            src.extractall(tempdir)
-            root = src.getmembers()[0].name.split('/', 1)[0]
+    The download goes through cache (a ContextCache), so unchanged tarballs
+    are not downloaded again. Either way, the tarball is streamed rather than
+    loaded into memory:
 
-        buildroot = os.path.join(tempdir, root)
+    * context='extract': It's unpacked into a temporary directory as it
+      arrives, and that is built.
+    * context='stdin': Nothing is unpacked, it's fed to podman build as a tar
+      on stdin. This needs a podman that accepts a context archive on stdin.
+
+    If given, buildlog (a BuildLog) gets the build output.
+
+    Returns the ID of the new image.
+    """
+    name = name or url
+    if cancel is None:
+        cancel = Cancellation()
+    if cache is None:
+        cache = ContextCache()
+    with tempfile.TemporaryDirectory() as tempdir, \
+            tempfile.NamedTemporaryFile('w+t', encoding='utf-8') as ntf, \
+            cache.open(url, cancel=cancel) as tarball:
+        cli = ['podman', 'build']
+        for k, v in buildargs.items():
+            cli += ['--build-arg', f'{k}={v}']
+        cli += ['--iidfile', ntf.name]
+        cli += ['--tag', generate_name()]
+
+        if context == 'stdin':
+            cli += ['-']
+            feed = functools.partial(restream, tarball)
+        elif context == 'extract':
+            # 1. Download and unpack repo
+            extract_stream(tarball, tempdir)
+            cli += [tempdir]
+            feed = None
+        else:
+            raise ValueError(f"Unknown context mode {context!r}")
 
         # 2. Build into image
-        with tempfile.NamedTemporaryFile('w+t', encoding='utf-8') as ntf:
-            cli = ['podman', 'build']
-            for k, v in buildargs.items():
-                cli += ['--build-arg', f'{k}={v}']
-            cli += ['--iidfile', ntf.name]
-            cli += ['--tag', generate_name()]
-            cli += [buildroot]
-
-            # FIXME: Forward output on error
-            subprocess.run(
-                cli, stdin=subprocess.DEVNULL,
-                stdout=None if verbose else subprocess.DEVNULL,
-                stderr=subprocess.STDOUT,
-                check=True,
-            )
-
-            ntf.seek(0)
-            image_id = ntf.read().strip()
-        return podman.images.get(image_id)
+        _run_streamed(cli, name=name, cancel=cancel, verbose=verbose, feed=feed, buildlog=buildlog)
+
+        ntf.seek(0)
+        return ntf.read().strip()
+
+
+def build_img_from_url(podman, url, buildargs, *, cache=None, context='extract', verbose=False):
+    """
+    Downloads a tarball from the given URL and uses it to build an image.
+    """
+    return podman.images.get(
+        build_id_from_url(url, buildargs, cache=cache, context=context, verbose=verbose)
+    )
+
+
+def pull_image(source, *, name=None, cancel=None, offline=False, verbose=False, buildlog=None):
+    """
+    Pull an image from a registry.
+
+    If offline, the local copy is used as-is. Returns a reference to the image.
+    """
+    if offline:
+        return source
+    _run_streamed(
+        ['podman', 'pull', source], name=name or source, cancel=cancel, verbose=verbose,
+        buildlog=buildlog,
+    )
+    return source
 
 
 def build_server(podman, buildargs):
@@ -122,19 +309,92 @@ def build_manager(podman, buildargs):
     return build_img_from_url(podman, CONTAINER_REPOS['manage'], buildargs)
 
 
-def get_ports(image):
+def _run_logged(func, buildlog, **kwargs):
+    """
+    Run a build job, recording in buildlog how it went.
+    """
+    buildlog.start()
+    outcome = 'failed'
+    try:
+        ref = func(buildlog=buildlog, **kwargs)
+        outcome = 'built'
+        return ref
+    except BuildCancelled:
+        outcome = 'cancelled'
+        raise
+    finally:
+        buildlog.finish(outcome)
+
+
+def build_images(podman, jobs, *, max_workers=None, verbose=False, logs=None):
+    """
+    Run several image builds concurrently.
+
+    jobs maps names to callables like build_id_from_url() or pull_image(),
+    taking name and cancel keywords and returning an image reference. If
+    logs is given, it maps names to BuildLogs, which the callables are given
+    as a buildlog keyword.
+
+    Generates (name, image) as builds finish. If one fails, the rest are
+    cancelled and waited for before the error is raised.
+    """
+    if max_workers is None:
+        max_workers = min(len(jobs), os.cpu_count() or 1)
+    cancel = Cancellation()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as pool:
+        futures = {}
+        for name, func in jobs.items():
+            if logs is not None and name in logs:
+                func = functools.partial(_run_logged, func, logs[name])
+            futures[pool.submit(func, name=name, cancel=cancel, verbose=verbose)] = name
+        try:
+            for fut in concurrent.futures.as_completed(futures):
+                name = futures[fut]
+                try:
+                    ref = fut.result()
+                except BuildCancelled:
+                    continue
+                except Exception:
+                    log.error("Building %s failed, cancelling other builds", name)
+                    raise
+                yield name, podman.images.get(ref)
+        finally:
+            # Covers failures and the consumer giving up early
+            cancel.cancel()
+            for fut in futures:
+                fut.cancel()
+
+
+def inspect_image(image, *, state=None):
+    """
+    Get the inspection details of the given image.
+
+    Image IDs are immutable, so if a State is given, the details are cached
+    there.
+    """
+    details = state.get_inspect(image.id) if state is not None else None
+    if details is None:
+        with span('inspect image'):
+            ii = image.inspect()
+        if state is not None:
+            state.save_inspect(image.id, ii._asdict())
+        return ii
+    return collections.namedtuple('ImageInspect', details.keys())(**details)
+
+
+def get_ports(image, *, state=None):
     """
     Get the declared exposed ports for the given image.
 
     All are in the form of "<port>/<tcp|udp>".
     """
-    ii = image.inspect()
+    ii = inspect_image(image, state=state)
     yield from ii.config.get('exposedports', {}).keys()
 
 
-def get_volumes(image):
+def get_volumes(image, *, state=None):
     """
     Get the declared volumes for the given image
     """
-    ii = image.inspect()
+    ii = inspect_image(image, state=state)
     yield from ii.config.get('volumes', {}).keys()
@@ -0,0 +1,238 @@
+"""
+Works out JVM options for the server from the memory and CPUs it'll have.
+
+The memory available is the smallest of:
+
+* [resources.server] memory
+* The cgroup v2 memory.max of the pod's cgroup parent (and its ancestors)
+* The host's RAM
+
+Where podcraft itself happens to run doesn't count: the containers are put
+under the cgroup parent, or podman's default, not podcraft's cgroup.
+
+The heap is that minus headroom for the rest of the JVM (metaspace, thread
+stacks, GC structures, direct buffers), and for everything else when the
+memory is shared. Xms is the same as Xmx, so the heap is never resized.
+
+GC is G1 with Aikar's flags (https://mcflags.emc.gs), which keep pauses short
+with the allocation pattern of a Minecraft server.
+
+The options are given to the server container as JAVA_TOOL_OPTIONS, which
+every JVM picks up. This is off unless [jvm] auto is set, since options on the
+image's own command line win: an image with its own -Xmx smaller than the
+-Xms given here won't start.
+"""
+import collections
+import os
+import re
+
+from .config import ConfigError
+
+MiB = 2 ** 20
+GiB = 2 ** 30
+
+UNITS = {'': 1, 'b': 1, 'k': 2 ** 10, 'm': MiB, 'g': GiB}
+
+#: Heap is rounded down to a multiple of this
+HEAP_STEP = 256 * MiB
+MIN_HEAP = 512 * MiB
+
+#: The least memory to leave outside the heap, for the rest of the JVM
+MIN_HEADROOM = 512 * MiB
+
+#: Above this heap size, Aikar's flags use bigger regions and young gen
+LARGE_HEAP = 12 * GiB
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+Derivation = collections.namedtuple('Derivation', ['setting', 'value', 'reason'])
+
+G1_FLAGS = [
+    '-XX:+UseG1GC',
+    '-XX:+ParallelRefProcEnabled',
+    '-XX:MaxGCPauseMillis=200',
+    '-XX:+UnlockExperimentalVMOptions',
+    '-XX:+DisableExplicitGC',
+    '-XX:+AlwaysPreTouch',
+    '-XX:G1HeapWastePercent=5',
+    '-XX:G1MixedGCCountTarget=4',
+    '-XX:G1MixedGCLiveThresholdPercent=90',
+    '-XX:G1RSetUpdatingPauseTimePercent=5',
+    '-XX:SurvivorRatio=32',
+    '-XX:+PerfDisableSharedMem',
+    '-XX:MaxTenuringThreshold=1',
+]
+
+#: The flags that depend on heap size: (up to LARGE_HEAP, above it)
+G1_SIZED_FLAGS = [
+    ('-XX:G1NewSizePercent=30', '-XX:G1NewSizePercent=40'),
+    ('-XX:G1MaxNewSizePercent=40', '-XX:G1MaxNewSizePercent=50'),
+    ('-XX:G1HeapRegionSize=8M', '-XX:G1HeapRegionSize=16M'),
+    ('-XX:G1ReservePercent=20', '-XX:G1ReservePercent=15'),
+    ('-XX:InitiatingHeapOccupancyPercent=15', '-XX:InitiatingHeapOccupancyPercent=20'),
+]
+
+
+def parse_size(text):
+    """
+    Parse a size like podman's (512m, 6g) into bytes.
+    """
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([bkmg]?)', str(text).strip().lower())
+    if m is None:
+        raise ConfigError(f"Can't understand size {text!r}")
+    return int(float(m.group(1)) * UNITS[m.group(2)])
+
+
+def count_cpuset(cpuset):
+    """
+    How many CPUs are in a cpuset like 0-3,6.
+    """
+    count = 0
+    for part in cpuset.split(','):
+        first, _, last = part.partition('-')
+        count += int(last or first) - int(first) + 1
+    return count
+
+
+def _read(path):
+    try:
+        with open(path, 'rt') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_path(parent):
+    """
+    The cgroup v2 path of a cgroup parent, which can be a systemd slice name
+    like machine-mc.slice (which is machine.slice/machine-mc.slice).
+    """
+    if '/' in parent or not parent.endswith('.slice'):
+        return parent
+    parts = parent[:-len('.slice')].split('-')
+    return '/'.join('-'.join(parts[:i]) + '.slice' for i in range(1, len(parts) + 1))
+
+
+def cgroup_limits(path, *, root=CGROUP_ROOT):
+    """
+    The tightest memory.max and cpu.max (as CPUs) of a cgroup and its
+    ancestors, as (memory, cpus, where), with None for no limit.
+    """
+    memory = cpus = None
+    where = {}
+    parts = [p for p in path.split('/') if p]
+    for i in range(len(parts), -1, -1):
+        group = '/' + '/'.join(parts[:i])
+        mem = _read(os.path.join(root, *parts[:i], 'memory.max'))
+        if mem and mem != 'max' and (memory is None or int(mem) < memory):
+            memory, where['memory'] = int(mem), group
+        cpu = _read(os.path.join(root, *parts[:i], 'cpu.max'))
+        if cpu and not cpu.startswith('max'):
+            quota, period = map(int, cpu.split())
+            if cpus is None or quota / period < cpus:
+                cpus, where['cpus'] = quota / period, group
+    return memory, cpus, where
+
+
+def host_memory():
+    for line in (_read('/proc/meminfo') or '').splitlines():
+        if line.startswith('MemTotal:'):
+            return int(line.split()[1]) * 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _mib(n):
+    return f"{n / MiB:.0f} MiB"
+
+
+def derive(config, *, cgroups=None, host_ram=None, host_cpus=None):
+    """
+    Work out the JVM options for the server.
+
+    Returns (options, derivations), where derivations explains each value.
+    cgroups is a list of (memory, cpus, where) from cgroup_limits(), and is
+    found if not given; likewise host_ram and host_cpus.
+    """
+    resources = config.get('resources', {}).get('server', {})
+    jvm = config.get('jvm', {})
+    steps = []
+
+    if cgroups is None:
+        parent = config.get('resources', {}).get('cgroup-parent')
+        cgroups = [cgroup_limits(cgroup_path(parent))] if parent else []
+
+    # Memory
+    candidates = []
+    if 'memory' in resources:
+        candidates.append((parse_size(resources['memory']), True, "[resources.server] memory"))
+    for memory, _, where in cgroups:
+        if memory is not None:
+            candidates.append((memory, False, f"cgroup {where['memory']} memory.max"))
+    if host_ram is None:
+        host_ram = host_memory()
+    candidates.append((host_ram, False, "host RAM"))
+    limit, dedicated, source = min(candidates, key=lambda c: c[0])
+    steps.append(Derivation('memory', _mib(limit), source))
+
+    # Heap
+    if 'heap' in jvm:
+        heap = parse_size(jvm['heap'])
+        steps.append(Derivation('heap', _mib(heap), "[jvm] heap"))
+    else:
+        if dedicated:
+            headroom = max(MIN_HEADROOM, limit * 0.15)
+            why = "the rest of the JVM"
+        else:
+            headroom = max(GiB, limit * 0.25)
+            why = "the rest of the JVM, and everything else sharing it"
+        heap = max(int(limit - headroom) // HEAP_STEP * HEAP_STEP, MIN_HEAP)
+        steps.append(Derivation(
+            'heap', _mib(heap),
+            f"{_mib(limit)} less {_mib(headroom)} for {why}, rounded down to {_mib(HEAP_STEP)}",
+        ))
+    if heap + MIN_HEADROOM > limit:
+        raise ConfigError(
+            f"A {_mib(heap)} heap doesn't leave the JVM {_mib(MIN_HEADROOM)} of the "
+            f"{_mib(limit)} from {source}; give it more memory, or set a smaller [jvm] heap"
+        )
+    options = [f'-Xms{heap // MiB}m', f'-Xmx{heap // MiB}m']
+    steps.append(Derivation('-Xms/-Xmx', f'{heap // MiB}m', "the same, so the heap is never resized"))
+
+    # CPUs
+    cpu_limits = []
+    if 'cpus' in resources:
+        cpu_limits.append((float(resources['cpus']), "[resources.server] cpus"))
+    if 'cpuset' in resources:
+        cpu_limits.append((count_cpuset(resources['cpuset']), "[resources.server] cpuset"))
+    for _, cpus, where in cgroups:
+        if cpus is not None:
+            cpu_limits.append((cpus, f"cgroup {where['cpus']} cpu.max"))
+    if cpu_limits:
+        cpus, source = min(cpu_limits, key=lambda c: c[0])
+        count = max(1, round(cpus))
+        options.append(f'-XX:ActiveProcessorCount={count}')
+        steps.append(Derivation('processors', count, f"{cpus:g} from {source}"))
+    else:
+        count = host_cpus or os.cpu_count()
+        steps.append(Derivation('processors', count, "all of the host's, left to the JVM"))
+
+    # GC
+    large = heap > LARGE_HEAP
+    options += G1_FLAGS
+    options += [large_flag if large else small_flag for small_flag, large_flag in G1_SIZED_FLAGS]
+    steps.append(Derivation(
+        'gc', 'G1',
+        f"Aikar's flags for heaps {'over' if large else 'up to'} {LARGE_HEAP // GiB} GiB",
+    ))
+
+    extra = jvm.get('extra', [])
+    if not isinstance(extra, list) or not all(isinstance(o, str) for o in extra):
+        raise ConfigError("[jvm] extra should be a list of options, like [\"-Dfoo=bar\"]")
+    if extra:
+        options += extra
+        steps.append(Derivation('extra', ' '.join(extra), "[jvm] extra"))
+    return options, steps
+
+
+def enabled(config):
+    return config.get('jvm', {}).get('auto', False)
@@ -0,0 +1,226 @@
+"""
+Synthetic load for a server, to measure the effect of settings changes.
+
+Each connection does one of:
+
+* status: the handshake, a status request, and a ping (what the multiplayer
+  menu does)
+* login: the handshake, and Login Start, up to the server's first reply
+  (encryption request, compression, success, or a disconnect)
+
+Connections run on asyncio, optionally spread over several processes when
+one core can't keep up.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import json
+import resource
+import struct
+import time
+
+from . import slp
+
+LOGIN_STATE = 2
+
+#: The most file descriptors to ask for
+MAX_FDS = 1 << 20
+
+LOGIN_REPLIES = {
+    0x00: 'disconnect',
+    0x01: 'encryption',
+    0x02: 'success',
+    0x03: 'compression',
+}
+
+
+async def _read_packet(reader):
+    length = 0
+    for i in range(5):
+        byte, = await reader.readexactly(1)
+        length |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            break
+    return slp.parse_packet(await reader.readexactly(length))
+
+
+def _handshake(host, port, protocol, state):
+    return slp.encode_packet(
+        0x00,
+        slp.encode_varint(protocol) + slp.encode_string(host)
+        + struct.pack('>H', port) + slp.encode_varint(state),
+    )
+
+
+def _login_start(name, protocol):
+    payload = slp.encode_string(name)
+    # Later versions added fields after the name
+    if protocol >= 764:
+        payload += bytes(16)  # UUID
+    elif protocol == 760:
+        payload += b'\0\0'  # No signature, no UUID
+    elif protocol >= 759:
+        payload += b'\0'  # No signature (759), or no UUID (761-763)
+    return slp.encode_packet(0x00, payload)
+
+
+async def _status(reader, writer, host, port, protocol, n):
+    writer.write(_handshake(host, port, protocol, slp.STATUS_STATE) + slp.encode_packet(0x00))
+    await writer.drain()
+    packet_id, read = await _read_packet(reader)
+    if packet_id != 0x00:
+        raise slp.SlpError(f"Expected a status response, got packet {packet_id:#x}")
+    json.loads(read(slp.decode_varint(read)).decode('utf-8'))
+    writer.write(slp.encode_packet(0x01, struct.pack('>q', n)))
+    await writer.drain()
+    packet_id, read = await _read_packet(reader)
+    if packet_id != 0x01 or struct.unpack('>q', read(8))[0] != n:
+        raise slp.SlpError("Bad pong")
+    return 'pong'
+
+
+async def _login(reader, writer, host, port, protocol, n):
+    writer.write(
+        _handshake(host, port, protocol, LOGIN_STATE)
+        + _login_start(f'load{n % 1000000:06d}', protocol)
+    )
+    await writer.drain()
+    packet_id, _ = await _read_packet(reader)
+    return LOGIN_REPLIES.get(packet_id, f'packet {packet_id:#x}')
+
+
+SCENARIOS = {
+    'status': _status,
+    'login': _login,
+}
+
+
+async def _one(host, port, scenario, protocol, n, timeout, samples):
+    start = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        connected = time.perf_counter()
+        outcome = await asyncio.wait_for(
+            SCENARIOS[scenario](reader, writer, host, port, protocol, n), timeout,
+        )
+    except asyncio.TimeoutError:
+        samples['errors']['timeout'] += 1
+    except Exception as exc:
+        samples['errors'][type(exc).__name__] += 1
+    else:
+        samples['connect'].append(connected - start)
+        samples['total'].append(time.perf_counter() - start)
+        samples['outcomes'][outcome] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def _engine(host, port, *, scenario, protocol, connections, concurrency, timeout, offset=0):
+    samples = {
+        'connect': [],
+        'total': [],
+        'outcomes': collections.Counter(),
+        'errors': collections.Counter(),
+    }
+    ids = iter(range(offset, offset + connections))
+
+    async def worker():
+        for n in ids:
+            await _one(host, port, scenario, protocol, n, timeout, samples)
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, connections))))
+    return samples
+
+
+def _run_process(kwargs):
+    _raise_fd_limit()
+    return asyncio.run(_engine(**kwargs))
+
+
+def _raise_fd_limit():
+    """
+    Thousands of connections need more than the usual 1024 file descriptors.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # Linux won't take an infinite soft limit
+    want = MAX_FDS if hard == resource.RLIM_INFINITY else min(hard, MAX_FDS)
+    if soft != resource.RLIM_INFINITY and soft < want:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+
+
+def _split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def _summarize(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    return {
+        'min': ordered[0] * 1000,
+        'avg': sum(ordered) / len(ordered) * 1000,
+        'p50': slp.percentile(ordered, 50) * 1000,
+        'p90': slp.percentile(ordered, 90) * 1000,
+        'p99': slp.percentile(ordered, 99) * 1000,
+        'max': ordered[-1] * 1000,
+    }
+
+
+def run(host, port, *, scenario='status', connections=1000, concurrency=100,
+        processes=1, timeout=10, protocol=None):
+    """
+    Put load on a server, returning a JSON-able report.
+
+    The protocol version is found with a status ping if not given, since the
+    server will refuse to log in with the wrong one.
+    """
+    if protocol is None:
+        status, _ = slp.query(host, port, timeout=timeout)
+        protocol = status['version']['protocol']
+
+    processes = max(1, min(processes, connections))
+    jobs = []
+    offset = 0
+    for conns, conc in zip(_split(connections, processes), _split(concurrency, processes)):
+        jobs.append({
+            'host': host, 'port': port, 'scenario': scenario, 'protocol': protocol,
+            'connections': conns, 'concurrency': max(conc, 1), 'timeout': timeout,
+            'offset': offset,
+        })
+        offset += conns
+
+    start = time.perf_counter()
+    if processes == 1:
+        results = [_run_process(jobs[0])]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_run_process, jobs))
+    elapsed = time.perf_counter() - start
+
+    connect, total = [], []
+    outcomes, errors = collections.Counter(), collections.Counter()
+    for r in results:
+        connect += r['connect']
+        total += r['total']
+        outcomes.update(r['outcomes'])
+        errors.update(r['errors'])
+    failed = sum(errors.values())
+    return {
+        'target': f'{host}:{port}',
+        'scenario': scenario,
+        'protocol': protocol,
+        'connections': connections,
+        'concurrency': concurrency,
+        'processes': processes,
+        'elapsed': elapsed,
+        'throughput': len(total) / elapsed if elapsed else 0,
+        'completed': len(total),
+        'failed': failed,
+        'error_rate': failed / connections if connections else 0,
+        'errors': dict(errors),
+        'outcomes': dict(outcomes),
+        'connect_ms': _summarize(connect),
+        'latency_ms': _summarize(total),
+    }
@@ -0,0 +1,331 @@
+"""
+Reading the server logs, and an index of the interesting things in them.
+
+The logs volume has latest.log, and older logs rotated into
+YYYY-MM-DD-N.log.gz. Lines look like:
+
+    [12:34:56] [Server thread/INFO]: alice joined the game
+
+Lines only have the time, so the date comes from the file name, or for
+latest.log, from when it was first indexed, counting midnights along the way.
+
+The index is a SQLite database of events (joins, leaves, lag warnings,
+errors, crash reports). It's brought up to date incrementally: rotated logs
+never change, so they're only read once, and latest.log is read from where
+the last update stopped.
+"""
+import ctypes
+import ctypes.util
+import datetime
+import gzip
+import os
+import re
+import select
+import sqlite3
+import struct
+import time
+
+LINE = re.compile(r'^\[(\d\d):(\d\d):(\d\d)\] \[([^/\]]+)/(\w+)\]: (.*)$')
+ROTATED = re.compile(r'^(\d{4}-\d\d-\d\d)-\d+\.log\.gz$')
+
+EVENTS = [
+    ('join', re.compile(r'^(\w+) joined the game')),
+    ('leave', re.compile(r'^(\w+) left the game')),
+    ('lag', re.compile(r"^Can't keep up! .*Running (\d+)ms or (\d+) ticks behind")),
+    ('crash', re.compile(r'crash report has been saved to: (.+)$|^Crash report saved to:? (.+)$')),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    inode INTEGER,
+    offset INTEGER,
+    day TEXT,
+    last TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    ts REAL,
+    kind TEXT,
+    player TEXT,
+    detail TEXT,
+    file TEXT
+);
+CREATE INDEX IF NOT EXISTS events_kind ON events (kind, ts);
+CREATE INDEX IF NOT EXISTS events_player ON events (player, ts);
+"""
+
+
+def parse_event(line):
+    """
+    Get (kind, player, detail) for an interesting log line, or None.
+    """
+    m = LINE.match(line)
+    if m is None:
+        return None
+    level, message = m.group(5), m.group(6)
+    for kind, pattern in EVENTS:
+        em = pattern.search(message)
+        if em is not None:
+            player = em.group(1) if kind in ('join', 'leave') else None
+            return kind, player, message
+    if level in ('ERROR', 'FATAL'):
+        return 'error', None, message
+    return None
+
+
+def count_midnights(lines):
+    """
+    How many times the clock goes past midnight in some log lines.
+    """
+    count = 0
+    last = None
+    for line in lines:
+        m = LINE.match(line)
+        if m is not None:
+            stamp = ':'.join(m.group(1, 2, 3))
+            if last is not None and stamp < last:
+                count += 1
+            last = stamp
+    return count
+
+
+def rotated_logs(logdir):
+    """
+    The rotated logs, oldest first. There are none if the server has never
+    been started, and so the directory doesn't exist yet.
+    """
+    try:
+        names = [n for n in os.listdir(logdir) if ROTATED.match(n)]
+    except FileNotFoundError:
+        return []
+
+    def key(name):
+        date, _, rest = name[:-len('.log.gz')].rpartition('-')
+        return date, int(rest)
+    return sorted(names, key=key)
+
+
+def open_log(path):
+    """
+    Open a log for reading text, decompressing as it goes if it's gzipped.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'rt', encoding='utf-8', errors='replace')
+
+
+class LogIndex:
+    """
+    The event index for a logs directory.
+    """
+    def __init__(self, logdir, dbfile):
+        self.logdir = logdir
+        self.db = sqlite3.connect(dbfile)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def _index_lines(self, name, lines, day, last):
+        """
+        Index lines from a log, returning the (day, time) of the last one.
+        """
+        rows = []
+        for line in lines:
+            m = LINE.match(line)
+            if m is None:
+                continue
+            stamp = ':'.join(m.group(1, 2, 3))
+            if last is not None and stamp < last:
+                # Went past midnight
+                day += datetime.timedelta(days=1)
+            last = stamp
+            event = parse_event(line.rstrip('\n'))
+            if event is not None:
+                when = datetime.datetime.combine(day, datetime.time(*map(int, m.group(1, 2, 3))))
+                rows.append((time.mktime(when.timetuple()), *event, name))
+        self.db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?)", rows)
+        return day, last
+
+    def _forget(self, name):
+        self.db.execute("DELETE FROM events WHERE file = ?", (name,))
+        self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def update(self):
+        """
+        Index whatever's new. Returns how many files were read.
+        """
+        read = 0
+        with self.db:
+            known = {
+                row[0]: row[1:]
+                for row in self.db.execute("SELECT name, inode, offset, day, last FROM files")
+            }
+            for name in rotated_logs(self.logdir):
+                if name in known:
+                    continue
+                day = datetime.date.fromisoformat(ROTATED.match(name).group(1))
+                with open_log(os.path.join(self.logdir, name)) as f:
+                    day, last = self._index_lines(name, f, day, None)
+                self.db.execute(
+                    "INSERT INTO files VALUES (?, NULL, NULL, ?, ?)",
+                    (name, day.isoformat(), last),
+                )
+                read += 1
+
+            path = os.path.join(self.logdir, 'latest.log')
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return read
+            inode, offset, day, last = known.get('latest.log', (None, 0, None, None))
+            if inode != st.st_ino or st.st_size < offset:
+                # Rotated, and the old one will be (or was) indexed as a .gz
+                self._forget('latest.log')
+                offset, last, day = 0, None, None
+            if st.st_size > offset:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(st.st_size - offset)
+                # Leave any partial last line for next time
+                data = data[:data.rfind(b'\n') + 1]
+                lines = data.decode('utf-8', errors='replace').splitlines()
+                if day is None:
+                    # The file ends on the day it was last written
+                    end = datetime.date.fromtimestamp(st.st_mtime)
+                    day = (end - datetime.timedelta(days=count_midnights(lines))).isoformat()
+                newday, last = self._index_lines(
+                    'latest.log', lines, datetime.date.fromisoformat(day), last,
+                )
+                offset += len(data)
+                day = newday.isoformat()
+                read += 1
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES ('latest.log', ?, ?, ?, ?)",
+                (st.st_ino, offset, day, last),
+            )
+        return read
+
+    def search(self, *, kinds=None, player=None, since=None):
+        """
+        Generates (timestamp, kind, player, detail) for matching events, oldest
+        first.
+        """
+        query = "SELECT ts, kind, player, detail FROM events WHERE 1"
+        params = []
+        if kinds:
+            query += f" AND kind IN ({', '.join('?' for _ in kinds)})"
+            params += kinds
+        if player is not None:
+            query += " AND player = ? COLLATE NOCASE"
+            params.append(player)
+        if since is not None:
+            query += " AND ts >= ?"
+            params.append(since)
+        yield from self.db.execute(query + " ORDER BY ts", params)
+
+
+# inotify, from sys/inotify.h
+IN_MODIFY = 0x002
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    Just enough inotify to watch a directory, through ctypes.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def watch(self, path, mask):
+        if self._add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise OSError(ctypes.get_errno(), f"Can't watch {path}")
+
+    def read(self, timeout=None):
+        """
+        Wait for events, returning the names they're about.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        pos = 0
+        while pos < len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            names.append(os.fsdecode(data[pos:pos + length].rstrip(b'\0')))
+            pos += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def follow(logdir, *, from_start=False, poll=1.0):
+    """
+    Generates lines as they're added to latest.log, following it across
+    rotations. Falls back to polling every poll seconds without inotify.
+    """
+    path = os.path.join(logdir, 'latest.log')
+    try:
+        notify = Inotify()
+        notify.watch(logdir, IN_MODIFY | IN_CREATE | IN_MOVED_TO)
+    except (OSError, AttributeError):
+        notify = None
+
+    f = None
+    partial = ''
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, 'rt', encoding='utf-8', errors='replace')
+                except FileNotFoundError:
+                    pass
+                else:
+                    inode = os.fstat(f.fileno()).st_ino
+                    if not from_start:
+                        f.seek(0, os.SEEK_END)
+                    from_start = True  # Read new files from the start
+            if f is not None:
+                chunk = f.read()
+                if chunk:
+                    lines = (partial + chunk).split('\n')
+                    partial = lines.pop()
+                    yield from lines
+                try:
+                    rotated = os.stat(path).st_ino != inode
+                except FileNotFoundError:
+                    rotated = True
+                if rotated:
+                    # Whatever's left in the old file was read above
+                    f.close()
+                    f, partial = None, ''
+                    continue
+            if notify is not None:
+                notify.read()
+            else:
+                time.sleep(poll)
+    finally:
+        if f is not None:
+            f.close()
+        if notify is not None:
+            notify.close()
@@ -1,20 +1,27 @@
+import collections
+import contextlib
+import fcntl
+import functools
 import logging
+import os
 import pathlib
-import subprocess
+import time
 
-import toml
-from cached_property import cached_property
-import podman.libs.errors
-
-from .config import Config
+# Most of what Podcraft uses is imported where it's used, so that quick
+# commands like status don't pay for loading the build machinery.
+from . import jvm
+from .config import Config, ConfigError, MINECRAFT_PORT, RCON_PORT, read_properties
 from .state import State
-from .images import build_server, build_manager,  get_volumes
-from .podman import client
-from .pods import create_pod
-from .containers import create_container
+from .tracing import span
+from .podman import client, server
+from .varlink import NotFound, call, exec_container, exec_opts
 
 CONFIG_FILE_NAME = "podcraft.toml"
 STATE_FILE_NAME = ".tmp/state"
+LOCK_FILE_NAME = ".tmp/lock"
+SNAPSHOT_INDEX_NAME = ".tmp/snapshot.index"
+LOG_INDEX_NAME = ".tmp/logs.db"
+BUILD_LOG_DIR = ".tmp/build-logs"
 
 log = logging.getLogger(__name__)
 
@@ -25,30 +32,66 @@ class NoProjectError(Exception):
     """
 
 
+class CommandFailed(Exception):
+    """
+    A server console command didn't work.
+    """
+
+
+class Removal(collections.namedtuple('Removal', ['kind', 'name', 'id', 'outcome', 'error'])):
+    """
+    The result of removing one podman resource.
+    """
+    REMOVED = 'removed'
+    GONE = 'already gone'
+    FAILED = 'failed'
+
+
+class cached_property:
+    """
+    Like functools.cached_property, which needs Python 3.8
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.func.__name__] = self.func(obj)
+        return value
+
+
 class Podcraft:
     """
     Main access object
     """
 
-    def __init__(self, root):
+    def __init__(self, root, *, podman_address=None):
         self.root = pathlib.Path(root).absolute()
+        #: Use this varlink server instead of the project's own
+        self.podman_address = podman_address
 
     @classmethod
     def find_project(cls, start):
-        start = pathlib.Path(start).absolute()
-        for p in [start] + list(start.parents):
-            if (p / CONFIG_FILE_NAME).exists():
-                return cls(p)
-        else:
-            raise NoProjectError
+        with span('find project'):
+            start = pathlib.Path(start).absolute()
+            for p in [start] + list(start.parents):
+                if (p / CONFIG_FILE_NAME).exists():
+                    return cls(p)
+            else:
+                raise NoProjectError
 
     @cached_property
     def config(self):
         """
         Config data from the TOML file
         """
-        with (self.root / CONFIG_FILE_NAME).open('rt') as cf:
-            return Config(toml.load(cf))
+        with span('load config'):
+            import toml
+
+            with (self.root / CONFIG_FILE_NAME).open('rt') as cf:
+                return Config(toml.load(cf))
         # TODO: Apply schema/defaults
 
     def __enter__(self):
@@ -56,12 +99,65 @@ class Podcraft:
         return self
 
     def __exit__(self, type, value, tb):
+        self.wait_for_cleanup()
         self.state.__exit__(type, value, tb)
 
+    @contextlib.contextmanager
+    def exclusive(self):
+        """
+        Use the project (like with pc:), keeping out any other podcraft run
+        that changes it until done.
+
+        Commands that only look don't need this, and aren't kept out.
+        """
+        self._ensure_tmp()
+        fd = os.open(self.root / LOCK_FILE_NAME, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log.info("Waiting for another podcraft to finish with this project")
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            with self:
+                yield self
+        finally:
+            os.close(fd)
+
     def _ensure_tmp(self):
         if not (self.root / ".tmp").exists():
             (self.root / ".tmp").mkdir(parents=True)
 
+    def connect(self):
+        """
+        Get a podman client, preferring the project's persistent server
+        """
+        return client(
+            self.root / self.config.podman_socket,
+            self.root / self.config.podman_pidfile,
+            address=self.podman_address,
+        )
+
+    def podman_server(self):
+        """
+        Get the address of a podman server, preferring the project's persistent one
+        """
+        return server(
+            self.root / self.config.podman_socket,
+            self.root / self.config.podman_pidfile,
+            address=self.podman_address,
+        )
+
+    @contextlib.asynccontextmanager
+    async def aconnect(self):
+        """
+        Get an asyncio podman client, preferring the project's persistent server
+        """
+        from .aiopodman import AsyncClient
+
+        with self.podman_server() as address:
+            async with AsyncClient(address) as pm:
+                yield pm
+
     @cached_property
     def state(self):
         """
@@ -70,156 +166,918 @@ class Podcraft:
         self._ensure_tmp()
         return State(self.root / STATE_FILE_NAME)
 
-    def cleanup(self):
+    def cleanup(self, *, keep_images=False, wait=True):
         """
         Deletes all the podman resources.
 
-        Does not delete volume data
+        All the containers are removed at once, then the pod, then the images.
+        If keep_images, images are left (and still tracked) so they can be
+        reused. If not wait, the images are removed in the background, so that
+        a build can start straight away; see wait_for_cleanup().
+
+        Returns a Removal for each resource. Does not delete volume data
         """
-        log.info("Cleaning up")
-        with client() as pm:
-            for name in ('server', 'manager'):
-                try:
-                    log.debug(f"Getting {name} container")
-                    c = self.state.get_container_object(name, client=pm)
-                except KeyError:
-                    pass
-                except podman.libs.errors.ContainerNotFound:
-                    log.debug("Stale state")
-                    self.state.save_container(name, None)
+        import asyncio
+        import concurrent.futures
+
+        results = asyncio.run(self.acleanup(keep_images=True))
+        if not keep_images:
+            images = self._detach_images()
+            if wait:
+                results += asyncio.run(self._aremove_images(images))
+            else:
+                log.debug("Removing images in the background")
+                pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                self._image_cleanup = pool.submit(asyncio.run, self._aremove_images(images))
+                pool.shutdown(wait=False)
+        self._record_teardown(results)
+        return results
+
+    def wait_for_cleanup(self):
+        """
+        Wait for a background image cleanup to finish, returning its results.
+        """
+        fut = getattr(self, '_image_cleanup', None)
+        if fut is None:
+            return []
+        del self._image_cleanup
+        results = fut.result()
+        self._record_teardown(results, append=True)
+        return results
+
+    def _record_teardown(self, results, *, append=False):
+        """
+        Keep the results in the state, and remember images we couldn't remove
+        so the next cleanup can retry them.
+        """
+        if not append:
+            self.state.data['teardown'] = []
+        self.state.data.setdefault('teardown', []).extend(r._asdict() for r in results)
+        for r in results:
+            if r.kind == 'image' and r.outcome == Removal.FAILED:
+                self.state.data.setdefault('orphans', {})[r.id] = r.name
+            if r.outcome != Removal.FAILED:
+                log.debug(f"{r.name} {r.kind}: {r.outcome}")
+            else:
+                log.warning(f"Could not remove {r.name} {r.kind} ({r.id}): {r.error}")
+
+    def image_jobs(self, names=None, *, cache=None, context='extract'):
+        """
+        The builds needed for the images, as taken by build_images()
+
+        names limits which images to build.
+        """
+        from .images import CONTAINER_REPOS, build_id_from_url, pull_image
+
+        jobs = {
+            'server': functools.partial(
+                build_id_from_url, CONTAINER_REPOS['server'], self.config.server_buildargs(),
+                cache=cache, context=context,
+            ),
+            'manager': functools.partial(
+                build_id_from_url, CONTAINER_REPOS['manage'], self.config.manage_buildargs(),
+                cache=cache, context=context,
+            ),
+        }
+        for name, image in self.config.addons():
+            jobs[name] = functools.partial(
+                pull_image, image, offline=cache is not None and cache.offline,
+            )
+        if names is not None:
+            jobs = {n: j for n, j in jobs.items() if n in names}
+        return jobs
+
+    def build_logs(self, names):
+        """
+        Make a BuildLog for each of the images to be built, for build_images().
+        """
+        from .buildlog import BuildLog
+
+        return {
+            name: BuildLog(str(self.root / BUILD_LOG_DIR / f'{name}.log'))
+            for name in names
+        }
+
+    def _save_builds(self, logs, images):
+        """
+        Keep the records of the finished builds (images is {name: image ID})
+        in the state.
+        """
+        for name, buildlog in logs.items():
+            if buildlog.outcome not in ('built', 'failed'):
+                continue
+            record = dict(buildlog.record(), finished=time.time())
+            if buildlog.outcome == 'built':
+                record['image'] = images.get(name)
+            else:
+                record['log'] = buildlog.path
+                log.error(f"Building {name} failed, the full output is in {buildlog.path}")
+            self.state.save_build(name, record)
+
+    def build_inputs(self, cache, *, check_upstream=True):
+        """
+        Everything that goes into making each of the resources, for planning
+
+        If not check_upstream, build contexts aren't downloaded, and only what
+        was cached last time is used. Either way, a context that isn't
+        available has a digest of None.
+        """
+        from .cache import NotCached
+        from .images import CONTAINER_REPOS
+
+        def digest(url):
+            if not check_upstream:
+                return cache.cached_digest(url)
+            try:
+                return cache.digest(url)
+            except NotCached:
+                return None
+
+        images = {
+            'server': {
+                'url': CONTAINER_REPOS['server'],
+                'digest': digest(CONTAINER_REPOS['server']),
+                'buildargs': self.config.server_buildargs(),
+            },
+            'manager': {
+                'url': CONTAINER_REPOS['manage'],
+                'digest': digest(CONTAINER_REPOS['manage']),
+                'buildargs': self.config.manage_buildargs(),
+            },
+        }
+        for name, image in self.config.addons():
+            images[name] = {'image': image}
+
+        return {
+            'images': images,
+            'containers': {name: self.container_inputs(name) for name in images},
+            'pod': dict(
+                {
+                    'ports': self.config.exposed_ports(),
+                    'addons': dict(self.config.addons()),
+                },
+                **self.config.pod_options()
+            ),
+            'properties': self.config['properties'],
+        }
+
+    def container_inputs(self, name):
+        """
+        The config that goes into a container, other than its image and pod
+        """
+        inputs = {
+            'volumes': sorted(self.config.volumes()),
+        }
+        # Only when set, so existing containers aren't remade for nothing
+        resources = self.container_options(name)
+        if resources:
+            inputs['resources'] = resources
+        return inputs
+
+    def container_options(self, name):
+        """
+        The extra options for creating a container: its resource limits, and
+        the JVM options for the server.
+        """
+        opts = self.config.container_options(name)
+        if name == 'server' and jvm.enabled(self.config):
+            options, _ = jvm.derive(self.config)
+            opts['env'] = {'JAVA_TOOL_OPTIONS': ' '.join(options)}
+        return opts
+
+    def _forget_missing(self, pm):
+        """
+        Drop anything from the state that podman no longer has.
+        """
+        import podman.libs.errors
+
+        for name in self.state.names():
+            try:
+                self.state.get_container_object(name, client=pm)
+            except KeyError:
+                pass
+            except podman.libs.errors.ContainerNotFound:
+                log.debug(f"Stale state for {name} container")
+                self.state.save_container(name, None)
+            try:
+                self.state.get_image_object(name, client=pm)
+            except KeyError:
+                pass
+            except podman.libs.errors.ImageNotFound:
+                log.debug(f"Stale state for {name} image")
+                self.state.save_image(name, None)
+        try:
+            self.state.get_pod_object(client=pm)
+        except podman.libs.errors.PodNotFound:
+            log.debug("Stale state for pod")
+            self.state.save_pod(None)
+        self.state.prune_inspects()
+
+    def plan(self, *, offline=False, force=False, check_upstream=True):
+        """
+        Work out what needs to be done to bring everything up to date.
+
+        If force, everything is rebuilt. If not check_upstream, nothing is
+        downloaded, so changes to the build contexts since they were last
+        downloaded aren't seen.
+        """
+        from .cache import ContextCache
+        from .planner import make_plan
+
+        cache = ContextCache(offline=offline)
+        with span('plan'), self.connect() as pm:
+            self._forget_missing(pm)
+            return make_plan(
+                self.state, self.build_inputs(cache, check_upstream=check_upstream),
+                client=pm, force=force,
+                properties_exist=(self.root / self.config.properties_file).exists(),
+            )
+
+    def _ports(self, images):
+        """
+        Assemble complete list of port forwards
+        """
+        from .images import get_ports
+
+        strip_proto = lambda p: str(p).split('/', 1)[0]
+        ports = [
+            f'{strip_proto(outter)}:{inner}'
+            for outter, (_, inner) in self.config.exposed_ports().items()
+        ]
+        for name, _ in self.config.addons():
+            for p in get_ports(images[name], state=self.state):
+                port = strip_proto(p)
+                ports.append(f'{port}:{port}')
+        return ports
+
+    def _config_volumes(self):
+        """
+        The volumes from the config, as {mount point: host path}
+        """
+        return {
+            c: self.root / (h if h else f".tmp/{c.replace('/', '_')}")
+            for h, c in self.config.volumes()
+        }
+
+    def _volumes(self, images):
+        """
+        Assemble complete list of volumes, and create their storage
+        """
+        from .images import get_volumes
+
+        volumes = self._config_volumes()
+        for img in images.values():
+            ivols = get_volumes(img, state=self.state)
+            for v in ivols:
+                if v not in volumes:
+                    volumes[v] = f".tmp/{v.replace('/', '_')}"
+
+        log.info("Checking volumes")
+        self._ensure_tmp()
+        for hostpath in volumes.values():
+            hostpath = self.root / hostpath
+            if not hostpath.exists():
+                # FIXME: Better heuristic for what's files and directories
+                if '.' in hostpath.name:
+                    if not hostpath.exists():
+                        if hostpath.suffix == '.json':
+                            hostpath.write_text('[]')
+                        else:
+                            hostpath.touch()
                 else:
-                    try:
-                        log.debug(f"Removing {name} container")
-                        c.remove(force=True)
-                    except Exception:
-                        pass
+                    hostpath.mkdir(parents=True)
+        return volumes
+
+    def apply_plan(self, plan, *, jobs=None, offline=False, context='extract', keep_images=False):
+        """
+        Carry out a plan from plan().
+
+        jobs limits how many images are built at once. If offline, images are
+        built from previously downloaded sources only. context is how build
+        contexts are given to podman, see build_id_from_url(). If
+        keep_images, images that were replaced are left for the next cleanup
+        to remove, instead of being removed now.
+        """
+        import podman.libs.errors
+        from .cache import ContextCache
+        from .containers import create_container
+        from .images import build_images
+        from .pods import create_pod
+
+        # FIXME: Don't allow this to run when the pod is started
+        fingerprints = plan.fingerprints()
+        start = time.monotonic()
+        with self.connect() as pm:
+            # 1. Build the images
+            to_build = plan.names('build')
+            old_images = set()
+
+            def replaced(name):
+                image_id = self.state.get_image(name)
+                old_images.add(image_id)
+                # Tracked from now, so it isn't lost if a later step fails;
+                # the previous generation might still be using it, though
+                if image_id not in self.state.generation_images():
+                    self.state.data.setdefault('orphans', {})[image_id] = name
+
+            if to_build:
+                log.info("Building images")
+                cache = ContextCache(offline=offline)
+                job_list = self.image_jobs(to_build, cache=cache, context=context)
+                logs = self.build_logs(to_build)
+                built = {}
+                try:
+                    with span('build images', names=to_build):
+                        for name, img in build_images(pm, job_list, max_workers=jobs, logs=logs):
+                            log.info(f"Built {name}")
+                            if name in self.state.data['images']:
+                                replaced(name)
+                            self.state.save_image(name, img)
+                            self.state.save_fingerprint(f'image:{name}', fingerprints[f'image:{name}'])
+                            built[name] = img.id
+                finally:
+                    self._save_builds(logs, built)
+            images = {
+                name: self.state.get_image_object(name, client=pm)
+                for name in plan.inputs['images']
+            }
+
+            # 2. Remove what's being replaced
+            replaced = plan.names('create-container') + plan.names('remove')
+            for name in replaced:
+                if name in self.state.data['containers']:
+                    log.info(f"Removing {name} container")
+                    self.state.get_container_object(name, client=pm).remove(force=True)
                     self.state.save_container(name, None)
+            for name in plan.names('remove'):
+                if name in self.state.data['images']:
+                    replaced(name)
+                    self.state.save_image(name, None)
+            if ('create-pod', None) in plan and self.state.get_pod() is not None:
+                log.info("Removing pod")
+                self.state.get_pod_object(client=pm).remove(force=True)
+                self.state.save_pod(None)
+
+            # 3. Create volumes (storage directories)
+            volumes = self._volumes(images)
+
+            # 4. Create pod
+            if ('create-pod', None) in plan:
+                log.info("Creating pod")
+                pod = create_pod(pm, publish=self._ports(images), **self.config.pod_options())
+                self.state.save_pod(pod)
+                self.state.save_fingerprint('pod', fingerprints['pod'])
+            else:
+                pod = self.state.get_pod_object(client=pm)
+
+            # 5. Write out server.properties
+            if ('write-properties', None) in plan:
+                (self.root / self.config.properties_file).write_text(
+                    '\n'.join(produce_properties(self.config.server_properties()))
+                )
+                self.state.save_fingerprint('properties', fingerprints['properties'])
 
+            # 6. Create containers
+            for name in plan.names('create-container'):
+                log.info(f"Creating {name} container")
+                con = create_container(
+                    images[name], pod, volumes, state=self.state,
+                    **self.container_options(name)
+                )
+                self.state.save_container(name, con)
+                self.state.save_fingerprint(f'container:{name}', fingerprints[f'container:{name}'])
+
+            # 7. Clean up images that have been replaced, except ones the
+            # previous generation still uses (which weren't made orphans)
+            orphans = self.state.data.get('orphans', {})
+            for image_id in old_images:
+                if keep_images or image_id not in orphans:
+                    continue
                 try:
-                    log.debug(f"Getting {name} image")
-                    i = self.state.get_image_object(name, client=pm)
-                except KeyError:
+                    pm.images.get(image_id).remove(force=True)
+                except podman.libs.errors.ImageNotFound:
                     pass
-                else:
+                del orphans[image_id]
+                self.state.forget_inspect(image_id)
+
+        self.state.data['build'] = {
+            'finished': time.time(),
+            'seconds': time.monotonic() - start,
+            'steps': len(plan.steps),
+        }
+
+    def build_generation(self, plan, *, jobs=None, offline=False, context='extract'):
+        """
+        Build a whole new generation of resources from a plan from plan(),
+        alongside the current one, which carries on running. Images that
+        haven't changed are shared with the current generation.
+
+        Returns the generation, for switch_generation(). See apply_plan() for
+        the arguments. If it fails, the pod and containers made so far are
+        removed, and the new images are left for the next cleanup.
+        """
+        from .cache import ContextCache
+        from .containers import create_container
+        from .images import build_images
+        from .pods import create_pod
+
+        current = self.state.generation()
+        gen = {
+            'images': {
+                name: img for name, img in current.get('images', {}).items()
+                if name in plan.inputs['images']
+            },
+            'containers': {},
+            'fingerprints': plan.fingerprints(),
+            'generation': {'number': self.state.generation_number() + 1},
+        }
+        number = gen['generation']['number']
+        start = time.monotonic()
+        try:
+            with self.connect() as pm:
+                to_build = plan.names('build')
+                if to_build:
+                    log.info(f"Building images for generation {number}")
+                    cache = ContextCache(offline=offline)
+                    job_list = self.image_jobs(to_build, cache=cache, context=context)
+                    logs = self.build_logs(to_build)
                     try:
-                        log.debug(f"Removing {name} image")
-                        i.remove(force=True)
-                    except Exception:
-                        pass
-                    self.state.save_image(name, None)
+                        with span('build images', names=to_build):
+                            for name, img in build_images(pm, job_list, max_workers=jobs, logs=logs):
+                                log.info(f"Built {name}")
+                                gen['images'][name] = dict(img.items())
+                    finally:
+                        self._save_builds(logs, {n: i['id'] for n, i in gen['images'].items()})
+                images = {name: pm.images.get(img['id']) for name, img in gen['images'].items()}
+
+                volumes = self._volumes(images)
+
+                log.info(f"Creating pod for generation {number}")
+                pod = create_pod(pm, publish=self._ports(images), **self.config.pod_options())
+                gen['pod'] = dict(pod.items())
+
+                # Written when it's switched to, the current server might need
+                # restarting before then
+                if ('write-properties', None) in plan:
+                    gen['properties'] = '\n'.join(produce_properties(self.config.server_properties()))
+
+                for name, img in images.items():
+                    log.info(f"Creating {name} container")
+                    con = create_container(
+                        img, pod, volumes, state=self.state,
+                        **self.container_options(name)
+                    )
+                    gen['containers'][name] = dict(con.items())
+        except BaseException:
+            log.error(f"Generation {number} failed, removing what was made of it")
+            try:
+                self._discard_generation(gen)
+            except Exception:
+                log.exception(f"Could not remove generation {number}")
+            raise
+
+        self.state.data['build'] = {
+            'finished': time.time(),
+            'seconds': time.monotonic() - start,
+            'steps': len(plan.steps),
+        }
+        return gen
+
+    def _discard_generation(self, gen):
+        """
+        Remove the pod and containers of a generation that was never switched
+        to, and leave its new images for the next cleanup.
+        """
+        import asyncio
+
+        keep = self.state.generation_images()
+        for name, img in gen['images'].items():
+            if img['id'] not in keep:
+                self.state.data.setdefault('orphans', {})[img['id']] = name
+        if 'pod' in gen:
+            self._record_teardown(asyncio.run(self._aretire(gen, images=False)))
+
+    def _swap(self, gen):
+        """
+        Make gen the current generation in the state, and write out its
+        server.properties if it has its own. The one being replaced keeps the
+        server.properties it ran with.
+
+        Returns the generation to retire, as State.switch_generation().
+        """
+        properties = self.root / self.config.properties_file
+        current = properties.read_text() if properties.exists() else None
+        retired = self.state.switch_generation(gen)
+        previous = self.state.get_previous()
+        if previous is not None and current is not None:
+            previous['properties'] = current
+        if 'properties' in gen:
+            properties.write_text(gen['properties'])
+        return retired
+
+    def switch_generation(self, gen):
+        """
+        Swap over to another generation of resources.
+
+        If the server is running, the world is flushed while it carries on,
+        and then the current pod is stopped and the new one started, so
+        players are only kicked for the swap. If the new pod won't start,
+        the old one is started again.
 
-            log.debug("Getting pod")
-            p = self.state.get_pod_object(client=pm)
-            if p is not None:
+        The current generation is kept as the previous one, along with the
+        server.properties it ran with, and the one that was previous is
+        removed. Returns how long the server was down for, in seconds, or None
+        if it wasn't running.
+        """
+        import asyncio
+
+        running = self.is_running()
+        downtime = None
+        with self.connect() as pm:
+            old_pod = self.state.get_pod_object(client=pm)
+            if running:
                 try:
-                    log.debug(f"Removing pod")
-                    p.remove(force=True)
-                except Exception:
-                    pass
-                self.state.save_pod(None)
+                    with self.console() as command:
+                        command('save-all flush')
+                except Exception as exc:
+                    log.warning(f"Could not flush the world before swapping: {exc}")
+                log.info("Swapping generations")
+                start = time.monotonic()
+                with span('stop pod'):
+                    old_pod.stop()
 
-    def rebuild_everything(self):
+            retired = self._swap(gen)
+            try:
+                if running:
+                    with span('start pod'):
+                        self.state.get_pod_object(client=pm).start()
+                    downtime = time.monotonic() - start
+            except Exception:
+                log.error("The new generation would not start, switching back")
+                self._swap(self.state.get_previous())
+                old_pod.start()
+                raise
+            finally:
+                if retired is not None:
+                    self._record_teardown(asyncio.run(self._aretire(retired)))
+
+        info = self.state.data.setdefault('generation', {})
+        info['swapped'] = time.time()
+        info['downtime'] = downtime
+        if downtime is not None:
+            log.info(f"Swapped to generation {info.get('number', 0)} in {downtime:.2f}s")
+        return downtime
+
+    def blue_green(self, plan, *, jobs=None, offline=False, context='extract'):
         """
-        Rebuild all of the stuff
+        Carry out a plan from plan() by building a new generation and swapping
+        to it, so the server keeps running during the build.
+
+        Returns the downtime, as switch_generation().
         """
-        # FIXME: Clean up old stuff
-        # FIXME: Don't allow this to run when the pod is started
-        with client() as pm:
-            # 1. Build the images
-            log.info("Building server")
-            serv_img = build_server(pm, self.config.server_buildargs())
-            self.state.save_image('server', serv_img)
-
-            log.info("Building manager")
-            man_img = build_manager(pm, self.config.manage_buildargs())
-            self.state.save_image('manager', man_img)
-
-            # 2. Assemble complete list of volumes and forwards
-            strip_proto = lambda p: str(p).split('/', 1)[0]
-            ports = [
-                f'{strip_proto(outter)}:{inner}'
-                for outter, (_, inner) in self.config.exposed_ports().items()
-            ]
-            volumes = {
-                c: self.root / (h if h else f".tmp/{c.replace('/', '_')}")
-                for h, c in self.config.volumes()
-            }
-            for img in (serv_img, man_img):
-                ivols = get_volumes(img)
-                for v in ivols:
-                    if v not in volumes:
-                        volumes[v] = f".tmp/{v.replace('/', '_')}"
-            # TODO: Add addon analysis
+        gen = self.build_generation(plan, jobs=jobs, offline=offline, context=context)
+        return self.switch_generation(gen)
 
-            # 3. Create volumes (storage directories)
-            log.info("Checking volumes")
-            self._ensure_tmp()
-            for hostpath in volumes.values():
-                hostpath = self.root / hostpath
-                if not hostpath.exists():
-                    # FIXME: Better heuristic for what's files and directories
-                    if '.' in hostpath.name:
-                        if not hostpath.exists():
-                            if hostpath.suffix == '.json':
-                                hostpath.write_text('[]')
-                            else:
-                                hostpath.touch()
-                    else:
-                        hostpath.mkdir(parents=True)
+    def rollback(self):
+        """
+        Swap back to the previous generation, so the current one becomes the
+        previous.
 
-            # 5. Write out server.properties
-            (self.root / self.config.properties_file).write_text(
-                '\n'.join(produce_properties(self.config.server_properties()))
-            )
+        Returns the downtime, as switch_generation().
+        """
+        previous = self.state.get_previous()
+        if previous is None:
+            raise ValueError("There is no previous generation to roll back to")
+        return self.switch_generation(previous)
 
-            # 4. Create pod
-            log.info("Creating pod")
-            pod = create_pod(pm, publish=ports)
-            self.state.save_pod(pod)
+    def rebuild_everything(self, *, jobs=None, offline=False, context='extract'):
+        """
+        Rebuild all of the stuff
 
-            # 6. Create containers
-            log.info("Creating containers")
-            serv_con = create_container(serv_img, pod, volumes)
-            self.state.save_container('server', serv_con)
-            man_con = create_container(man_img, pod, volumes)
-            self.state.save_container('manager', man_con)
+        See apply_plan() for the arguments.
+        """
+        self.apply_plan(
+            self.plan(offline=offline, force=True),
+            jobs=jobs, offline=offline, context=context,
+        )
 
     def start(self):
-        with client() as pm:
+        with self.connect() as pm:
             self.state.get_pod_object(client=pm).start()
 
     def stop(self):
-        with client() as pm:
+        with self.connect() as pm:
             self.state.get_pod_object(client=pm).stop()
 
     def restart(self):
-        with client() as pm:
+        with self.connect() as pm:
             self.state.get_pod_object(client=pm).restart()
 
     def pause(self):
-        with client() as pm:
+        with self.connect() as pm:
             self.state.get_pod_object(client=pm).pause()
 
     def unpause(self):
-        with client() as pm:
+        with self.connect() as pm:
             self.state.get_pod_object(client=pm).pause()
 
     def is_running(self):
-        with client() as pm:
-            pod = self.state.get_pod_object(client=pm)
-            return pod.status == 'Running'
+        # Straight to varlink, since this is polled by monitoring
+        pod = self.state.get_pod()
+        if pod is None:
+            return False
+        with self.podman_server() as address:
+            try:
+                reply = call(address, 'io.podman.GetPod', {'name': pod})
+            except NotFound:
+                return False
+        return reply['pod']['status'] == 'Running'
+
+    def rcon(self, *, timeout=10):
+        """
+        Get a (not yet connected) RCON client for the server.
+
+        Raises RconUnavailable if RCON isn't published on the host.
+        """
+        from .rcon import RconClient, RconUnavailable
+
+        port = self.config.host_port('server', RCON_PORT)
+        if port is None:
+            raise RconUnavailable("RCON is not exposed on the host (set enable-rcon in [properties])")
+        props = read_properties(self.root / self.config.properties_file)
+        return RconClient('127.0.0.1', port, props['rcon.password'], timeout=timeout)
+
+    def ping(self, *, timeout=5):
+        """
+        Do a server list ping, returning the status and the latency in seconds.
+        """
+        from . import slp
+
+        port = self.config.host_port('server', MINECRAFT_PORT)
+        return slp.query('127.0.0.1', port, timeout=timeout)
+
+    @contextlib.contextmanager
+    def console(self):
+        """
+        Get a function that runs a server console command, returning its output.
+
+        Uses RCON if it's exposed, otherwise runs the commands in the container.
+        """
+        from .rcon import RconUnavailable
+
+        try:
+            rcon = self.rcon()
+        except RconUnavailable:
+            def command(cmd):
+                rc, out = self.exec('server', ['cmd', cmd])
+                if rc:
+                    raise CommandFailed(f"{cmd}: {out}")
+                return out
+            yield command
+        else:
+            with rcon:
+                yield rcon.command
+
+    def snapshotter(self):
+        """
+        Get the Snapshotter for copying the live world to the snapshot volume.
+        """
+        from .snapshot import Snapshotter
+
+        return Snapshotter(
+            self.root / 'live', self.root / 'snapshot', self.root / SNAPSHOT_INDEX_NAME,
+        )
+
+    def snapshot(self, *, full=False):
+        """
+        Bring the snapshot volume up to date with the live world, copying only
+        what changed. If full, everything is copied.
+
+        Returns the stats, which are also kept in the state.
+        """
+        from .snapshot import take_snapshot
+
+        with self.console() as command:
+            stats = take_snapshot(self.snapshotter(), command, full=full)
+        self.state.data['snapshot'] = stats
+        return stats
+
+    def log_index(self):
+        """
+        Get the index of events in the server logs. Call update() on it to
+        bring it up to date.
+        """
+        from .logs import LogIndex
+
+        self._ensure_tmp()
+        return LogIndex(self.root / 'logs', self.root / LOG_INDEX_NAME)
+
+    def backup_store(self, root=None):
+        """
+        Get the backup store, from the config if root isn't given.
+        """
+        from .backup import BackupStore
+
+        root = root or self.config.backup_store()
+        if root is None:
+            raise ConfigError("No backup store configured (set store in [management.backup])")
+        return BackupStore(self.root / root)
+
+    def backup(self, store, *, snapshot=True, keep=None):
+        """
+        Back up the snapshot volume to a BackupStore, taking a snapshot first
+        if snapshot. If keep, older backups are pruned down to that many.
+
+        Returns the backup name and stats, which are also kept in the state.
+        """
+        if snapshot:
+            self.snapshot()
+        name, stats = store.backup(self.root / 'snapshot')
+        if keep is not None:
+            stats['pruned'], stats['pruned_objects'] = store.prune(keep)
+        self.state.data['backup'] = dict(stats, name=name)
+        return name, stats
 
     def exec(self, cname, cmd):
-        # TODO: Use ExecContainer instead
-        with client() as pm:
-            cont = self.state.get_container_object(cname, client=pm)
-
-            proc = subprocess.run(
-                ['podman', 'exec', cont.id, *cmd], encoding='utf-8',
-                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
+        """
+        Run a command in a container, returning the exit code and the output.
+        """
+        chunks = []
+        rc = self.exec_streamed(cname, cmd, lambda stream, data: chunks.append(data))
+        return rc, b''.join(chunks).decode('utf-8', errors='replace')
+
+    def exec_streamed(self, cname, cmd, output, **opts):
+        """
+        Run a command in a container, returning the exit code.
+
+        output is called with (stream, data) as output arrives, where stream
+        is varlink.STDOUT or varlink.STDERR. Other keyword arguments (user,
+        workdir, env) are passed to ExecContainer.
+        """
+        with self.podman_server() as address:
+            opts = exec_opts(self.state.get_container(cname), cmd, **opts)
+            return exec_container(address, opts, output=output)
+
+    # asyncio counterparts
+
+    async def _aremove(self, kind, name, remove, ident):
+        """
+        Remove one resource, returning a Removal.
+        """
+        try:
+            log.debug(f"Removing {name} {kind}")
+            await remove(ident, force=True)
+        except NotFound:
+            return Removal(kind, name, ident, Removal.GONE, None)
+        except Exception as exc:
+            return Removal(kind, name, ident, Removal.FAILED, str(exc))
+        else:
+            return Removal(kind, name, ident, Removal.REMOVED, None)
+
+    def _detach_images(self):
+        """
+        Stop tracking all the images (including ones an earlier cleanup
+        couldn't remove), returning {id: name} for removal.
+        """
+        images = self.state.data.pop('orphans', {})
+        for name in self.state.names():
+            if name in self.state.data['images']:
+                image_id = self.state.get_image(name)
+                images[image_id] = name
+                self.state.forget_inspect(image_id)
+                self.state.save_image(name, None)
+        return images
+
+    async def _aremove_images(self, images):
+        """
+        Remove the given images ({id: name}) all at once.
+        """
+        import asyncio
+
+        async with self.aconnect() as pm:
+            return list(await asyncio.gather(*(
+                self._aremove('image', name, pm.remove_image, image_id)
+                for image_id, name in images.items()
+            )))
+
+    async def _aretire(self, gen, *, images=True):
+        """
+        Remove the containers and pod of a generation that's no longer kept,
+        and (if images) its images that neither kept generation uses.
+        """
+        import asyncio
+
+        async with self.aconnect() as pm:
+            results = list(await asyncio.gather(*(
+                self._aremove('container', name, pm.remove_container, con['id'])
+                for name, con in gen.get('containers', {}).items()
+            )))
+            if 'pod' in gen:
+                results.append(await self._aremove('pod', 'the', pm.remove_pod, gen['pod']['id']))
+        if images:
+            keep = self.state.generation_images()
+            unused = {
+                img['id']: name for name, img in gen.get('images', {}).items()
+                if img['id'] not in keep
+            }
+            for image_id in unused:
+                self.state.forget_inspect(image_id)
+            results += await self._aremove_images(unused)
+        return results
+
+    async def acleanup(self, *, keep_images=False):
+        """
+        Deletes all the podman resources, doing independent removals concurrently.
+
+        See cleanup(). Does not delete volume data
+        """
+        import asyncio
+
+        log.info("Cleaning up")
+        async with self.aconnect() as pm:
+            names = [n for n in self.state.names() if n in self.state.data['containers']]
+            results = list(await asyncio.gather(*(
+                self._aremove('container', name, pm.remove_container, self.state.get_container(name))
+                for name in names
+            )))
+
+            if self.state.get_pod() is not None:
+                results.append(await self._aremove('pod', 'the', pm.remove_pod, self.state.get_pod()))
+
+        # Forget everything that's gone, keep what's still there for next time
+        for r in results:
+            if r.outcome != Removal.FAILED:
+                if r.kind == 'container':
+                    self.state.save_container(r.name, None)
+                else:
+                    self.state.save_pod(None)
+
+        # The previous generation goes too, with its images left for the
+        # image cleanup
+        previous = self.state.data.pop('previous', None)
+        if previous is not None:
+            results += await self._aretire(previous, images=False)
+            current = self.state.generation_images()
+            for name, img in previous.get('images', {}).items():
+                if img['id'] not in current:
+                    self.state.data.setdefault('orphans', {})[img['id']] = name
+
+        if not keep_images:
+            results += await self._aremove_images(self._detach_images())
+        return results
+
+    async def astart(self):
+        async with self.aconnect() as pm:
+            await pm.start_pod(self.state.get_pod())
+
+    async def astop(self):
+        async with self.aconnect() as pm:
+            await pm.stop_pod(self.state.get_pod())
+
+    async def ais_running(self):
+        async with self.aconnect() as pm:
+            pod = await pm.get_pod(self.state.get_pod())
+            return pod['status'] == 'Running'
+
+    async def alimits(self):
+        """
+        The resource limits podman actually applied to each container, as
+        {name: {setting: value}}, where settings are as in [resources] and
+        None means unlimited. If a container couldn't be inspected, its value
+        is the exception.
+        """
+        import asyncio
+
+        names = [n for n in self.state.names() if n in self.state.data['containers']]
+        async with self.aconnect() as pm:
+            details = await asyncio.gather(*(
+                pm.inspect_container(self.state.get_container(name)) for name in names
+            ), return_exceptions=True)
+        limits = {}
+        for name, d in zip(names, details):
+            if isinstance(d, Exception):
+                limits[name] = d
+                continue
+            hc = d.get('hostconfig', {})
+            limits[name] = {
+                'memory': hc.get('memory') or None,
+                'cpus': (hc.get('nanocpus') or 0) / 1e9 or None,
+                'cpuset': hc.get('cpusetcpus') or None,
+                'blkio-weight': hc.get('blkioweight') or None,
+                # 0 and -1 both mean unlimited
+                'pids-limit': hc['pidslimit'] if (hc.get('pidslimit') or 0) > 0 else None,
+                'cgroup-parent': hc.get('cgroupparent') or None,
+            }
+        return limits
+
+    async def aexec(self, cname, cmd):
+        chunks = []
+        async with self.aconnect() as pm:
+            rc = await pm.exec(
+                self.state.get_container(cname), cmd,
+                output=lambda stream, data: chunks.append(data),
             )
-        return proc.returncode, proc.stdout
+        return rc, b''.join(chunks).decode('utf-8', errors='replace')
 
 
 def produce_properties(props):
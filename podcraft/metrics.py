@@ -0,0 +1,234 @@
+"""
+A Prometheus exporter for a server.
+
+Everything is gathered in the background every so often, and scrapes are
+answered from the last results, so however often Prometheus scrapes, the
+game server only gets asked once per refresh.
+
+Sources:
+
+* A status ping, for players
+* RCON tps (Paper and Spigot have it), for ticks per second
+* The log index, for tick lag warnings
+* podman, for container CPU, memory, and I/O
+* The state file, for build, snapshot, backup, and job timings
+"""
+import asyncio
+import http.server
+import logging
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+TPS = re.compile(r'TPS from last 1m, 5m, 15m: (.+)$')
+LAG = re.compile(r'Running (\d+)ms or (\d+) ticks behind')
+
+#: ContainerStats field -> (metric, help)
+CONTAINER_STATS = {
+    'cpu': ('podcraft_container_cpu_percent', "CPU use, as a percentage of one core"),
+    'mem_usage': ('podcraft_container_memory_bytes', "Memory in use"),
+    'mem_limit': ('podcraft_container_memory_limit_bytes', "Memory limit"),
+    'block_input': ('podcraft_container_block_read_bytes', "Bytes read from block devices"),
+    'block_output': ('podcraft_container_block_write_bytes', "Bytes written to block devices"),
+    'net_input': ('podcraft_container_network_receive_bytes', "Bytes received"),
+    'net_output': ('podcraft_container_network_transmit_bytes', "Bytes sent"),
+    'pids': ('podcraft_container_pids', "Processes"),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Collects samples and renders them in the Prometheus text format.
+    """
+    def __init__(self):
+        self._families = {}
+
+    def add(self, name, value, labels=None, *, help='', type='gauge'):
+        family = self._families.setdefault(name, {'help': help, 'type': type, 'samples': []})
+        family['samples'].append((labels or {}, value))
+
+    def render(self):
+        lines = []
+        for name, family in self._families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for labels, value in family['samples']:
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+                if label_text:
+                    lines.append(f"{name}{{{label_text}}} {float(value)!r}")
+                else:
+                    lines.append(f"{name} {float(value)!r}")
+        return '\n'.join(lines) + '\n'
+
+
+def parse_tps(text):
+    """
+    Get the 1m, 5m, and 15m TPS from the output of tps, or None.
+    """
+    m = TPS.search(re.sub(r'§.', '', text))
+    if m is None:
+        return None
+    return [float(v.strip(' *')) for v in m.group(1).split(',')]
+
+
+class Collector:
+    """
+    Gathers the metrics for a project every interval seconds, in a thread.
+    """
+    def __init__(self, pc, *, interval=15):
+        self.pc = pc
+        self.interval = interval
+        self.text = Metrics().render()
+        self._rcon = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._rcon is not None:
+            self._rcon.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def refresh(self):
+        start = time.monotonic()
+        metrics = Metrics()
+        state = self.pc.state.peek()
+        for source in (self._ping, self._tps, self._lag, self._containers, self._timings):
+            try:
+                source(metrics, state)
+            except Exception as exc:
+                log.debug("%s failed: %s", source.__name__, exc)
+        metrics.add('podcraft_refresh_seconds', time.monotonic() - start,
+                    help="How long gathering these metrics took")
+        metrics.add('podcraft_refresh_timestamp_seconds', time.time(),
+                    help="When these metrics were gathered")
+        self.text = metrics.render()
+
+    def _ping(self, metrics, state):
+        try:
+            status, latency = self.pc.ping()
+        except Exception:
+            metrics.add('podcraft_up', 0, help="Whether the server answered a status ping")
+            raise
+        metrics.add('podcraft_up', 1, help="Whether the server answered a status ping")
+        metrics.add('podcraft_ping_seconds', latency, help="Status ping round trip time")
+        metrics.add('podcraft_players_online', status['players']['online'], help="Players online")
+        metrics.add('podcraft_players_max', status['players']['max'], help="Player limit")
+
+    def _tps(self, metrics, state):
+        from .rcon import RconError
+
+        try:
+            if self._rcon is None:
+                self._rcon = self.pc.rcon()
+                self._rcon.connect()
+            output = self._rcon.command('tps')
+        except (RconError, OSError):
+            if self._rcon is not None:
+                self._rcon.close()
+                self._rcon = None
+            raise
+        tps = parse_tps(output)
+        if tps is None:
+            return  # Vanilla doesn't have tps
+        for window, value in zip(('1m', '5m', '15m'), tps):
+            metrics.add('podcraft_tps', value, {'window': window}, help="Ticks per second")
+
+    def _lag(self, metrics, state):
+        with self.pc.log_index() as index:
+            index.update()
+            events = list(index.search(kinds=['lag']))
+        metrics.add('podcraft_tick_lag_warnings_total', len(events), type='counter',
+                    help="Can't keep up! warnings in the logs")
+        if events:
+            m = LAG.search(events[-1][3])
+            if m is not None:
+                metrics.add('podcraft_tick_lag_last_seconds', int(m.group(1)) / 1000,
+                            help="How far behind the last lag warning said the server was")
+                metrics.add('podcraft_tick_lag_last_timestamp_seconds', events[-1][0],
+                            help="When the last lag warning was")
+
+    def _containers(self, metrics, state):
+        from .aiopodman import AsyncClient
+
+        containers = {name: c['id'] for name, c in state['containers'].items()}
+
+        async def gather():
+            with self.pc.podman_server() as address:
+                async with AsyncClient(address) as pm:
+                    return await asyncio.gather(*(
+                        pm.get_container_stats(cid) for cid in containers.values()
+                    ), return_exceptions=True)
+
+        for name, stats in zip(containers, asyncio.run(gather())):
+            if isinstance(stats, Exception):
+                continue  # Not running
+            for field, (metric, help) in CONTAINER_STATS.items():
+                if field in stats:
+                    metrics.add(metric, stats[field], {'container': name}, help=help)
+
+    def _timings(self, metrics, state):
+        build = state.get('build')
+        if build:
+            metrics.add('podcraft_build_seconds', build['seconds'], help="How long the last build took")
+            metrics.add('podcraft_build_timestamp_seconds', build['finished'], help="When the last build finished")
+        snapshot = state.get('snapshot')
+        if snapshot:
+            metrics.add('podcraft_snapshot_pause_seconds', snapshot['pause'],
+                        help="How long saving was paused for the last snapshot")
+            metrics.add('podcraft_snapshot_timestamp_seconds', snapshot['taken'],
+                        help="When the last snapshot was taken")
+        backup = state.get('backup')
+        if backup:
+            metrics.add('podcraft_backup_seconds', backup['seconds'], help="How long the last backup took")
+            metrics.add('podcraft_backup_new_bytes', backup['new_bytes'],
+                        help="Bytes the last backup added to the store")
+        for name, job in state.get('jobs', {}).items():
+            labels = {'job': name}
+            metrics.add('podcraft_job_seconds', job['seconds'], labels, help="How long the job took last time")
+            metrics.add('podcraft_job_bytes', job.get('bytes', 0), labels, help="Bytes the job handled last time")
+            metrics.add('podcraft_job_timestamp_seconds', job['started'], labels, help="When the job last ran")
+            metrics.add('podcraft_job_failed', int(bool(job['error'] or job['rc'])), labels,
+                        help="Whether the job failed last time")
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    collector = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.collector.text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def make_server(collector, address):
+    """
+    Make an HTTP server for collector's metrics at address.
+    """
+    handler = type('Handler', (_Handler,), {'collector': collector})
+    return http.server.ThreadingHTTPServer(address, handler)
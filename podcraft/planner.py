@@ -0,0 +1,155 @@
+"""
+Works out the least amount of work needed to bring the podman resources up
+to date with the config.
+
+Every resource is fingerprinted from the inputs it was made from, and the
+fingerprints are kept in the state. A resource is remade if its inputs
+changed, or if something it depends on is being remade:
+
+* Images depend on their build inputs
+* The pod depends on the published ports (and addon images, which can add
+  ports) and its cgroup parent
+* Containers depend on their image, the pod, their volumes, their resource
+  limits, and (for the server) its JVM options
+* server.properties depends on the properties
+"""
+import collections
+import hashlib
+import json
+
+Step = collections.namedtuple('Step', ['action', 'name', 'reason'])
+
+#: The actions, in the order they're carried out
+ACTIONS = ('build', 'remove', 'create-pod', 'write-properties', 'create-container')
+
+
+def fingerprint(inputs):
+    """
+    Hash some JSON-able data.
+    """
+    blob = json.dumps(inputs, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class Plan:
+    """
+    A set of steps, and the inputs they were worked out from.
+    """
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.steps = []
+
+    def add(self, action, name, reason):
+        assert action in ACTIONS
+        self.steps.append(Step(action, name, reason))
+
+    def names(self, action):
+        """
+        The names that the given action will be done to.
+        """
+        return [s.name for s in self.steps if s.action == action]
+
+    def __contains__(self, item):
+        action, name = item
+        return any(s.action == action and s.name == name for s in self.steps)
+
+    def __iter__(self):
+        yield from sorted(self.steps, key=lambda s: ACTIONS.index(s.action))
+
+    def __bool__(self):
+        return bool(self.steps)
+
+    def describe(self):
+        """
+        Generates a human-readable line for each step.
+        """
+        if not self.steps:
+            yield "Everything is up to date"
+        for step in self:
+            target = f" {step.name}" if step.name else ""
+            yield f"{step.action}{target}: {step.reason}"
+
+    def fingerprints(self):
+        """
+        The fingerprints of everything, once the plan is carried out.
+        """
+        rv = {
+            f'image:{name}': fingerprint(i)
+            for name, i in self.inputs['images'].items()
+        }
+        rv.update({
+            f'container:{name}': fingerprint(i)
+            for name, i in self.inputs['containers'].items()
+        })
+        rv['pod'] = fingerprint(self.inputs['pod'])
+        rv['properties'] = fingerprint(self.inputs['properties'])
+        return rv
+
+
+def _changed(state, key, inputs):
+    return state.get_fingerprint(key) != fingerprint(inputs)
+
+
+def make_plan(state, inputs, *, client=None, force=False, properties_exist=True):
+    """
+    Compare the inputs against the state and work out what needs doing.
+
+    inputs is a dict with:
+    * images: name -> build inputs (a digest of None means the build
+      context isn't available, so it's assumed to have changed)
+    * containers: name -> container inputs (everything except the image and pod)
+    * pod: pod inputs
+    * properties: server.properties inputs
+
+    The state should already have had resources podman doesn't know about
+    removed. client is passed to State.should_rebuild_container().
+
+    If force, everything is remade.
+    """
+    plan = Plan(inputs)
+
+    for name, i in inputs['images'].items():
+        if force:
+            plan.add('build', name, "rebuilding everything")
+        elif name not in state.data['images']:
+            plan.add('build', name, "not built")
+        elif 'digest' in i and i['digest'] is None:
+            plan.add('build', name, "build context isn't downloaded, so can't tell if it changed")
+        elif _changed(state, f'image:{name}', i):
+            plan.add('build', name, "build inputs changed")
+
+    for name in state.names():
+        if name not in inputs['images']:
+            plan.add('remove', name, "no longer configured")
+
+    addons_rebuilt = [
+        name for name in plan.names('build')
+        if name not in ('server', 'manager')
+    ]
+    if force:
+        plan.add('create-pod', None, "rebuilding everything")
+    elif state.get_pod() is None:
+        plan.add('create-pod', None, "no pod")
+    elif _changed(state, 'pod', inputs['pod']):
+        plan.add('create-pod', None, "published ports or cgroup parent changed")
+    elif addons_rebuilt:
+        plan.add('create-pod', None, f"addon images may publish new ports ({', '.join(addons_rebuilt)})")
+
+    for name, i in inputs['containers'].items():
+        if force:
+            plan.add('create-container', name, "rebuilding everything")
+        elif ('create-pod', None) in plan:
+            plan.add('create-container', name, "pod is being replaced")
+        elif ('build', name) in plan:
+            plan.add('create-container', name, "image is being rebuilt")
+        elif state.should_rebuild_container(name, client=client):
+            plan.add('create-container', name, "not using the current image")
+        elif _changed(state, f'container:{name}', i):
+            plan.add('create-container', name, "container config changed")
+
+    if force or not properties_exist:
+        plan.add('write-properties', None, "not written")
+    elif _changed(state, 'properties', inputs['properties']):
+        plan.add('write-properties', None, "properties changed (restart to apply)")
+
+    return plan
@@ -1,34 +1,191 @@
 import subprocess
-import podman
 import contextlib
+import logging
 import tempfile
+import threading
 import time
 import os
 import os.path
+import pathlib
 import signal
 
+from . import varlink
+from .tracing import span
+
+log = logging.getLogger(__name__)
+
+# podman.Client keeps its varlink connection on the instance while a call is
+# in flight, so it can't be shared between threads. Share one per thread.
+_clients = threading.local()
+
+# Persistent servers known to be answering, so they're only checked once
+_healthy = set()
+
+
+class ServerUnavailable(Exception):
+    """
+    The persistent varlink server couldn't be started or reached.
+    """
+
 
-# TODO: Connection pooling/saving
 @contextlib.contextmanager
-def client():
+def ephemeral_server():
+    """
+    Run a throwaway varlink server for the duration of the context.
+
+    Yields the varlink address.
+    """
     socket = tempfile.mktemp()
-    proc = subprocess.Popen(
-        ['podman', 'varlink', '--timeout', '0', f'unix:{socket}'],
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.DEVNULL,
-    )
-    # Wait for it to start
-    while not os.path.exists(socket):
-        time.sleep(0.1)
+    with span('start podman varlink', persistent=False):
+        proc = subprocess.Popen(
+            ['podman', 'varlink', '--timeout', '0', f'unix:{socket}'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+        )
+        # Wait for it to start
+        while not os.path.exists(socket):
+            time.sleep(0.1)
     try:
-        with podman.Client(f'unix:{socket}') as client:
-            yield client
+        yield f'unix:{socket}'
     finally:
         # Since the process doesn't have to timeout, we have to signal it to stop
         proc.terminate()
 
 
-def start_persistent_server(socketfile, pidfile, *, wait_for_start=True):
+def _server_pid(socketfile, pidfile):
+    """
+    Get the PID of the persistent server, or None if it isn't running.
+    """
+    try:
+        pid = int(pidfile.read_text())
+    except (OSError, ValueError):
+        return None
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        # Exists, but isn't ours, so it isn't our server
+        return None
+
+    # Guard against the PID having been reused by something else
+    try:
+        cmdline = pathlib.Path(f'/proc/{pid}/cmdline').read_bytes()
+    except OSError:
+        # No procfs, take the PID at its word
+        return pid
+    if b'varlink' not in cmdline or os.fsencode(str(socketfile)) not in cmdline:
+        return None
+    return pid
+
+
+def _connect(address):
+    """
+    Get the shared client for the given address, connecting if needed.
+    """
+    cache = getattr(_clients, 'cache', None)
+    if cache is None:
+        cache = _clients.cache = {}
+    if address not in cache:
+        with span('connect podman client'):
+            import podman  # The podman library is slow to import
+            cache[address] = podman.Client(address)
+    return cache[address]
+
+
+def _ping(address):
+    """
+    Check the server is answering, without the weight of a podman.Client.
+    """
+    varlink.call(address, 'org.varlink.service.GetInfo', timeout=5)
+    _healthy.add(address)
+
+
+def _forget(address):
+    _healthy.discard(address)
+    getattr(_clients, 'cache', {}).pop(address, None)
+
+
+def persistent_server(socketfile, pidfile):
+    """
+    Make sure the persistent server is running and healthy, (re)starting it
+    if it isn't.
+
+    Returns the varlink address. Raises ServerUnavailable if it can't be made
+    to work.
+    """
+    address = f'unix:{socketfile}'
+    if address in _healthy:
+        return address
+
+    if _server_pid(socketfile, pidfile) is not None and socketfile.exists():
+        try:
+            _ping(address)
+        except (ConnectionError, OSError, varlink.VarlinkError):
+            log.debug("Persistent server is not responding, restarting it")
+            stop_persistent_server(socketfile, pidfile)
+        else:
+            return address
+    else:
+        log.debug("Persistent server is not running, starting it")
+        # Clear out whatever a dead server left behind
+        for p in (socketfile, pidfile):
+            if p.exists():
+                p.unlink()
+
+    try:
+        start_persistent_server(socketfile, pidfile, timeout=10)
+        _ping(address)
+    except (ConnectionError, OSError, subprocess.SubprocessError, TimeoutError,
+            varlink.VarlinkError) as exc:
+        _forget(address)
+        raise ServerUnavailable(str(exc)) from exc
+    return address
+
+
+@contextlib.contextmanager
+def server(socketfile=None, pidfile=None, *, address=None):
+    """
+    Get the address of a podman varlink server.
+
+    If address is given, that server is used as-is. If socketfile and pidfile
+    are given, the persistent server is used (and started if needed).
+    Otherwise, or if the persistent server can't be used, a server is started
+    just for this context.
+    """
+    if address is None and socketfile is not None:
+        try:
+            address = persistent_server(socketfile, pidfile)
+        except ServerUnavailable as exc:
+            log.warning("Could not use persistent podman server (%s), falling back", exc)
+
+    if address is not None:
+        yield address
+    else:
+        with ephemeral_server() as address:
+            yield address
+
+
+@contextlib.contextmanager
+def client(socketfile=None, pidfile=None, *, address=None):
+    """
+    Get a podman client.
+
+    Clients for the persistent server (or a given address) are shared by all
+    the operations in a thread. See server() for the arguments.
+    """
+    shared = address is not None
+    with server(socketfile, pidfile, address=address) as address:
+        if shared or (socketfile is not None and address == f'unix:{socketfile}'):
+            yield _connect(address)
+        else:
+            import podman
+            with podman.Client(address) as client:
+                yield client
+
+
+def start_persistent_server(socketfile, pidfile, *, wait_for_start=True, timeout=None):
     """
     Start the persistent server (used for giving containers access to podman).
 
@@ -38,35 +195,63 @@ def start_persistent_server(socketfile, pidfile, *, wait_for_start=True):
         # Socket exists, let's just assume things are fine
         return
 
-    proc = subprocess.Popen(
-        ['podman', 'varlink', '--timeout', '0', f'unix:{socketfile}'],
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.DEVNULL,
-    )
-    # Wait for it to start
-    while wait_for_start and not os.path.exists(socketfile):
-        time.sleep(0.1)
+    socketfile.parent.mkdir(parents=True, exist_ok=True)
+    with span('start podman varlink', persistent=True):
+        proc = subprocess.Popen(
+            ['podman', 'varlink', '--timeout', '0', f'unix:{socketfile}'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            # Outlive us, and don't catch our ^C
+            start_new_session=True,
+        )
+        pidfile.write_text(str(proc.pid))
 
-    pidfile.write_text(str(proc.pid))
+        # Wait for it to start
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while wait_for_start and not os.path.exists(socketfile):
+            if proc.poll() is not None:
+                raise subprocess.SubprocessError(f"podman varlink exited with {proc.returncode}")
+            if deadline is not None and time.monotonic() > deadline:
+                proc.terminate()
+                raise TimeoutError("podman varlink did not start")
+            time.sleep(0.1)
 
 
-def stop_persistent_server(socketfile, pidfile, *, wait_for_stop=True):
+def stop_persistent_server(socketfile, pidfile, *, wait_for_stop=True, timeout=10):
     """
     Stop the persistent server.
 
-    Does nothing if the socket does not exist.
+    If it hasn't stopped after timeout seconds, it's killed. Does nothing if
+    the socket does not exist.
     """
+    _forget(f'unix:{socketfile}')
     if not socketfile.exists():
         # Socket not found, let's just assume things are fine
         if pidfile.exists():  # Remove the PID file if it exists.
             pidfile.unlink()
         return
 
-    pid = int(pidfile.read_text())
-    os.kill(pid, signal.SIGTERM)
+    pid = _server_pid(socketfile, pidfile)
+    if pid is None:
+        # Nothing is serving this socket, it's just litter
+        socketfile.unlink()
+    else:
+        os.kill(pid, signal.SIGTERM)
 
     # Wait for it to stop
+    deadline = time.monotonic() + timeout
     while wait_for_stop and os.path.exists(socketfile):
+        if time.monotonic() > deadline:
+            log.warning("Persistent server did not stop, killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            # It didn't get to clean up after itself
+            if socketfile.exists():
+                socketfile.unlink()
+            break
         time.sleep(0.1)
 
-    pidfile.unlink()
+    if pidfile.exists():
+        pidfile.unlink()
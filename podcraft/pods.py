@@ -7,6 +7,8 @@ Stuff for pods
 from podman.libs import ConfigDict
 from podman.libs.pods import Pod
 
+from .tracing import span
+
 
 def create_pod(client, ident=None, cgroupparent=None, labels=None, share=None,
                infra=False, publish=[]):
@@ -23,7 +25,7 @@ def create_pod(client, ident=None, cgroupparent=None, labels=None, share=None,
         publish=publish
     )
 
-    with client._client() as podman:
+    with span('create pod'), client._client() as podman:
         result = podman.CreatePod(config)
         details = podman.GetPod(result['pod'])
     return Pod(client._client, result['pod'], details['pod'])
@@ -0,0 +1,175 @@
+"""
+Native RCON client, so commands don't need a podman exec each.
+
+Packets are a little-endian int32 length, int32 request ID, int32 type, the
+payload, and two NULs. Responses longer than 4096 bytes are split over several
+packets with no end marker, so after a full-size packet we send a packet of
+an unknown type, which the server answers with "Unknown request" only after
+it has sent all of the real response.
+
+The vanilla server expects exactly one packet per socket read and drops the
+connection if several arrive at once, so batches run in lock step unless a
+window is given for servers that read packets properly.
+"""
+import collections
+import itertools
+import socket
+import struct
+
+AUTH = 3
+AUTH_RESPONSE = 2
+EXECCOMMAND = 2
+RESPONSE_VALUE = 0
+# Anything the server doesn't understand gets an "Unknown request" reply
+TERMINATOR = 100
+
+MAX_PAYLOAD = 4096
+
+
+class RconError(Exception):
+    """
+    Something went wrong talking RCON.
+    """
+
+
+class AuthenticationFailed(RconError):
+    """
+    The server rejected the password.
+    """
+
+
+class RconUnavailable(RconError):
+    """
+    RCON can't be reached from the host.
+    """
+
+
+Packet = collections.namedtuple('Packet', ['id', 'type', 'payload'])
+
+
+class RconClient:
+    """
+    A single authenticated RCON connection.
+    """
+    def __init__(self, host, port, password, *, timeout=10):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self._ids = itertools.count(1)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = b''
+        auth_id = self._send(AUTH, self.password)
+        while True:
+            pkt = self._recv()
+            # Some servers send an empty RESPONSE_VALUE first
+            if pkt.type == AUTH_RESPONSE:
+                break
+        if pkt.id == -1 or pkt.id != auth_id:
+            self.close()
+            raise AuthenticationFailed("RCON password was rejected")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _send(self, type, payload):
+        ident = next(self._ids)
+        data = payload.encode('utf-8')
+        body = struct.pack('<ii', ident, type) + data + b'\0\0'
+        self.sock.sendall(struct.pack('<i', len(body)) + body)
+        return ident
+
+    def _read(self, n):
+        while len(self._buf) < n:
+            chunk = self.sock.recv(max(n - len(self._buf), 4096))
+            if not chunk:
+                raise RconError("Connection closed by server")
+            self._buf += chunk
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def _recv(self):
+        length, = struct.unpack('<i', self._read(4))
+        body = self._read(length)
+        ident, type = struct.unpack('<ii', body[:8])
+        return Packet(ident, type, body[8:-2].decode('utf-8', errors='replace'))
+
+    def _collect(self, ident, first=None):
+        """
+        Read the rest of the response to a command, up to its terminator.
+        """
+        parts = [] if first is None else [first.payload]
+        end = self._send(TERMINATOR, '')
+        while True:
+            pkt = self._recv()
+            if pkt.id == end:
+                return ''.join(parts)
+            elif pkt.id == ident:
+                parts.append(pkt.payload)
+
+    def command(self, cmd):
+        """
+        Run a command, returning its output.
+        """
+        ident = self._send(EXECCOMMAND, cmd)
+        pkt = self._recv()
+        if len(pkt.payload.encode('utf-8')) < MAX_PAYLOAD:
+            return pkt.payload
+        return self._collect(ident, pkt)
+
+    def batch(self, commands, *, window=1):
+        """
+        Run several commands, generating their outputs in order.
+
+        If window is more than 1, that many commands are sent without waiting
+        for their responses. Vanilla servers can't handle that.
+        """
+        if window <= 1:
+            for cmd in commands:
+                yield self.command(cmd)
+            return
+
+        # Map of command ID -> [terminator ID, parts], in the order sent
+        pending = collections.OrderedDict()
+        by_terminator = {}
+        commands = iter(commands)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    cmd = next(commands)
+                except StopIteration:
+                    exhausted = True
+                    break
+                ident = self._send(EXECCOMMAND, cmd)
+                end = self._send(TERMINATOR, '')
+                pending[ident] = [end, []]
+                by_terminator[end] = ident
+            if not pending:
+                return
+
+            pkt = self._recv()
+            if pkt.id in pending:
+                pending[pkt.id][1].append(pkt.payload)
+            elif pkt.id in by_terminator:
+                by_terminator.pop(pkt.id)
+            # Hand out whatever's finished, in order
+            while pending:
+                ident, (end, parts) = next(iter(pending.items()))
+                if end in by_terminator:
+                    break
+                del pending[ident]
+                yield ''.join(parts)
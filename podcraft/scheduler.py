@@ -0,0 +1,182 @@
+"""
+Runs the backup cycle from [management.backup]: on a (jittered) schedule, take
+a snapshot and run the post-snapshot jobs against it.
+
+A cycle is skipped if the live world hasn't changed since the last snapshot,
+which is checked against the snapshot index without walking the world.
+
+Jobs are either containers (image, with the rest of their settings given as
+environment variables), or built in:
+
+* store: back up to a deduplicating store in that directory
+
+Jobs run concurrently, up to a limit. How long each took and how many bytes
+it handled are kept in the state.
+"""
+import asyncio
+import logging
+import random
+import re
+import time
+
+from .varlink import ImageNotFound, VarlinkError
+
+log = logging.getLogger(__name__)
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+#: How much the time between cycles is varied by, as a fraction
+JITTER = 0.1
+
+#: Seconds between container stats checks
+STATS_INTERVAL = 1
+
+#: How many past durations to keep for each job
+HISTORY = 10
+
+
+def parse_frequency(text):
+    """
+    Parse a frequency like "1h", "90m", or "1h30m" into seconds. A bare number
+    is seconds.
+    """
+    if isinstance(text, (int, float)):
+        return float(text)
+    text = text.strip().lower()
+    if re.fullmatch(r'\d+(\.\d+)?', text):
+        return float(text)
+    parts = re.findall(r'(\d+(?:\.\d+)?)\s*([smhdw])', text)
+    if not parts or re.sub(r'(\d+(?:\.\d+)?)\s*([smhdw])|\s', '', text):
+        raise ValueError(f"Can't understand frequency {text!r}")
+    return sum(float(n) * UNITS[unit] for n, unit in parts)
+
+
+def next_delay(frequency, *, jitter=JITTER):
+    """
+    How long to wait until the next cycle.
+    """
+    return frequency * random.uniform(1 - jitter, 1 + jitter)
+
+
+def job_name(index, job):
+    return job.get('name', f'job-{index}')
+
+
+async def _run_container_job(pm, job, *, pod_id, volumes):
+    """
+    Run a job container to completion, returning (exit code, bytes handled).
+    """
+    from .images import pull_image
+
+    try:
+        image_id = (await pm.get_image(job['image']))['id']
+    except ImageNotFound:
+        await asyncio.get_running_loop().run_in_executor(None, pull_image, job['image'])
+        image_id = (await pm.get_image(job['image']))['id']
+    env = {k.upper(): str(v) for k, v in job.items() if k not in ('image', 'name')}
+    cid = await pm.create_container(image_id, pod_id, volumes, env=env)
+    try:
+        await pm.start_container(cid)
+        waiter = asyncio.ensure_future(pm.wait_container(cid))
+        handled = 0
+        while not waiter.done():
+            try:
+                stats = await pm.get_container_stats(cid)
+            except VarlinkError:
+                pass  # Not running (yet or any more)
+            else:
+                handled = stats['block_input'] + stats['block_output']
+            await asyncio.wait([waiter], timeout=STATS_INTERVAL)
+        return waiter.result(), handled
+    finally:
+        await pm.remove_container(cid, force=True)
+
+
+class Scheduler:
+    """
+    Runs backup cycles for a project.
+    """
+    def __init__(self, pc, *, concurrency=None):
+        self.pc = pc
+        settings = pc.config['management'].get('backup', {})
+        self.frequency = parse_frequency(settings.get('frequency', '1h'))
+        self.concurrency = concurrency or settings.get('concurrency', 2)
+        self.jobs = {
+            job_name(i, job): job
+            for i, job in enumerate(settings.get('job', []))
+        }
+
+    async def _run_job(self, pm, name, job, limit, context):
+        async with limit:
+            log.info(f"Running {name}")
+            record = {'started': time.time(), 'rc': None, 'error': None}
+            start = time.monotonic()
+            try:
+                if 'image' in job:
+                    record['rc'], record['bytes'] = await _run_container_job(pm, job, **context)
+                elif 'store' in job:
+                    store = self.pc.backup_store(job['store'])
+                    _, stats = await asyncio.get_running_loop().run_in_executor(
+                        None, store.backup, self.pc.root / 'snapshot',
+                    )
+                    record['rc'], record['bytes'] = 0, stats['bytes']
+                else:
+                    raise ValueError("Job has neither an image nor a store")
+            except Exception as exc:
+                log.exception(f"{name} failed")
+                record['error'] = f"{type(exc).__name__}: {exc}"
+            record['seconds'] = time.monotonic() - start
+            log.info(f"{name} finished in {record['seconds']:.1f}s")
+            return name, record
+
+    async def _run_jobs(self, pod_id, volumes):
+        limit = asyncio.Semaphore(self.concurrency)
+        context = {'pod_id': pod_id, 'volumes': volumes}
+        async with self.pc.aconnect() as pm:
+            return dict(await asyncio.gather(*(
+                self._run_job(pm, name, job, limit, context)
+                for name, job in self.jobs.items()
+            )))
+
+    def cycle(self, *, force=False):
+        """
+        Snapshot and run the jobs, unless nothing changed (or force).
+
+        Returns the job records, or None if the cycle was skipped.
+        """
+        pc = self.pc
+        # Only hold the state while snapshotting, the jobs can take a while
+        with pc:
+            snapshotter = pc.snapshotter()
+            snapshotter.load_index()
+            if not force and not snapshotter.has_changes():
+                log.info("World hasn't changed since the last snapshot, skipping")
+                pc.state.data.setdefault('schedule', {})['skipped'] = time.time()
+                return None
+            pc.snapshot()
+            pod_id = pc.state.get_pod()
+            volumes = pc._config_volumes()
+
+        records = asyncio.run(self._run_jobs(pod_id, volumes))
+
+        with pc:
+            jobs = pc.state.data.setdefault('jobs', {})
+            for name, record in records.items():
+                history = jobs.get(name, {}).get('history', [])
+                record['history'] = (history + [record['seconds']])[-HISTORY:]
+                jobs[name] = record
+            pc.state.data.setdefault('schedule', {})['ran'] = time.time()
+        return records
+
+    def run_forever(self):
+        """
+        Run cycles on the schedule until interrupted.
+        """
+        while True:
+            try:
+                self.cycle()
+            except Exception:
+                log.exception("Backup cycle failed")
+            delay = next_delay(self.frequency)
+            log.info(f"Next backup cycle in {delay / 60:.0f} minutes")
+            time.sleep(delay)
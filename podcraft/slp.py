@@ -0,0 +1,156 @@
+"""
+Native Server List Ping client, the same handshake/status/ping exchange the
+multiplayer menu does.
+
+Packets are a varint length, a varint packet ID, and the fields. The client
+sends a handshake (next state 1, status) and a status request, and gets the
+status JSON back; then it sends a ping with an 8-byte payload, which the
+server echos.
+"""
+import json
+import math
+import socket
+import struct
+import time
+
+#: Protocol version to send in the handshake; -1 means "just tell me"
+PROTOCOL = -1
+
+STATUS_STATE = 1
+
+
+class SlpError(Exception):
+    """
+    The server didn't answer the ping properly.
+    """
+
+
+def encode_varint(value):
+    value &= 0xFFFFFFFF
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(read):
+    """
+    Read a varint, using read(n) to get bytes.
+    """
+    value = 0
+    for i in range(5):
+        byte, = read(1)
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            break
+    else:
+        raise SlpError("varint is too long")
+    if value & 0x80000000:
+        value -= 1 << 32
+    return value
+
+
+def encode_string(text):
+    data = text.encode('utf-8')
+    return encode_varint(len(data)) + data
+
+
+def encode_packet(packet_id, payload=b''):
+    body = encode_varint(packet_id) + payload
+    return encode_varint(len(body)) + body
+
+
+class _Reader:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __call__(self, n):
+        buf = b''
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise SlpError("Connection closed by server")
+            buf += chunk
+        return buf
+
+    def packet(self):
+        """
+        Read a packet, returning (packet ID, body reader).
+        """
+        return parse_packet(self(decode_varint(self)))
+
+
+def parse_packet(body):
+    """
+    Split a packet body (after the length) into (packet ID, reader), where
+    reader(n) gets the next n bytes of the fields.
+    """
+    pos = 0
+
+    def read(n):
+        nonlocal pos
+        data = body[pos:pos + n]
+        if len(data) < n:
+            raise SlpError("Packet is truncated")
+        pos += n
+        return data
+    return decode_varint(read), read
+
+
+def query(host, port, *, timeout=5):
+    """
+    Ping the server, returning the status dict and the round trip time of
+    the ping in seconds.
+    """
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = _Reader(sock)
+        handshake = (
+            encode_varint(PROTOCOL) + encode_string(host)
+            + struct.pack('>H', port) + encode_varint(STATUS_STATE)
+        )
+        sock.sendall(encode_packet(0x00, handshake) + encode_packet(0x00))
+        packet_id, read = reader.packet()
+        if packet_id != 0x00:
+            raise SlpError(f"Expected a status response, got packet {packet_id:#x}")
+        status = json.loads(read(decode_varint(read)).decode('utf-8'))
+
+        token = int(time.time() * 1000)
+        start = time.perf_counter()
+        sock.sendall(encode_packet(0x01, struct.pack('>q', token)))
+        packet_id, read = reader.packet()
+        latency = time.perf_counter() - start
+        if packet_id != 0x01 or struct.unpack('>q', read(8))[0] != token:
+            raise SlpError("Bad pong")
+        return status, latency
+
+
+def description_text(description):
+    """
+    Flatten a chat component (or plain string) description to text.
+    """
+    if isinstance(description, str):
+        return description
+    return description.get('text', '') + ''.join(
+        description_text(e) for e in description.get('extra', [])
+    )
+
+
+def percentile(ordered, q):
+    """
+    Nearest-rank percentile (q out of 100) of some sorted samples.
+    """
+    return ordered[max(math.ceil(len(ordered) * q / 100) - 1, 0)]
+
+
+def latency_stats(samples):
+    """
+    Get the min, average, and 99th percentile of some samples.
+    """
+    ordered = sorted(samples)
+    return ordered[0], sum(ordered) / len(ordered), percentile(ordered, 99)
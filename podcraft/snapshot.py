@@ -0,0 +1,259 @@
+"""
+Incremental snapshots of the live world.
+
+An index of the size and mtime of every file copied so far is kept, so only
+files that changed since the last snapshot are copied. Copies are reflinks
+where the filesystem supports them (btrfs, XFS), so unchanged blocks are
+shared and a copy is nearly free.
+
+The index also has the mtime of every directory, so whether anything changed
+can be checked by stat()ing what's in the index, without listing directories:
+a changed file has a new size or mtime, and a new or deleted file changes its
+directory's mtime. Only directories whose mtime changed are listed, to tell
+that apart from the server renaming the files it rewrites on every save.
+
+Hardlinks aren't used: the server rewrites region files in place, so a
+hardlinked snapshot would change along with the world.
+
+To keep the time the server isn't saving short, most of the copying is done
+while it's still running normally. Then saving is turned off, the world is
+flushed, and a second pass copies just what changed in the meantime.
+"""
+import collections
+import concurrent.futures
+import errno
+import fcntl
+import itertools
+import json
+import logging
+import os
+import shutil
+import time
+
+log = logging.getLogger(__name__)
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+#: Files that are rewritten on every save, whether or not the world changed
+IGNORED = frozenset({'level.dat', 'level.dat_old', 'session.lock'})
+
+
+def reflink(src, dst):
+    """
+    Make dst a copy-on-write clone of src. Raises OSError if the filesystem
+    can't.
+    """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class Snapshotter:
+    """
+    Copies changed files from one directory to another.
+    """
+    def __init__(self, source, dest, index_file, *, workers=4):
+        self.source = source
+        self.dest = dest
+        self.index_file = index_file
+        self.workers = workers
+        self._can_reflink = True
+        self.index = {}
+        self.dirs = {}
+        self._children = None
+
+    def load_index(self):
+        try:
+            with open(self.index_file, 'rt') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        self.index = data.get('files', {})
+        self.dirs = data.get('dirs', {})
+        self._children = None
+
+    def save_index(self):
+        tmp = f"{self.index_file}.tmp"
+        with open(tmp, 'wt') as f:
+            json.dump({'files': self.index, 'dirs': self.dirs}, f)
+        os.replace(tmp, self.index_file)
+
+    def reset(self):
+        """
+        Forget what's been copied, so the next sync copies everything, and
+        deletes whatever is in the destination but not in the source.
+        """
+        self.index = {}
+        self.dirs = {}
+        self._children = None
+        for dirpath, _, filenames in os.walk(self.dest):
+            for fname in filenames:
+                rel = os.path.relpath(os.path.join(dirpath, fname), self.dest)
+                self.index[rel] = None  # Never matches, so it's copied again
+
+    def has_changes(self, *, ignore=IGNORED):
+        """
+        Has the source changed since the index was made?
+
+        Files in ignore (which the server rewrites on every save) don't count.
+        """
+        if not self.index:
+            return True
+        for rel, mtime in self.dirs.items():
+            try:
+                if os.stat(os.path.join(self.source, rel)).st_mtime_ns == mtime:
+                    continue
+                listing = set(os.listdir(os.path.join(self.source, rel)))
+            except FileNotFoundError:
+                return True
+            # Saving level.dat renames files around, which changes the
+            # directory's mtime even when nothing else did
+            if listing - ignore != self._known_children(rel) - ignore:
+                return True
+        for rel, stat in self.index.items():
+            if os.path.basename(rel) in ignore:
+                continue
+            try:
+                st = os.stat(os.path.join(self.source, rel))
+            except FileNotFoundError:
+                return True
+            if [st.st_size, st.st_mtime_ns] != stat:
+                return True
+        return False
+
+    def _known_children(self, rel):
+        """
+        The names the index has directly inside a directory.
+        """
+        if self._children is None:
+            self._children = collections.defaultdict(set)
+            for path in itertools.chain(self.index, self.dirs):
+                if path != '.':
+                    parent, name = os.path.split(path)
+                    self._children[parent or '.'].add(name)
+        return self._children[rel]
+
+    def scan(self):
+        """
+        Get {relative path: (size, mtime in ns)} for the source, noting the
+        directories' mtimes along the way.
+        """
+        if not os.path.isdir(self.source):
+            # Don't mistake a missing world for a deleted one
+            raise FileNotFoundError(errno.ENOENT, "World not found", str(self.source))
+        found = {}
+        self._scanned_dirs = {}
+        for dirpath, _, filenames in os.walk(self.source):
+            self._scanned_dirs[os.path.relpath(dirpath, self.source)] = os.stat(dirpath).st_mtime_ns
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue  # Deleted out from under us
+                found[os.path.relpath(path, self.source)] = (st.st_size, st.st_mtime_ns)
+        return found
+
+    def _copy(self, rel):
+        """
+        Copy one file, returning True if it was a reflink.
+        """
+        src = os.path.join(self.source, rel)
+        dst = os.path.join(self.dest, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        # Readers of the snapshot never see half a file
+        tmp = f"{dst}.podcraft-tmp"
+        cloned = False
+        if self._can_reflink:
+            try:
+                reflink(src, tmp)
+                cloned = True
+            except OSError as exc:
+                if exc.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+                    log.debug("Can't reflink (%s), copying instead", exc)
+                    self._can_reflink = False
+                else:
+                    raise
+        if not cloned:
+            shutil.copyfile(src, tmp)
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+        return cloned
+
+    def sync(self):
+        """
+        Bring the destination up to date with the source, returning stats.
+        """
+        start = time.monotonic()
+        current = self.scan()
+        changed = [
+            rel for rel, stat in current.items()
+            if self.index.get(rel) != list(stat)
+        ]
+        removed = [rel for rel in self.index if rel not in current]
+
+        reflinked = copied = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self._copy, rel): rel for rel in changed}
+            for future in concurrent.futures.as_completed(futures):
+                rel = futures[future]
+                try:
+                    cloned = future.result()
+                except FileNotFoundError:
+                    # Deleted since the scan, the next pass will catch it
+                    current.pop(rel)
+                    continue
+                if cloned:
+                    reflinked += 1
+                copied += current[rel][0]
+                self.index[rel] = list(current[rel])
+
+        for rel in removed:
+            try:
+                os.unlink(os.path.join(self.dest, rel))
+            except FileNotFoundError:
+                pass
+            del self.index[rel]
+        self.dirs = self._scanned_dirs
+        self._children = None
+
+        return {
+            'files': len(current),
+            'changed': len(changed),
+            'reflinked': reflinked,
+            'bytes': copied,
+            'removed': len(removed),
+            'seconds': time.monotonic() - start,
+        }
+
+
+def take_snapshot(snapshotter, command, *, full=False):
+    """
+    Take a consistent snapshot, using command() to send console commands to
+    the server. Returns stats, including how long saving was paused.
+    """
+    if full:
+        snapshotter.reset()
+    else:
+        snapshotter.load_index()
+
+    # Warm pass, while the server carries on as normal
+    warm = snapshotter.sync()
+
+    command('save-off')
+    paused = time.monotonic()
+    try:
+        command('save-all flush')
+        final = snapshotter.sync()
+    finally:
+        command('save-on')
+        pause = time.monotonic() - paused
+    snapshotter.save_index()
+
+    log.info("Saving was paused for %.2fs", pause)
+    return {
+        'taken': time.time(),
+        'pause': pause,
+        'warm': warm,
+        'final': final,
+    }
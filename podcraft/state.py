@@ -4,17 +4,69 @@ Manages the statefile, which tracks things like:
 * Image IDs
 * Container IDs
 * Pod ID
+* Fingerprints of the inputs each of those were made from
+* Image inspection details (image IDs are immutable, so these never go stale)
+* The step timings of the last two builds of each image
+* The previous generation of images, containers, pod and server.properties,
+  after a blue/green rebuild, so it can be switched back to
 
 The important thing is that while none of this is critical state, it would be
 quite annoying to rebuild.
+
+The file is only locked while it's read (shared) and written (exclusive), so
+commands that only look at a project don't wait for others. Commands that
+change its resources also hold the project lock (Podcraft.exclusive()) the
+whole time, so they run one at a time. The file is only written if something
+changed: what changed is merged into whatever is in the file by then, so the
+odd bits of bookkeeping other runs did in the meantime aren't lost. It is
+replaced atomically, and the previous version is kept as a backup in case the
+file gets damaged anyway.
 """
+import contextlib
+import copy
+import fcntl
 import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+#: The keys that make up a generation of resources
+GENERATION_KEYS = ('images', 'containers', 'pod', 'fingerprints', 'generation')
+
+
+def merge(base, ours, theirs):
+    """
+    Three-way merge of JSON data: apply the changes from base to ours on top
+    of theirs. Dicts are merged key by key; anything else we changed replaces
+    theirs.
+    """
+    if ours == base:
+        return theirs
+    if not all(isinstance(d, dict) for d in (base, ours, theirs)):
+        return ours
+    result = dict(theirs)
+    for key in set(base) | set(ours):
+        if key not in ours:
+            result.pop(key, None)
+        elif key not in base:
+            result[key] = ours[key]
+        elif key not in theirs:
+            # They removed it; keep it only if we changed it
+            if ours[key] != base[key]:
+                result[key] = ours[key]
+        else:
+            result[key] = merge(base[key], ours[key], theirs[key])
+    return result
 
 
 def default_state():
     return {
         'images': {},
         'containers': {},
+        'fingerprints': {},
+        'inspect': {},
     }
 
 
@@ -26,22 +78,124 @@ class State:
     """
     def __init__(self, fname):
         self.statefile = fname
+        self._loaded = None
+        self._damaged = False
 
-    def __enter__(self):
+    @property
+    def backupfile(self):
+        return f"{os.fspath(self.statefile)}.bak"
+
+    @property
+    def lockfile(self):
+        return f"{os.fspath(self.statefile)}.lock"
+
+    def _read(self, fname):
+        with open(fname, 'rt') as sf:
+            return json.load(sf)
+
+    def peek(self):
+        """
+        Read the state without locking it, for a look at how things are.
+
+        This is safe since the file is replaced atomically, but the data can
+        be stale by the time it's used, and changes to it aren't saved.
+        """
+        for fname in (self.statefile, self.backupfile):
+            try:
+                return self._read(fname)
+            except (FileNotFoundError, ValueError):
+                pass
+        return default_state()
+
+    @contextlib.contextmanager
+    def _locked(self, mode):
+        fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log.debug("Waiting for another podcraft to finish with the state file")
+                fcntl.flock(fd, mode)
+            yield
+        finally:
+            os.close(fd)
+
+    def _load(self):
+        """
+        Read the state, recovering from the backup if needed.
+
+        Returns the data, and if the state file was damaged.
+        """
         try:
-            with open(self.statefile, 'rt') as sf:
-                self.data = json.load(sf)
-        except FileNotFoundError:
-            self.data = default_state()
-        except Exception:
-            # FIXME: Warn about the loss of state
-            ...
-            self.data = default_state()
+            return self._read(self.statefile), False
+        except Exception as exc:
+            damaged = not isinstance(exc, FileNotFoundError)
+            if damaged:
+                log.warning("State file is damaged (%s), recovering from backup", exc)
+            # A missing state file with a backup means a write was interrupted
+            try:
+                return self._read(self.backupfile), damaged
+            except FileNotFoundError:
+                return default_state(), damaged
+            except Exception:
+                log.warning("State backup is damaged too, starting from scratch")
+                return default_state(), damaged
+
+    def __enter__(self):
+        with self._locked(fcntl.LOCK_SH):
+            self.data, self._damaged = self._load()
+        self._loaded = self._serialize()
         return self
 
     def __exit__(self, type, value, tb):
-        with open(self.statefile, 'wt') as sf:
-            json.dump(self.data, sf)
+        if self.dirty:
+            self.save()
+
+    def save(self):
+        """
+        Write out the changes now, merged into what's in the file.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            theirs, self._damaged = self._load()
+            self.data = merge(json.loads(self._loaded), self.data, theirs)
+            self._write()
+
+    def _serialize(self):
+        return json.dumps(self.data, sort_keys=True)
+
+    @property
+    def dirty(self):
+        """
+        Has the data changed since it was loaded?
+        """
+        return self._serialize() != self._loaded
+
+    def _write(self):
+        """
+        Atomically replace the state file, keeping the old one as a backup.
+        """
+        blob = self._serialize()
+        tmpname = f"{os.fspath(self.statefile)}.tmp"
+        with open(tmpname, 'wt') as sf:
+            sf.write(blob)
+            sf.flush()
+            os.fsync(sf.fileno())
+        if os.path.exists(self.statefile) and not self._damaged:
+            os.replace(self.statefile, self.backupfile)
+        os.replace(tmpname, self.statefile)
+        dirfd = os.open(os.path.dirname(os.path.abspath(self.statefile)), os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        self._loaded = blob
+        self._damaged = False
+
+    def names(self):
+        """
+        All the names we have an image or container for.
+        """
+        return sorted(set(self.data['images']) | set(self.data['containers']))
 
     def save_image(self, name, img):
         """
@@ -49,6 +203,7 @@ class State:
         """
         if img is None:
             del self.data['images'][name]
+            self.save_fingerprint(f'image:{name}', None)
             return
         if isinstance(img, str):
             save = {'id': img}
@@ -76,6 +231,7 @@ class State:
         """
         if cont is None:
             del self.data['containers'][name]
+            self.save_fingerprint(f'container:{name}', None)
             return
         if isinstance(cont, str):
             save = {'id': cont}
@@ -103,6 +259,7 @@ class State:
         """
         if pod is None:
             del self.data['pod']
+            self.save_fingerprint('pod', None)
             return
         if isinstance(pod, str):
             save = {'id': pod}
@@ -127,6 +284,113 @@ class State:
         self.save_pod(obj)  # Update cache
         return obj
 
+    def save_inspect(self, image_id, details):
+        """
+        Cache the inspection details of an image.
+        """
+        self.data.setdefault('inspect', {})[image_id] = details
+
+    def get_inspect(self, image_id):
+        """
+        Get the cached inspection details of an image, or None.
+        """
+        return self.data.get('inspect', {}).get(image_id)
+
+    def forget_inspect(self, image_id):
+        """
+        Drop the cached inspection details of an image, eg because it was removed.
+        """
+        self.data.get('inspect', {}).pop(image_id, None)
+
+    def prune_inspects(self):
+        """
+        Drop the cached inspection details of images we no longer track.
+        """
+        known = {i['id'] for i in self.data['images'].values()}
+        for image_id in list(self.data.get('inspect', {})):
+            if image_id not in known:
+                self.forget_inspect(image_id)
+
+    def save_build(self, name, record):
+        """
+        Keep the record of an image build, and the one from the build before.
+        """
+        history = self.data.setdefault('builds', {}).setdefault(name, [])
+        history.insert(0, record)
+        del history[2:]
+
+    def get_builds(self, name):
+        """
+        Get the records of the last two builds of an image, newest first.
+        """
+        return self.data.get('builds', {}).get(name, [])
+
+    def save_fingerprint(self, key, fingerprint):
+        """
+        Save the fingerprint of the inputs a resource was made from.
+        """
+        fps = self.data.setdefault('fingerprints', {})
+        if fingerprint is None:
+            fps.pop(key, None)
+        else:
+            fps[key] = fingerprint
+
+    def get_fingerprint(self, key):
+        """
+        Get the fingerprint a resource was made from, or None.
+        """
+        return self.data.get('fingerprints', {}).get(key)
+
+    def generation(self):
+        """
+        A copy of the current generation of resources.
+        """
+        return {k: copy.deepcopy(self.data[k]) for k in GENERATION_KEYS if k in self.data}
+
+    def generation_number(self):
+        """
+        The number of the newest generation.
+        """
+        return max(
+            gen.get('generation', {}).get('number', 0)
+            for gen in (self.data, self.data.get('previous', {}))
+        )
+
+    def get_previous(self):
+        """
+        Get the previous generation, or None.
+        """
+        return self.data.get('previous')
+
+    def switch_generation(self, gen):
+        """
+        Make gen the current generation, keeping the current one (if there is
+        one) as the previous.
+
+        Returns the generation that was previous until now, unless that's gen,
+        so its resources can be removed. Otherwise returns None.
+        """
+        previous = self.data.pop('previous', None)
+        if 'pod' in self.data:
+            self.data['previous'] = self.generation()
+        for key in GENERATION_KEYS:
+            if key in gen:
+                self.data[key] = copy.deepcopy(gen[key])
+            else:
+                self.data.pop(key, None)
+        return previous if previous != gen else None
+
+    def generation_images(self):
+        """
+        The IDs of the images used by the current or previous generation.
+        """
+        previous = self.data.get('previous', {})
+        return {
+            i['id']
+            for images in (self.data['images'], previous.get('images', {}))
+            for i in images.values()
+        }
+
     def should_rebuild_container(self, name, *, client=None):
         """
         Is there a new image for this container?
@@ -0,0 +1,109 @@
+"""
+Spans for finding out where a command spends its time.
+
+The hooks stay in the code: while tracing is off, span() just hands back a
+shared do-nothing context manager. podcraft --profile turns it on, and
+writes the spans out as Chrome trace events (for chrome://tracing or
+https://ui.perfetto.dev) when the command finishes.
+"""
+import contextlib
+import os
+import threading
+import time
+
+_NULL = contextlib.nullcontext()
+
+#: The Recorder in use, or None if tracing is off
+_recorder = None
+
+
+class Recorder:
+    """
+    Collects finished spans, from any thread.
+    """
+    def __init__(self, *, clock=time.perf_counter):
+        self.clock = clock
+        self.origin = clock()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, args):
+        with self._lock:
+            self.spans.append((name, start - self.origin, end - start, threading.get_ident(), args))
+
+    def trace_events(self):
+        """
+        The spans as Chrome trace "complete" events.
+        """
+        pid = os.getpid()
+        return [
+            {
+                'name': name, 'cat': 'podcraft', 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': start * 1e6, 'dur': duration * 1e6, 'args': args,
+            }
+            for name, start, duration, tid, args in self.spans
+        ]
+
+    def summary(self):
+        """
+        Generates (name, count, total seconds, longest seconds) for each kind
+        of span, the slowest first.
+        """
+        totals = {}
+        for name, _, duration, _, _ in self.spans:
+            count, total, longest = totals.get(name, (0, 0, 0))
+            totals[name] = (count + 1, total + duration, max(longest, duration))
+        for name, (count, total, longest) in sorted(totals.items(), key=lambda i: -i[1][1]):
+            yield name, count, total, longest
+
+
+class _Span:
+    __slots__ = ('recorder', 'name', 'args', 'start')
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.recorder.clock()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.recorder.add(self.name, self.start, self.recorder.clock(), self.args)
+
+
+def span(name, **args):
+    """
+    Time the body of a with block, if tracing is on. args are kept with it.
+    """
+    if _recorder is None:
+        return _NULL
+    return _Span(_recorder, name, args)
+
+
+def start():
+    """
+    Turn tracing on, returning the Recorder.
+    """
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def stop():
+    """
+    Turn tracing off, returning the Recorder that was in use (or None).
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def format_summary(recorder):
+    """
+    Generates the lines of a table of where the time went.
+    """
+    yield f"{'span':<32} {'count':>5} {'total':>9} {'longest':>9}"
+    for name, count, total, longest in recorder.summary():
+        yield f"{name[:32]:<32} {count:>5} {total:>8.3f}s {longest:>8.3f}s"
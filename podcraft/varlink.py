@@ -0,0 +1,187 @@
+"""
+Just enough of the varlink protocol to talk to podman directly.
+
+Messages are JSON objects, each terminated by a NUL byte. A call looks like
+{"method": "io.podman.GetPod", "parameters": {...}}, and the reply is either
+{"parameters": {...}} or {"error": "io.podman.PodNotFound", "parameters": {...}}.
+
+Upgraded calls (ExecContainer) switch the connection to podman's own framing
+after the reply: each frame is a destination byte, three bytes of padding, a
+big-endian 32-bit length, and then that many bytes of data. The exit code is
+sent as the 4-byte payload of a QUIT frame.
+"""
+import json
+import socket
+import struct
+
+from .tracing import span
+
+# Exec stream destinations
+STDOUT = 0
+STDIN = 1
+STDERR = 2
+TERMINAL_RESIZE = 3
+QUIT = 4
+HANG_UP = 5
+
+FRAME_HEADER = struct.Struct('>B3xI')
+EXIT_CODE = struct.Struct('>I')
+
+
+class VarlinkError(Exception):
+    """
+    The service replied with an error.
+    """
+    def __init__(self, error, parameters=None):
+        super().__init__(error, parameters or {})
+        self.error = error
+        self.parameters = parameters or {}
+
+    def __str__(self):
+        reason = self.parameters.get('reason')
+        return f"{self.error}: {reason}" if reason else self.error
+
+
+class NotFound(VarlinkError):
+    """
+    Something podman was asked about doesn't exist.
+    """
+
+
+class ContainerNotFound(NotFound):
+    pass
+
+
+class ImageNotFound(NotFound):
+    pass
+
+
+class PodNotFound(NotFound):
+    pass
+
+
+ERRORS = {
+    'io.podman.ContainerNotFound': ContainerNotFound,
+    'io.podman.ImageNotFound': ImageNotFound,
+    'io.podman.PodNotFound': PodNotFound,
+}
+
+
+def encode_call(method, parameters=None, *, upgrade=False):
+    """
+    Serialize a method call.
+    """
+    msg = {'method': method}
+    if parameters:
+        msg['parameters'] = parameters
+    if upgrade:
+        msg['upgrade'] = True
+    return json.dumps(msg).encode('utf-8') + b'\0'
+
+
+def decode_reply(data):
+    """
+    Deserialize a reply (without its terminating NUL), returning the
+    parameters or raising the error.
+    """
+    msg = json.loads(data.decode('utf-8'))
+    if 'error' in msg:
+        raise ERRORS.get(msg['error'], VarlinkError)(msg['error'], msg.get('parameters'))
+    return msg.get('parameters', {})
+
+
+def encode_frame(dest, data):
+    """
+    Serialize an exec stream frame.
+    """
+    return FRAME_HEADER.pack(dest, len(data)) + data
+
+
+def fold_keys(mapping):
+    """
+    Case-fold the keys of a dict, as the podman library does for inspections.
+    """
+    return {k.casefold(): v for k, v in mapping.items()}
+
+
+def split_address(address):
+    """
+    Get the socket path from a unix: varlink address.
+    """
+    if not address.startswith('unix:'):
+        raise ValueError(f"Only unix: varlink addresses are supported, not {address!r}")
+    return address[len('unix:'):].split(';', 1)[0]
+
+
+def exec_opts(ident, cmd, *, user=None, workdir=None, env=None):
+    """
+    Build the options for ExecContainer.
+    """
+    opts = {
+        'name': ident,
+        'tty': False,
+        'privileged': False,
+        'cmd': list(cmd),
+    }
+    if user is not None:
+        opts['user'] = user
+    if workdir is not None:
+        opts['workdir'] = workdir
+    if env is not None:
+        opts['env'] = [f'{k}={v}' for k, v in env.items()]
+    return opts
+
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Exec stream ended without an exit code")
+        buf += chunk
+    return bytes(buf)
+
+
+def _recv_reply(sock):
+    reply = bytearray()
+    while not reply.endswith(b'\0'):
+        chunk = sock.recv(1)
+        if not chunk:
+            raise ConnectionError("Connection closed before the reply")
+        reply += chunk
+    return decode_reply(bytes(reply[:-1]))
+
+
+def call(address, method, parameters=None, *, timeout=None):
+    """
+    Call a method on a blocking connection, returning the reply parameters.
+
+    For one-off calls where a whole client would be overkill.
+    """
+    with span(f'varlink {method}'), socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(split_address(address))
+        sock.sendall(encode_call(method, parameters))
+        return _recv_reply(sock)
+
+
+def exec_container(address, opts, *, output=None):
+    """
+    Run ExecContainer on a blocking connection, returning the exit code.
+
+    output is called with (stream, data) as output arrives.
+    """
+    with span('varlink io.podman.ExecContainer'), \
+            socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(split_address(address))
+        sock.sendall(encode_call('io.podman.ExecContainer', {'opts': opts}, upgrade=True))
+        _recv_reply(sock)
+
+        while True:
+            dest, length = FRAME_HEADER.unpack(_recv_exactly(sock, FRAME_HEADER.size))
+            data = _recv_exactly(sock, length)
+            if dest in (STDOUT, STDERR):
+                if output is not None:
+                    output(dest, data)
+            elif dest in (QUIT, HANG_UP):
+                return EXIT_CODE.unpack(data)[0] if len(data) == EXIT_CODE.size else 0
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import socket
+import threading
+
+import pytest
+
+from podcraft.aiopodman import AsyncClient
+from podcraft.varlink import (
+    STDOUT, STDERR, QUIT, ContainerNotFound, encode_frame, exec_container, exec_opts,
+)
+
+
+class FakePodman:
+    """
+    A varlink server with just enough of io.podman for the tests.
+    """
+    def __init__(self):
+        self.calls = []
+        self.pods = {}
+        self.containers = {'c1': {'id': 'c1'}, 'c2': {'id': 'c2'}}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, reader, writer):
+        while True:
+            try:
+                msg = json.loads((await reader.readuntil(b'\0'))[:-1])
+            except asyncio.IncompleteReadError:
+                break
+            method = msg['method'].split('.')[-1]
+            params = msg.get('parameters', {})
+            self.calls.append((method, params))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            reply = getattr(self, method)(**params)
+            writer.write(json.dumps(reply).encode() + b'\0')
+            if method == 'ExecContainer':
+                writer.write(encode_frame(STDOUT, b'hello '))
+                writer.write(encode_frame(STDERR, b'world'))
+                writer.write(encode_frame(QUIT, (3).to_bytes(4, 'big')))
+                await writer.drain()
+                break
+            await writer.drain()
+        writer.close()
+
+    def CreatePod(self, create):
+        self.pods['p1'] = dict(create, id='p1', status='Created')
+        return {'parameters': {'pod': 'p1'}}
+
+    def GetPod(self, name):
+        return {'parameters': {'pod': self.pods[name]}}
+
+    def RemoveContainer(self, name, force):
+        if name not in self.containers:
+            return {'error': 'io.podman.ContainerNotFound', 'parameters': {'id': name}}
+        del self.containers[name]
+        return {'parameters': {'container': name}}
+
+    def ExecContainer(self, opts):
+        return {'parameters': {}}
+
+
+@pytest.fixture
+def run(tmp_path):
+    def run(coro_fn):
+        async def main():
+            server = await asyncio.start_unix_server(fake.handle, str(tmp_path / 'io.podman'))
+            try:
+                async with AsyncClient(f'unix:{tmp_path}/io.podman') as client:
+                    return await coro_fn(client)
+            finally:
+                server.close()
+                await server.wait_closed()
+        return asyncio.run(main())
+    fake = FakePodman()
+    run.fake = fake
+    return run
+
+
+def test_create_and_get_pod(run):
+    async def go(client):
+        pod_id = await client.create_pod(publish=['25565:25565'])
+        return await client.get_pod(pod_id)
+    pod = run(go)
+    assert pod['id'] == 'p1'
+    assert pod['infra'] is True
+    assert 'name' not in pod
+
+
+def test_errors(run):
+    async def go(client):
+        await client.remove_container('nope', force=True)
+    with pytest.raises(ContainerNotFound):
+        run(go)
+
+
+def test_concurrent(run):
+    async def go(client):
+        await asyncio.gather(
+            client.remove_container('c1', force=True),
+            client.remove_container('c2', force=True),
+        )
+    run(go)
+    assert run.fake.containers == {}
+    assert run.fake.max_in_flight == 2
+
+
+def test_exec(run):
+    output = []
+
+    async def go(client):
+        return await client.exec('c1', ['echo', 'hi'], output=lambda s, d: output.append((s, d)))
+    assert run(go) == 3
+    assert output == [(STDOUT, b'hello '), (STDERR, b'world')]
+    assert run.fake.calls[-1] == (
+        'ExecContainer',
+        {'opts': {'name': 'c1', 'tty': False, 'privileged': False, 'cmd': ['echo', 'hi']}},
+    )
+
+
+def test_sync_exec(tmp_path):
+    path = str(tmp_path / 'podman.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    calls = []
+
+    def serve():
+        conn, _ = listener.accept()
+        with conn:
+            buf = b''
+            while not buf.endswith(b'\0'):
+                buf += conn.recv(4096)
+            calls.append(json.loads(buf[:-1]))
+            conn.sendall(b'{"parameters": {}}\0')
+            conn.sendall(encode_frame(STDOUT, b'line 1\n'))
+            conn.sendall(encode_frame(STDERR, b'oops\n'))
+            conn.sendall(encode_frame(STDOUT, b'line 2\n'))
+            conn.sendall(encode_frame(QUIT, (7).to_bytes(4, 'big')))
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    seen = []
+    rc = exec_container(
+        f'unix:{path}', exec_opts('c1', ['echo', 'hi'], workdir='/data'),
+        output=lambda stream, data: seen.append((stream, data)),
+    )
+    thread.join()
+    listener.close()
+    assert rc == 7
+    assert seen == [(STDOUT, b'line 1\n'), (STDERR, b'oops\n'), (STDOUT, b'line 2\n')]
+    assert calls[0]['method'] == 'io.podman.ExecContainer'
+    assert calls[0]['upgrade'] is True
+    assert calls[0]['parameters']['opts'] == {
+        'name': 'c1', 'tty': False, 'privileged': False,
+        'cmd': ['echo', 'hi'], 'workdir': '/data',
+    }
@@ -0,0 +1,114 @@
+import fcntl
+import os
+import threading
+import zlib
+
+import pytest
+
+from podcraft.backup import (
+    BackupStore, GZIP, ZLIB, MAX_SECTORS, SECTOR, read_region, write_region,
+)
+
+
+def make_region(chunks):
+    timestamps = [0] * 1024
+    for index in chunks:
+        timestamps[index] = 1000 + index
+    return write_region(timestamps, chunks)
+
+
+def test_region_round_trip():
+    chunks = {
+        0: (ZLIB, b'nbt zero' * 100),
+        5: (GZIP, b'nbt five'),
+        1023: (ZLIB, os.urandom(10000)),
+        7: (None, b'\x04lz4 data, kept as is'),
+    }
+    data = make_region(chunks)
+    assert len(data) % 4096 == 0
+    timestamps, parsed = read_region(data)
+    assert parsed == chunks
+    assert timestamps[5] == 1005
+
+
+def test_dedup_restore_and_prune(tmp_path):
+    world = tmp_path / 'world'
+    (world / 'region').mkdir(parents=True)
+    (world / 'level.dat').write_bytes(b'level')
+    (world / 'region' / 'r.0.0.mca').write_bytes(make_region({
+        i: (ZLIB, f'chunk {i}'.encode() * 50) for i in range(10)
+    }))
+    store = BackupStore(str(tmp_path / 'store'), workers=4)
+
+    first, stats = store.backup(str(world), 'first')
+    assert stats['new_objects'] == 11
+
+    # Change one chunk
+    chunks = {i: (ZLIB, f'chunk {i}'.encode() * 50) for i in range(10)}
+    chunks[3] = (ZLIB, b'changed')
+    region = make_region(chunks)
+    (world / 'region' / 'r.0.0.mca').write_bytes(region)
+    second, stats = store.backup(str(world), 'second')
+    assert stats['new_objects'] == 1
+    assert store.manifests() == ['first', 'second']
+
+    store.restore('first', str(tmp_path / 'restored'))
+    _, chunks = read_region((tmp_path / 'restored' / 'region' / 'r.0.0.mca').read_bytes())
+    assert chunks[3] == (ZLIB, b'chunk 3' * 50)
+    assert (tmp_path / 'restored' / 'level.dat').read_bytes() == b'level'
+
+    assert store.prune(keep=1) == (1, 1)
+    store.restore('second', str(tmp_path / 'again'))
+    # The chunks are recompressed the same way, so it comes out identical
+    assert (tmp_path / 'again' / 'region' / 'r.0.0.mca').read_bytes() == region
+
+
+def test_huge_chunks(tmp_path):
+    # Big enough to be close to the limit, compressed
+    huge = os.urandom(MAX_SECTORS * SECTOR - 20000)
+    data = make_region({0: (ZLIB, huge), 1: (ZLIB, b'small')})
+    timestamps, chunks = read_region(data)
+    # Kept compressed as it was, in case recompressing it doesn't fit
+    assert chunks[0][0] is None
+    assert zlib.decompress(chunks[0][1][1:]) == huge
+    assert chunks[1] == (ZLIB, b'small')
+    assert write_region(timestamps, chunks) == data
+
+    with pytest.raises(ValueError):
+        write_region([0] * 1024, {0: (None, bytes(MAX_SECTORS * SECTOR))})
+
+
+def test_default_names_unique(tmp_path):
+    world = tmp_path / 'world'
+    world.mkdir()
+    (world / 'level.dat').write_bytes(b'level')
+    store = BackupStore(str(tmp_path / 'store'))
+    names = [store.backup(str(world))[0] for _ in range(12)]
+    assert len(set(names)) == 12
+    assert store.manifests() == names
+    with pytest.raises(FileExistsError):
+        store.backup(str(world), names[0])
+    assert not any(n.endswith('.tmp') for n in os.listdir(tmp_path / 'store' / 'manifests'))
+
+
+def test_prune_waits_for_backups(tmp_path):
+    store = BackupStore(str(tmp_path / 'store'))
+    pruned = threading.Event()
+    thread = threading.Thread(target=lambda: (store.prune(keep=1), pruned.set()))
+    with store._locked(fcntl.LOCK_SH):
+        thread.start()
+        assert not pruned.wait(0.2)
+    thread.join(5)
+    assert pruned.is_set()
+
+
+def test_prune_keeps_at_least_one(tmp_path):
+    world = tmp_path / 'world'
+    world.mkdir()
+    (world / 'level.dat').write_bytes(b'level')
+    store = BackupStore(str(tmp_path / 'store'))
+    store.backup(str(world), 'only')
+    for keep in (0, -1):
+        with pytest.raises(ValueError):
+            store.prune(keep)
+    assert store.manifests() == ['only']
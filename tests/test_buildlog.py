@@ -0,0 +1,71 @@
+import logging
+import subprocess
+import sys
+
+import pytest
+
+from podcraft.buildlog import BuildLog, report
+from podcraft.images import _run_streamed
+
+OUTPUT = """\
+STEP 1: FROM docker.io/library/openjdk:11
+STEP 2: RUN apk add curl
+--> Using cache 3f2a8c
+STEP 3: RUN ./download-server
+fetching...
+STEP 4: COMMIT server
+"""
+
+
+class FakeClock:
+    def __init__(self, times):
+        self.times = iter(times)
+
+    def __call__(self):
+        return next(self.times)
+
+
+def test_steps():
+    buildlog = BuildLog(clock=FakeClock([0, 0, 1, 1.5, 2, 10, 10.5, 11]))
+    buildlog.start()
+    for line in OUTPUT.splitlines():
+        buildlog.feed(line)
+    buildlog.finish('built')
+    assert buildlog.seconds == 11
+    assert [(s['step'], s['total'], s['seconds'], s['cached']) for s in buildlog.steps] == [
+        (1, 4, 1, False),
+        (2, 4, 1, True),
+        (3, 4, 8.5, False),
+        (4, 4, 0.5, False),
+    ]
+
+    newer = BuildLog(clock=FakeClock([0, 0, 1, 2, 3, 4, 5, 6]))
+    newer.start()
+    for line in OUTPUT.replace('STEP 3: RUN ./download-server', 'STEP 3: RUN ./download-server --fast').splitlines():
+        newer.feed(line)
+    newer.finish('built')
+    lines = list(report('server', [newer.record(), buildlog.record()]))
+    assert lines[0] == 'server: built in 6.0s (before: built in 11.0s)'
+    assert lines[2] == '    2/4       2.0s    +1.0s cached  RUN apk add curl'
+    # The changed step has nothing to compare with
+    assert lines[3] == '    3/4       2.0s                  RUN ./download-server --fast'
+
+
+def test_failure_log(tmp_path, caplog):
+    path = tmp_path / 'logs' / 'server.log'
+    buildlog = BuildLog(str(path))
+    buildlog.start()
+    script = f"print({OUTPUT!r}, end=''); raise SystemExit(3)"
+    with caplog.at_level(logging.ERROR), pytest.raises(subprocess.CalledProcessError):
+        _run_streamed([sys.executable, '-c', script], name='server', buildlog=buildlog)
+    buildlog.finish('failed')
+    assert path.read_text() == OUTPUT
+    assert '[server] STEP 4: COMMIT server' in caplog.text
+    assert len(buildlog.steps) == 4
+
+    # Successful builds don't leave a log behind
+    buildlog = BuildLog(str(path))
+    buildlog.start()
+    buildlog.feed('STEP 1: FROM scratch')
+    buildlog.finish('built')
+    assert not path.exists()
@@ -0,0 +1,98 @@
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+from podcraft.cache import ContextCache, NotCached
+
+
+class TarballHandler(http.server.BaseHTTPRequestHandler):
+    body = b'not really a tarball' * 100
+    requests = []
+
+    def do_GET(self):
+        etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    TarballHandler.requests = []
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), TarballHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_revalidates_with_etag(server, tmp_path):
+    cache = ContextCache(tmp_path)
+    first = cache.fetch(f'{server}/a.tar.gz')
+    assert first.read_bytes() == TarballHandler.body
+    assert first.name == 'sha256-' + hashlib.sha256(TarballHandler.body).hexdigest()
+
+    second = cache.fetch(f'{server}/a.tar.gz')
+    assert second == first
+    assert TarballHandler.requests[0][1] is None
+    assert TarballHandler.requests[1][1] is not None
+
+
+def test_same_content_stored_once(server, tmp_path):
+    cache = ContextCache(tmp_path)
+    assert cache.fetch(f'{server}/a.tar.gz') == cache.fetch(f'{server}/b.tar.gz')
+    assert len(list((tmp_path / 'blobs').iterdir())) == 1
+
+
+def test_offline(server, tmp_path):
+    ContextCache(tmp_path).fetch(f'{server}/a.tar.gz')
+    offline = ContextCache(tmp_path, offline=True)
+    assert offline.fetch(f'{server}/a.tar.gz').read_bytes() == TarballHandler.body
+    assert len(TarballHandler.requests) == 1
+    with pytest.raises(NotCached):
+        offline.fetch(f'{server}/other.tar.gz')
+
+
+def test_cached_digest_does_not_download(server, tmp_path):
+    cache = ContextCache(tmp_path)
+    assert cache.cached_digest(f'{server}/a.tar.gz') is None
+    digest = cache.digest(f'{server}/a.tar.gz')
+    assert cache.cached_digest(f'{server}/a.tar.gz') == digest
+    assert len(TarballHandler.requests) == 1
+
+
+def test_lru_eviction(server, tmp_path):
+    cache = ContextCache(tmp_path, max_size=len(TarballHandler.body) + 1)
+    old = cache.fetch(f'{server}/a.tar.gz')
+    TarballHandler.body = b'something newer' * 100
+    try:
+        new = cache.fetch(f'{server}/b.tar.gz')
+    finally:
+        TarballHandler.body = b'not really a tarball' * 100
+    assert new.exists()
+    assert not old.exists()
+    with pytest.raises(NotCached):
+        ContextCache(tmp_path, offline=True).fetch(f'{server}/a.tar.gz')
+
+
+def test_open_streams_and_caches(server, tmp_path):
+    cache = ContextCache(tmp_path)
+    with cache.open(f'{server}/a.tar.gz') as f:
+        assert f.read(10) == TarballHandler.body[:10]
+    # Whatever wasn't read still ends up cached
+    offline = ContextCache(tmp_path, offline=True)
+    with offline.open(f'{server}/a.tar.gz') as f:
+        assert f.read() == TarballHandler.body
@@ -0,0 +1,60 @@
+import pytest
+
+from podcraft.config import Config, ConfigError
+
+
+def make(**resources):
+    return Config({'properties': {}, 'server': {}, 'management': {}, 'volumes': {}, 'resources': resources})
+
+
+def test_container_options():
+    config = make(server={
+        'memory': '6g', 'cpus': 3.5, 'cpuset': '2-5', 'blkio-weight': 800, 'pids-limit': 4096,
+    })
+    assert config.container_options('server') == {
+        'memory': '6g',
+        'cpus': 3.5,
+        'cpuSetCpus': '2-5',
+        'blkioWeight': '800',
+        'pidsLimit': 4096,
+    }
+    assert config.container_options('manager') == {}
+    assert config.pod_options() == {}
+    assert make(**{'cgroup-parent': 'mc.slice'}).pod_options() == {'cgroupparent': 'mc.slice'}
+
+
+@pytest.mark.parametrize('settings', [
+    {'memroy': '1g'},
+    {'memory': 'lots'},
+    {'cpuset': '1-'},
+    {'blkio-weight': 5000},
+])
+def test_bad_resources(settings):
+    with pytest.raises(ValueError):
+        make(server=settings).container_options('server')
+
+
+def test_unknown_resources_container():
+    config = make(sever={'memory': '6g'})
+    with pytest.raises(ConfigError, match='sever'):
+        config.container_options('server')
+    with pytest.raises(ValueError):
+        config.pod_options()
+
+    config['addon'] = [{'image': 'example/map'}]
+    config['resources'] = {'addon-0': {'memory': '1g'}, 'cgroup-parent': 'mc.slice'}
+    assert config.container_options('addon-0') == {'memory': '1g'}
+    config['resources']['addon-1'] = {'memory': '1g'}
+    with pytest.raises(ValueError, match='addon-1'):
+        config.container_options('addon-0')
+
+
+def test_config_errors_reported(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    from podcraft.cli import main
+
+    (tmp_path / 'podcraft.toml').write_text('[jvm]\nauto = true\nheap = "lots"\n')
+    monkeypatch.chdir(tmp_path)
+    result = CliRunner().invoke(main, ['jvm'])
+    assert result.exit_code == 1
+    assert result.output == "Error in podcraft.toml: Can't understand size 'lots'\n"
@@ -0,0 +1,86 @@
+import pytest
+
+from podcraft import fleet
+from podcraft.fleet import Result, OK, NOT_OK, ERROR
+
+
+def make_project(path):
+    path.mkdir(parents=True)
+    (path / 'podcraft.toml').write_text('')
+    return path
+
+
+def test_find_projects(tmp_path):
+    b = make_project(tmp_path / 'b')
+    a = make_project(tmp_path / 'a')
+    make_project(tmp_path / 'a' / 'nested')
+    make_project(tmp_path / '.hidden')
+    c = make_project(tmp_path / 'deeper' / 'c')
+    (tmp_path / 'empty').mkdir()
+
+    found = list(fleet.find_projects([tmp_path, a]))
+    assert found == [str(a), str(b), str(c)]
+
+
+class FakePodcraft:
+    def __init__(self, path, podman_address):
+        self.path = path
+        self.address = podman_address
+        self.entered = False
+
+    def __enter__(self):
+        self.entered = True
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+@pytest.fixture
+def fake_fleet(monkeypatch):
+    def op(pc, args):
+        assert pc.entered
+        if pc.path == 'broken':
+            raise RuntimeError("no such pod")
+        return (NOT_OK if pc.path == 'stopped' else OK), ' '.join(args)
+
+    monkeypatch.setattr(fleet, 'Podcraft', FakePodcraft)
+    monkeypatch.setattr(fleet, 'OPERATIONS', {'test': op})
+
+
+def test_run(fake_fleet):
+    results = list(fleet.run(
+        ['one', 'broken', 'stopped'], 'test', ['say', 'hi'],
+        address='unix:/fake', workers=2,
+    ))
+    assert [r.project for r in results] == ['one', 'broken', 'stopped']
+    assert [r.rc for r in results] == [OK, ERROR, NOT_OK]
+    assert results[0].detail == 'say hi'
+    assert results[1].detail == "RuntimeError: no such pod"
+    assert fleet.summarize(results) == ERROR
+
+
+def test_summarize():
+    assert fleet.summarize([]) == OK
+    assert fleet.summarize([Result('a', OK, '', 0)]) == OK
+    assert fleet.summarize([
+        Result('a', NOT_OK, '', 0), Result('b', OK, '', 0),
+    ]) == NOT_OK
+
+
+def test_format_table():
+    lines = list(fleet.format_table([
+        Result('/srv/survival', OK, 'running', 0.5),
+        Result('/srv/c', ERROR, 'Error:\nit broke', 12.345),
+    ]))
+    assert lines == [
+        'PROJECT        RESULT  TIME    DETAIL',
+        '/srv/survival  ok      0.50s   running',
+        '/srv/c         error   12.35s  Error: / it broke',
+        '2 projects: 1 ok, 0 not ok, 1 errors',
+    ]
+
+
+def test_operations_match_cli_choices():
+    from podcraft.choices import FLEET_OPERATIONS
+    assert sorted(fleet.OPERATIONS) == sorted(FLEET_OPERATIONS)
@@ -0,0 +1,138 @@
+import collections
+import io
+import sys
+import tarfile
+import threading
+import time
+import types
+
+import pytest
+
+from podcraft.images import (
+    BuildCancelled, Cancellation, _run_streamed, build_images, extract_stream, get_ports,
+    get_volumes, restream,
+)
+from podcraft.state import State, default_state
+
+
+class FakeImage:
+    id = 'abc123'
+    inspects = 0
+
+    def inspect(self):
+        FakeImage.inspects += 1
+        obj = {
+            'id': self.id,
+            'config': {
+                'volumes': {'/mc/world': {}},
+                'exposedports': {'8080/tcp': {}},
+            },
+        }
+        return collections.namedtuple('ImageInspect', obj.keys())(**obj)
+
+
+def test_inspect_cached_in_state():
+    state = State(None)
+    state.data = default_state()
+    img = FakeImage()
+    assert list(get_volumes(img, state=state)) == ['/mc/world']
+    assert list(get_ports(img, state=state)) == ['8080/tcp']
+    assert list(get_volumes(img, state=state)) == ['/mc/world']
+    assert FakeImage.inspects == 1
+
+    state.forget_inspect(img.id)
+    list(get_volumes(img, state=state))
+    assert FakeImage.inspects == 2
+
+
+FakePodman = types.SimpleNamespace(images=types.SimpleNamespace(get=lambda ref: f'image {ref}'))
+
+
+def test_failed_build_cancels_the_rest():
+    events = []
+    quick_done = threading.Event()
+
+    def quick(name, cancel, verbose):
+        quick_done.set()
+        return 'quick-ref'
+
+    def fails(name, cancel, verbose):
+        quick_done.wait(5)
+        time.sleep(0.1)
+        raise RuntimeError("build failed")
+
+    def blocks(name, cancel, verbose):
+        while not cancel.cancelled:
+            time.sleep(0.01)
+        events.append('blocker stopped')
+        cancel.check()
+
+    built = []
+    with pytest.raises(RuntimeError):
+        for name, img in build_images(FakePodman, {'quick': quick, 'fails': fails, 'blocks': blocks}):
+            built.append((name, img))
+            events.append(f'yielded {name}')
+    events.append('raised')
+    assert built == [('quick', 'image quick-ref')]
+    # The blocked build was stopped and waited for before the error came out
+    assert events == ['yielded quick', 'blocker stopped', 'raised']
+
+
+def test_cancel_stops_process():
+    cancel = Cancellation()
+    threading.Timer(0.2, cancel.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(BuildCancelled):
+        _run_streamed([sys.executable, '-c', 'import time; time.sleep(30)'], name='slow', cancel=cancel)
+    assert time.monotonic() - start < 10
+
+    # Nothing new is started once cancelled
+    with pytest.raises(BuildCancelled):
+        _run_streamed([sys.executable, '-c', 'pass'], name='late', cancel=cancel)
+
+
+def github_tarball():
+    """
+    Like GitHub's archives, everything is in one top directory.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        def add(name, data=b'', **attrs):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            for k, v in attrs.items():
+                setattr(info, k, v)
+            tar.addfile(info, io.BytesIO(data))
+
+        add('repo-abc123', type=tarfile.DIRTYPE)
+        add('repo-abc123/Dockerfile', b'FROM scratch\n')
+        add('repo-abc123/conf', type=tarfile.DIRTYPE)
+        add('repo-abc123/conf/server.toml', b'x = 1\n')
+        add('repo-abc123/conf/copy.toml', type=tarfile.LNKTYPE, linkname='repo-abc123/conf/server.toml')
+        add('repo-abc123/../escaped', b'bad')
+        add('repo-abc123//etc/absolute', b'bad')
+    buf.seek(0)
+    return buf
+
+
+def test_extract_stream(tmp_path):
+    dest = tmp_path / 'context'
+    dest.mkdir()
+    extract_stream(github_tarball(), str(dest))
+    assert sorted(str(p.relative_to(dest)) for p in dest.rglob('*')) == [
+        'Dockerfile', 'conf', 'conf/copy.toml', 'conf/server.toml',
+    ]
+    assert (dest / 'conf' / 'copy.toml').read_bytes() == b'x = 1\n'
+    assert not (tmp_path / 'escaped').exists()
+
+
+def test_restream():
+    out = io.BytesIO()
+    restream(github_tarball(), out)
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode='r:') as tar:
+        members = {m.name: m for m in tar}
+        assert sorted(members) == ['Dockerfile', 'conf', 'conf/copy.toml', 'conf/server.toml']
+        assert members['conf/copy.toml'].islnk()
+        assert members['conf/copy.toml'].linkname == 'conf/server.toml'
+        assert tar.extractfile('Dockerfile').read() == b'FROM scratch\n'
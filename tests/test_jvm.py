@@ -0,0 +1,109 @@
+import pytest
+
+from podcraft import jvm
+from podcraft.config import Config
+
+GiB = 2 ** 30
+
+
+def make(server=None, **jvm_settings):
+    return Config({'resources': {'server': server or {}}, 'jvm': jvm_settings})
+
+
+def flag(options, prefix):
+    return [o for o in options if o.startswith(prefix)]
+
+
+def test_parse_size():
+    assert jvm.parse_size('512m') == 512 * 2 ** 20
+    assert jvm.parse_size('6G') == 6 * GiB
+    assert jvm.parse_size('1.5g') == int(1.5 * GiB)
+    assert jvm.count_cpuset('0-3,6') == 5
+
+
+def test_cgroup_limits(tmp_path):
+    (tmp_path / 'user.slice' / 'mc').mkdir(parents=True)
+    (tmp_path / 'user.slice' / 'memory.max').write_text(f'{8 * GiB}\n')
+    (tmp_path / 'user.slice' / 'cpu.max').write_text('max 100000\n')
+    (tmp_path / 'user.slice' / 'mc' / 'memory.max').write_text('max\n')
+    (tmp_path / 'user.slice' / 'mc' / 'cpu.max').write_text('250000 100000\n')
+    memory, cpus, where = jvm.cgroup_limits('/user.slice/mc', root=str(tmp_path))
+    assert memory == 8 * GiB
+    assert cpus == 2.5
+    assert where == {'memory': '/user.slice', 'cpus': '/user.slice/mc'}
+    assert jvm.cgroup_limits('/missing', root=str(tmp_path))[:2] == (None, None)
+
+
+def test_container_limit():
+    options, steps = jvm.derive(
+        make({'memory': '6g', 'cpus': 3.5}),
+        cgroups=[(16 * GiB, None, {'memory': '/'})], host_ram=32 * GiB,
+    )
+    # 6 GiB less 15%, rounded down to 256 MiB
+    assert options[:2] == ['-Xms5120m', '-Xmx5120m']
+    assert flag(options, '-XX:ActiveProcessorCount') == ['-XX:ActiveProcessorCount=4']
+    assert flag(options, '-XX:G1HeapRegionSize') == ['-XX:G1HeapRegionSize=8M']
+    assert steps[0] == ('memory', '6144 MiB', '[resources.server] memory')
+
+
+def test_shared_memory():
+    options, steps = jvm.derive(make(), cgroups=[], host_ram=4 * GiB, host_cpus=8)
+    # 4 GiB less 1 GiB for everything else
+    assert options[:2] == ['-Xms3072m', '-Xmx3072m']
+    assert not flag(options, '-XX:ActiveProcessorCount')
+    assert steps[0].reason == 'host RAM'
+
+
+def test_large_heap():
+    options, _ = jvm.derive(
+        make(extra=['-Dfoo=bar']), cgroups=[(24 * GiB, 6.0, {'memory': '/mc', 'cpus': '/mc'})],
+        host_ram=64 * GiB,
+    )
+    assert options[:2] == ['-Xms18432m', '-Xmx18432m']
+    assert flag(options, '-XX:G1NewSizePercent') == ['-XX:G1NewSizePercent=40']
+    assert flag(options, '-XX:ActiveProcessorCount') == ['-XX:ActiveProcessorCount=6']
+    assert options[-1] == '-Dfoo=bar'
+
+
+def test_heap_override():
+    options, steps = jvm.derive(make(heap='2g'), cgroups=[], host_ram=64 * GiB, host_cpus=8)
+    assert options[:2] == ['-Xms2048m', '-Xmx2048m']
+    assert not jvm.enabled(make(auto=False))
+    # Off unless asked for, so existing servers aren't remade with new options
+    assert not jvm.enabled(make())
+    assert jvm.enabled(make(auto=True))
+
+
+def test_bad_extra():
+    with pytest.raises(ValueError):
+        jvm.derive(make(extra='-Dfoo=bar'), cgroups=[], host_ram=64 * GiB, host_cpus=8)
+    with pytest.raises(ValueError):
+        jvm.derive(make(extra=['-Dfoo=bar', 5]), cgroups=[], host_ram=64 * GiB, host_cpus=8)
+
+
+def test_only_cgroup_parent(monkeypatch):
+    looked_at = []
+
+    def cgroup_limits(path):
+        looked_at.append(path)
+        return 4 * GiB, None, {'memory': path}
+
+    monkeypatch.setattr(jvm, 'cgroup_limits', cgroup_limits)
+    jvm.derive(make(), host_ram=64 * GiB, host_cpus=8)
+    assert looked_at == []
+
+    config = make()
+    config['resources']['cgroup-parent'] = 'machine-mc.slice'
+    _, steps = jvm.derive(config, host_ram=64 * GiB, host_cpus=8)
+    assert looked_at == ['machine.slice/machine-mc.slice']
+    assert steps[0].reason == 'cgroup machine.slice/machine-mc.slice memory.max'
+    assert jvm.cgroup_path('/custom/group') == '/custom/group'
+
+
+def test_heap_must_fit():
+    with pytest.raises(ValueError, match='512 MiB'):
+        jvm.derive(make({'memory': '512m'}), cgroups=[], host_ram=64 * GiB, host_cpus=8)
+    with pytest.raises(ValueError):
+        jvm.derive(make({'memory': '4g'}, heap='4g'), cgroups=[], host_ram=64 * GiB, host_cpus=8)
+    options, _ = jvm.derive(make({'memory': '1g'}), cgroups=[], host_ram=64 * GiB, host_cpus=8)
+    assert options[:2] == ['-Xms512m', '-Xmx512m']
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import socket
+import threading
+
+from podcraft import loadtest, slp
+from podcraft.choices import LOADTEST_SCENARIOS
+
+
+def serve(ready, info):
+    async def handle(reader, writer):
+        try:
+            _, read = await loadtest._read_packet(reader)
+            slp.decode_varint(read)  # protocol
+            read(slp.decode_varint(read))  # host
+            read(2)  # port
+            state = slp.decode_varint(read)
+            await loadtest._read_packet(reader)
+            if state == slp.STATUS_STATE:
+                status = {'version': {'name': '1.15.2', 'protocol': 578}}
+                writer.write(slp.encode_packet(0x00, slp.encode_string(json.dumps(status))))
+                _, read = await loadtest._read_packet(reader)
+                writer.write(slp.encode_packet(0x01, read(8)))
+            else:
+                # Offline mode with compression
+                writer.write(slp.encode_packet(0x03, slp.encode_varint(256)))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        info['port'] = server.sockets[0].getsockname()[1]
+        ready.set()
+        await asyncio.sleep(3600)
+
+    asyncio.run(main())
+
+
+def start_server():
+    ready, info = threading.Event(), {}
+    threading.Thread(target=serve, args=(ready, info), daemon=True).start()
+    ready.wait()
+    return info['port']
+
+
+def test_status_load():
+    port = start_server()
+    report = loadtest.run('127.0.0.1', port, connections=50, concurrency=10)
+    assert report['protocol'] == 578
+    assert report['completed'] == 50
+    assert report['failed'] == 0
+    assert report['outcomes'] == {'pong': 50}
+    assert report['latency_ms']['p50'] <= report['latency_ms']['p99'] <= report['latency_ms']['max']
+    json.dumps(report)
+
+
+def test_login_load():
+    port = start_server()
+    report = loadtest.run('127.0.0.1', port, scenario='login', connections=20, concurrency=5, protocol=578)
+    assert report['outcomes'] == {'compression': 20}
+    assert report['error_rate'] == 0
+
+
+def test_errors_counted():
+    # Nothing is listening here
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    report = loadtest.run('127.0.0.1', port, connections=5, concurrency=5, protocol=578, timeout=1)
+    assert report['failed'] == 5
+    assert report['error_rate'] == 1
+    assert report['latency_ms'] is None
+
+
+def test_split():
+    assert loadtest._split(10, 3) == [4, 3, 3]
+
+
+def test_scenarios_match_cli_choices():
+    assert sorted(loadtest.SCENARIOS) == sorted(LOADTEST_SCENARIOS)
+
+
+def test_login_start_fields():
+    # What comes after the name
+    for protocol, fields in [(578, b''), (759, b'\0'), (760, b'\0\0'), (763, b'\0'), (764, bytes(16))]:
+        expected = slp.encode_packet(0x00, slp.encode_string('steve') + fields)
+        assert loadtest._login_start('steve', protocol) == expected, protocol
+
+
+def test_fd_limit(monkeypatch):
+    set_to = []
+    monkeypatch.setattr(loadtest.resource, 'setrlimit', lambda which, limits: set_to.append(limits))
+    inf = loadtest.resource.RLIM_INFINITY
+
+    for limits in [(1024, inf), (1024, 4096), (4096, 4096)]:
+        monkeypatch.setattr(loadtest.resource, 'getrlimit', lambda which: limits)
+        loadtest._raise_fd_limit()
+    assert set_to == [(loadtest.MAX_FDS, inf), (4096, 4096)]
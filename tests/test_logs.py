@@ -0,0 +1,96 @@
+import datetime
+import gzip
+import os
+import threading
+import time
+
+from podcraft.logs import LogIndex, follow, parse_event, rotated_logs
+
+ROTATED = """\
+[23:59:50] [Server thread/INFO]: alice joined the game
+[23:59:58] [Server thread/WARN]: Can't keep up! Is the server overloaded? Running 2500ms or 50 ticks behind
+[00:00:05] [Server thread/INFO]: alice left the game
+"""
+
+LATEST = """\
+[10:00:00] [Server thread/INFO]: Starting minecraft server version 1.15.2
+[10:01:00] [Server thread/INFO]: Bob joined the game
+[10:02:00] [Server thread/ERROR]: Encountered an unexpected exception
+"""
+
+
+def test_parse_event():
+    assert parse_event("[10:01:00] [Server thread/INFO]: Bob joined the game") == \
+        ('join', 'Bob', 'Bob joined the game')
+    assert parse_event("[10:01:00] [Server thread/INFO]: <Bob> I joined the game") is None
+    assert parse_event("[10:01:00] [Server thread/INFO]: Done (3.2s)!") is None
+    assert parse_event(
+        "[10:01:00] [Server thread/ERROR]: This crash report has been saved to: /mc/crash-reports/x.txt"
+    )[0] == 'crash'
+
+
+def test_index(tmp_path):
+    logdir = tmp_path / 'logs'
+    logdir.mkdir()
+    with gzip.open(logdir / '2020-01-15-1.log.gz', 'wt') as f:
+        f.write(ROTATED)
+    (logdir / 'latest.log').write_text(LATEST)
+
+    with LogIndex(str(logdir), str(tmp_path / 'logs.db')) as index:
+        assert index.update() == 2
+        events = list(index.search(player='ALICE'))
+        assert [e[1] for e in events] == ['join', 'leave']
+        # The leave was after midnight
+        assert datetime.date.fromtimestamp(events[1][0]) == datetime.date(2020, 1, 16)
+        assert [e[1] for e in index.search(kinds=['lag', 'error'])] == ['lag', 'error']
+
+        # Nothing new, nothing read
+        assert index.update() == 0
+
+        with open(logdir / 'latest.log', 'at') as f:
+            f.write("[10:03:00] [Server thread/INFO]: Bob left the game\n[10:04:00] [Server")
+        index.update()
+        assert [e[1] for e in index.search(player='Bob')] == ['join', 'leave']
+
+        # Rotation: the old latest.log becomes a .gz, and a new one starts
+        with open(logdir / 'latest.log', 'rb') as src, gzip.open(logdir / '2020-01-17-1.log.gz', 'wb') as dst:
+            dst.write(src.read())
+        os.unlink(logdir / 'latest.log')
+        (logdir / 'latest.log').write_text("[11:00:00] [Server thread/INFO]: carol joined the game\n")
+        index.update()
+        assert [e[1] for e in index.search(player='Bob')] == ['join', 'leave']
+        assert len(list(index.search(player='carol'))) == 1
+        assert len(list(index.search(kinds=['join'], since=time.time() - 86400))) == 1
+
+
+def test_follow(tmp_path):
+    (tmp_path / 'latest.log').write_text("old\n")
+    seen = []
+
+    def reader():
+        for line in follow(str(tmp_path)):
+            seen.append(line)
+
+    threading.Thread(target=reader, daemon=True).start()
+    time.sleep(0.2)
+    with open(tmp_path / 'latest.log', 'at') as f:
+        f.write("one\ntw")
+        f.flush()
+        time.sleep(0.1)
+        f.write("o\n")
+    time.sleep(0.2)
+    os.rename(tmp_path / 'latest.log', tmp_path / 'old.log')
+    (tmp_path / 'latest.log').write_text("three\n")
+    deadline = time.time() + 5
+    while len(seen) < 3 and time.time() < deadline:
+        time.sleep(0.05)
+    assert seen == ['one', 'two', 'three']
+
+
+def test_no_logs_yet(tmp_path):
+    # The server was never started
+    logdir = str(tmp_path / 'logs')
+    assert rotated_logs(logdir) == []
+    index = LogIndex(logdir, str(tmp_path / 'logs.db'))
+    assert index.update() == 0
+    assert list(index.search(kinds=['join'])) == []
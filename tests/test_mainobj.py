@@ -0,0 +1,255 @@
+import contextlib
+import threading
+
+import pytest
+
+from podcraft.config import Config
+from podcraft.mainobj import Podcraft, Removal
+from podcraft.varlink import NotFound
+
+
+class FakePod:
+    def __init__(self, pod_id, *, fails=False):
+        self.id = pod_id
+        self.fails = fails
+        self.running = False
+
+    def items(self):
+        return [('id', self.id)]
+
+    def start(self):
+        if self.fails:
+            raise RuntimeError("pod would not start")
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+class FakeClient:
+    def __init__(self, pods):
+        self.pods = self
+        self._pods = {pod.id: pod for pod in pods}
+
+    def get(self, pod_id):
+        return self._pods[pod_id]
+
+
+class FakeAsyncClient:
+    """
+    Removes anything, except what's in gone (already removed) or failing.
+    """
+    def __init__(self):
+        self.removed = []
+        self.gone = set()
+        self.failing = set()
+
+    async def _remove(self, kind, ident):
+        if ident in self.gone:
+            raise NotFound('io.podman.NotFound')
+        if ident in self.failing:
+            raise RuntimeError(f"{ident} is in use")
+        self.removed.append((kind, ident))
+
+    async def remove_container(self, ident, *, force):
+        await self._remove('container', ident)
+
+    async def remove_pod(self, ident, *, force):
+        await self._remove('pod', ident)
+
+    async def remove_image(self, ident, *, force):
+        await self._remove('image', ident)
+
+
+class FakePodcraft(Podcraft):
+    def __init__(self, root, pods):
+        super().__init__(root)
+        (self.root / '.tmp').mkdir()
+        self.config = Config({'properties': {}, 'server': {}, 'management': {}, 'volumes': {}})
+        self.client = FakeClient(pods)
+        self.apm = FakeAsyncClient()
+        self.commands = []
+
+    def is_running(self):
+        return self.state.get_pod_object(client=self.client).running
+
+    @contextlib.contextmanager
+    def connect(self):
+        yield self.client
+
+    @contextlib.contextmanager
+    def console(self):
+        yield self.commands.append
+
+    @contextlib.asynccontextmanager
+    async def aconnect(self):
+        yield self.apm
+
+    def properties(self):
+        return (self.root / self.config.properties_file).read_text()
+
+
+def generation(number, pod_id, image_id):
+    return {
+        'images': {'server': {'id': image_id}},
+        'containers': {'server': {'id': f'{pod_id}-server'}},
+        'pod': {'id': pod_id},
+        'fingerprints': {'properties': f'props{number}'},
+        'generation': {'number': number},
+    }
+
+
+def make(tmp_path, *pods):
+    pc = FakePodcraft(tmp_path, pods)
+    with pc:
+        pc.state.switch_generation(generation(1, 'blue', 'img1'))
+    (tmp_path / pc.config.properties_file).write_text('motd=blue')
+    pods[0].running = True
+    return pc
+
+
+def test_switch_and_roll_back(tmp_path):
+    blue, green = FakePod('blue'), FakePod('green')
+    pc = make(tmp_path, blue, green)
+    gen = dict(generation(2, 'green', 'img2'), properties='motd=green')
+
+    with pc:
+        assert pc.switch_generation(gen) >= 0
+    assert green.running and not blue.running
+    assert pc.commands == ['save-all flush']
+    assert pc.properties() == 'motd=green'
+    with pc:
+        assert pc.state.get_pod() == 'green'
+        assert pc.state.get_previous()['properties'] == 'motd=blue'
+
+        pc.rollback()
+    assert blue.running and not green.running
+    assert pc.properties() == 'motd=blue'
+    with pc:
+        assert pc.state.get_pod() == 'blue'
+        assert pc.state.get_fingerprint('properties') == 'props1'
+        assert pc.state.get_previous()['properties'] == 'motd=green'
+    # Nothing was retired, both generations are kept
+    assert pc.apm.removed == []
+
+
+def test_new_generation_fails_to_start(tmp_path):
+    blue, green = FakePod('blue'), FakePod('green', fails=True)
+    pc = make(tmp_path, blue, green)
+    gen = dict(generation(2, 'green', 'img2'), properties='motd=green')
+
+    with pc:
+        with pytest.raises(RuntimeError):
+            pc.switch_generation(gen)
+    # The old one is back, as it was
+    assert blue.running
+    assert pc.properties() == 'motd=blue'
+    with pc:
+        assert pc.state.get_pod() == 'blue'
+        assert pc.state.get_fingerprint('properties') == 'props1'
+        assert pc.state.generation_number() == 2
+
+
+def test_discard_generation(tmp_path):
+    blue = FakePod('blue')
+    pc = make(tmp_path, blue)
+    gen = generation(2, 'green', 'img2')
+    gen['images']['manager'] = {'id': 'img1'}
+
+    with pc:
+        pc._discard_generation(gen)
+        # The new image is left for cleanup, the shared one is still used
+        assert pc.state.data['orphans'] == {'img2': 'server'}
+    assert sorted(pc.apm.removed) == [('container', 'green-server'), ('pod', 'green')]
+
+
+def outcomes(results):
+    return sorted((r.kind, r.id, r.outcome) for r in results)
+
+
+def built(tmp_path):
+    pc = FakePodcraft(tmp_path, [])
+    with pc:
+        pc.state.data['images'] = {'server': {'id': 'img-s'}, 'manager': {'id': 'img-m'}}
+        pc.state.data['containers'] = {'server': {'id': 'con-s'}, 'manager': {'id': 'con-m'}}
+        pc.state.data['pod'] = {'id': 'pod'}
+    return pc
+
+
+def test_cleanup(tmp_path):
+    pc = built(tmp_path)
+    pc.apm.gone.add('con-m')
+    pc.apm.failing.add('img-s')
+
+    with pc:
+        results = pc.cleanup()
+    assert outcomes(results) == [
+        ('container', 'con-m', Removal.GONE),
+        ('container', 'con-s', Removal.REMOVED),
+        ('image', 'img-m', Removal.REMOVED),
+        ('image', 'img-s', Removal.FAILED),
+        ('pod', 'pod', Removal.REMOVED),
+    ]
+    with pc:
+        assert pc.state.names() == []
+        assert pc.state.get_pod() is None
+        assert pc.state.data['orphans'] == {'img-s': 'server'}
+        assert len(pc.state.data['teardown']) == 5
+
+    # The next cleanup tries the image again
+    pc.apm.failing.clear()
+    with pc:
+        results = pc.cleanup()
+        assert outcomes(results) == [('image', 'img-s', Removal.REMOVED)]
+        assert 'orphans' not in pc.state.data
+
+
+def test_cleanup_keep_images(tmp_path):
+    pc = built(tmp_path)
+    with pc:
+        results = pc.cleanup(keep_images=True)
+    assert {r.kind for r in results} == {'container', 'pod'}
+    with pc:
+        assert pc.state.data['images'] == {'server': {'id': 'img-s'}, 'manager': {'id': 'img-m'}}
+        assert pc.state.data['containers'] == {}
+
+
+def test_cleanup_in_background(tmp_path):
+    pc = built(tmp_path)
+    pc.apm.failing.add('img-m')
+    with pc:
+        results = pc.cleanup(wait=False)
+        assert {r.kind for r in results} == {'container', 'pod'}
+        # Leaving the project waits for the images
+    assert not hasattr(pc, '_image_cleanup')
+    assert ('image', 'img-s') in pc.apm.removed
+    with pc:
+        assert pc.state.data['orphans'] == {'img-m': 'manager'}
+        assert len(pc.state.data['teardown']) == 5
+        assert pc.wait_for_cleanup() == []
+
+
+def test_exclusive(tmp_path):
+    first, second = Podcraft(tmp_path), Podcraft(tmp_path)
+    order = []
+
+    def run():
+        with second.exclusive():
+            order.append('second')
+            second.state.data['pod'] = {'id': 'second'}
+
+    with first.exclusive():
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join(0.2)
+        # Kept out for the whole run, not just while the state is written
+        assert thread.is_alive()
+        first.state.data['pod'] = {'id': 'first'}
+        order.append('first')
+    thread.join(5)
+    assert order == ['first', 'second']
+
+    # Just looking isn't kept out
+    with first.exclusive():
+        with second:
+            assert second.state.get_pod() == 'second'
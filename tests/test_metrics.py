@@ -0,0 +1,50 @@
+import threading
+import urllib.request
+
+from podcraft.metrics import Collector, Metrics, make_server, parse_tps
+
+
+def test_render():
+    metrics = Metrics()
+    metrics.add('podcraft_players_online', 3, help="Players online")
+    metrics.add('podcraft_job_seconds', 1.5, {'job': 'job-0'}, help="Job time")
+    metrics.add('podcraft_job_seconds', 2, {'job': 'say "hi"'}, help="Job time")
+    assert metrics.render() == (
+        '# HELP podcraft_players_online Players online\n'
+        '# TYPE podcraft_players_online gauge\n'
+        'podcraft_players_online 3.0\n'
+        '# HELP podcraft_job_seconds Job time\n'
+        '# TYPE podcraft_job_seconds gauge\n'
+        'podcraft_job_seconds{job="job-0"} 1.5\n'
+        'podcraft_job_seconds{job="say \\"hi\\""} 2.0\n'
+    )
+
+
+def test_parse_tps():
+    assert parse_tps("§6TPS from last 1m, 5m, 15m: §a19.98, §a20.0, §a*20.0") == [19.98, 20.0, 20.0]
+    assert parse_tps("Unknown or incomplete command") is None
+
+
+def test_timings_and_http():
+    state = {
+        'containers': {},
+        'build': {'finished': 100, 'seconds': 42.5, 'steps': 3},
+        'jobs': {'job-0': {'started': 50, 'seconds': 7, 'bytes': 1024, 'rc': 0, 'error': None}},
+    }
+    collector = Collector(None)
+    metrics = Metrics()
+    collector._timings(metrics, state)
+    collector.text = metrics.render()
+    assert 'podcraft_build_seconds 42.5' in collector.text
+    assert 'podcraft_job_failed{job="job-0"} 0.0' in collector.text
+
+    server = make_server(collector, ('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        with urllib.request.urlopen(url + '/metrics') as resp:
+            assert resp.headers['Content-Type'].startswith('text/plain')
+            assert resp.read().decode() == collector.text
+    finally:
+        server.shutdown()
+        server.server_close()
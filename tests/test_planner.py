@@ -0,0 +1,88 @@
+from podcraft.planner import make_plan, fingerprint
+from podcraft.state import State, default_state
+
+
+def inputs(**changes):
+    rv = {
+        'images': {
+            'server': {'digest': 'a', 'buildargs': {'type': 'vanilla'}},
+            'manager': {'digest': 'b', 'buildargs': {}},
+        },
+        'containers': {
+            'server': {'volumes': [['live', '/mc/world']]},
+            'manager': {'volumes': [['live', '/mc/world']]},
+        },
+        'pod': {'ports': {'25565/tcp': ['server', 25565]}},
+        'properties': {'motd': 'hi'},
+    }
+    rv.update(changes)
+    return rv
+
+
+def built_state(inp):
+    state = State(None)
+    state.data = default_state()
+    for name in inp['images']:
+        state.save_image(name, f'{name}-img')
+        state.save_container(name, {'id': f'{name}-con', 'imageid': f'{name}-img'})
+    state.save_pod('pod')
+    plan = make_plan(state, inp, force=True)
+    for key, fp in plan.fingerprints().items():
+        state.save_fingerprint(key, fp)
+    return state
+
+
+def steps(plan):
+    return {(s.action, s.name) for s in plan}
+
+
+def test_fresh_builds_everything():
+    state = State(None)
+    state.data = default_state()
+    assert steps(make_plan(state, inputs(), properties_exist=False)) == {
+        ('build', 'server'), ('build', 'manager'), ('create-pod', None),
+        ('create-container', 'server'), ('create-container', 'manager'),
+        ('write-properties', None),
+    }
+
+
+def test_up_to_date():
+    state = built_state(inputs())
+    assert not make_plan(state, inputs())
+
+
+def test_properties_only():
+    state = built_state(inputs())
+    plan = make_plan(state, inputs(properties={'motd': 'changed'}))
+    assert steps(plan) == {('write-properties', None)}
+
+
+def test_buildargs_rebuild_one_image():
+    state = built_state(inputs())
+    changed = inputs()
+    changed['images']['server']['buildargs'] = {'type': 'paper'}
+    assert steps(make_plan(state, changed)) == {
+        ('build', 'server'), ('create-container', 'server'),
+    }
+
+
+def test_unknown_context_rebuilds():
+    state = built_state(inputs())
+    unknown = inputs()
+    unknown['images']['server']['digest'] = None
+    plan = make_plan(state, unknown)
+    assert steps(plan) == {('build', 'server'), ('create-container', 'server')}
+    assert "isn't downloaded" in next(iter(plan)).reason
+
+
+def test_ports_replace_pod():
+    state = built_state(inputs())
+    plan = make_plan(state, inputs(pod={'ports': {'25566/tcp': ['server', 25565]}}))
+    assert steps(plan) == {
+        ('create-pod', None),
+        ('create-container', 'server'), ('create-container', 'manager'),
+    }
+
+
+def test_fingerprint_is_order_independent():
+    assert fingerprint({'a': 1, 'b': 2}) == fingerprint({'b': 2, 'a': 1})
@@ -0,0 +1,107 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from podcraft import podman
+
+#: Stands in for podman varlink. Its command line has "varlink" and the
+#: socket in it, like the real thing, so it passes the PID check.
+FAKE_SERVER = r'''
+import os, signal, socket, sys
+
+mode, path = sys.argv[2], sys.argv[3]
+if mode == 'stubborn':
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+else:
+    def stop(*_):
+        os.unlink(path)
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+# Only appear once listening, so nobody connects too early
+sock.bind(path + '.tmp')
+sock.listen(5)
+os.rename(path + '.tmp', path)
+while True:
+    conn, _ = sock.accept()
+    if mode != 'broken':
+        buf = b''
+        while not buf.endswith(b'\0'):
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            buf += chunk
+        conn.sendall(b'{"parameters": {}}\0')
+    conn.close()
+'''
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.setattr(podman, '_healthy', set())
+    procs = []
+
+    def spawn(mode='ok'):
+        socketfile = tmp_path / 'io.podman'
+        proc = subprocess.Popen([sys.executable, '-c', FAKE_SERVER, 'varlink', mode, str(socketfile)])
+        procs.append(proc)
+        (tmp_path / 'podman.pid').write_text(str(proc.pid))
+        while not socketfile.exists():
+            time.sleep(0.01)
+        return proc
+
+    def start(socketfile, pidfile, **kwargs):
+        spawn()
+
+    monkeypatch.setattr(podman, 'start_persistent_server', start)
+    spawn.paths = tmp_path / 'io.podman', tmp_path / 'podman.pid'
+    yield spawn
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+
+
+def test_reuses_healthy_server(project, monkeypatch):
+    proc = project()
+    started = []
+    monkeypatch.setattr(podman, 'start_persistent_server', lambda *a, **kw: started.append(a))
+    socketfile, pidfile = project.paths
+    assert podman.persistent_server(socketfile, pidfile) == f'unix:{socketfile}'
+    assert not started
+
+    # Once it's known to be healthy, it isn't asked again
+    pings = []
+    monkeypatch.setattr(podman, '_ping', pings.append)
+    podman.persistent_server(socketfile, pidfile)
+    assert not pings
+    assert proc.poll() is None
+
+
+def test_restarts_unresponsive_server(project):
+    broken = project('broken')
+    socketfile, pidfile = project.paths
+    assert podman.persistent_server(socketfile, pidfile) == f'unix:{socketfile}'
+    assert broken.wait(timeout=5) is not None
+    assert int(pidfile.read_text()) != broken.pid
+
+
+def test_starts_over_stale_files(project, tmp_path):
+    socketfile, pidfile = project.paths
+    socketfile.touch()
+    pidfile.write_text('999999999')
+    assert podman.persistent_server(socketfile, pidfile) == f'unix:{socketfile}'
+    assert f'unix:{socketfile}' in podman._healthy
+
+
+def test_stop_kills_stubborn_server(project):
+    proc = project('stubborn')
+    socketfile, pidfile = project.paths
+    start = time.monotonic()
+    podman.stop_persistent_server(socketfile, pidfile, timeout=0.5)
+    assert time.monotonic() - start < 5
+    assert proc.wait(timeout=5) == -9
+    assert not socketfile.exists()
+    assert not pidfile.exists()
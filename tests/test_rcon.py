@@ -0,0 +1,83 @@
+import socket
+import struct
+import threading
+
+import pytest
+
+from podcraft.config import read_properties
+from podcraft.rcon import RconClient, AuthenticationFailed
+
+
+class FakeRcon:
+    """
+    An RCON server that behaves like vanilla: one packet per read, long
+    responses split at 4096 bytes, and "Unknown request" for other types.
+    """
+    def __init__(self, password='hunter2'):
+        self.password = password
+        self.commands = []
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def send(self, conn, ident, type, payload):
+        body = struct.pack('<ii', ident, type) + payload + b'\0\0'
+        conn.sendall(struct.pack('<i', len(body)) + body)
+
+    def serve(self):
+        conn, _ = self.listener.accept()
+        with conn:
+            while True:
+                data = conn.recv(4110)
+                if not data:
+                    return
+                length, ident, type = struct.unpack('<iii', data[:12])
+                assert len(data) == length + 4, "several packets in one read"
+                payload = data[12:-2]
+                if type == 3:
+                    self.send(conn, ident if payload.decode() == self.password else -1, 2, b'')
+                elif type == 2:
+                    cmd = payload.decode()
+                    self.commands.append(cmd)
+                    if cmd == 'long':
+                        reply = b'x' * 10000
+                    else:
+                        reply = f'ran {cmd}'.encode()
+                    for i in range(0, len(reply), 4096):
+                        self.send(conn, ident, 0, reply[i:i + 4096])
+                else:
+                    self.send(conn, ident, 0, f'Unknown request {type:x}'.encode())
+
+
+def test_command():
+    server = FakeRcon()
+    with RconClient('127.0.0.1', server.port, 'hunter2') as client:
+        assert client.command('list') == 'ran list'
+        assert client.command('long') == 'x' * 10000
+        assert client.command('say hi') == 'ran say hi'
+    assert server.commands == ['list', 'long', 'say hi']
+
+
+def test_batch():
+    server = FakeRcon()
+    with RconClient('127.0.0.1', server.port, 'hunter2') as client:
+        assert list(client.batch(['a', 'long', 'b'])) == ['ran a', 'x' * 10000, 'ran b']
+
+
+def test_bad_password():
+    server = FakeRcon()
+    with pytest.raises(AuthenticationFailed):
+        RconClient('127.0.0.1', server.port, 'wrong').connect()
+
+
+def test_read_properties(tmp_path):
+    path = tmp_path / 'server.properties'
+    path.write_text("#Minecraft server properties\nenable-rcon=true\nrcon.password=a=b\n\nmotd=Hi there\n")
+    assert read_properties(path) == {
+        'enable-rcon': 'true',
+        'rcon.password': 'a=b',
+        'motd': 'Hi there',
+    }
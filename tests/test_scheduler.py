@@ -0,0 +1,139 @@
+import asyncio
+import contextlib
+
+import pytest
+
+from podcraft import scheduler
+from podcraft.scheduler import Scheduler, parse_frequency, next_delay
+from podcraft.snapshot import Snapshotter
+from podcraft.state import State
+
+
+def test_parse_frequency():
+    assert parse_frequency("1h") == 3600
+    assert parse_frequency("90m") == 5400
+    assert parse_frequency("1h30m") == 5400
+    assert parse_frequency("1d 12h") == 129600
+    assert parse_frequency("45") == 45
+    assert parse_frequency(300) == 300
+    for bad in ("", "soon", "1x", "1h and a bit"):
+        with pytest.raises(ValueError):
+            parse_frequency(bad)
+
+
+def test_next_delay():
+    delays = [next_delay(3600) for _ in range(100)]
+    assert all(3240 <= d <= 3960 for d in delays)
+    assert len(set(delays)) > 1
+
+
+class FakePodman:
+    """
+    Runs job "containers" by sleeping, keeping track of how many run at once.
+    """
+    def __init__(self):
+        self.running = 0
+        self.most = 0
+        self.removed = []
+
+    async def get_image(self, name):
+        return {'id': f'{name}-id'}
+
+    async def create_container(self, image_id, pod_id, volumes, *, env):
+        assert pod_id == 'pod-id'
+        return env['TARGET']
+
+    async def start_container(self, cid):
+        self.running += 1
+        self.most = max(self.most, self.running)
+
+    async def wait_container(self, cid):
+        await asyncio.sleep(0.05)
+        self.running -= 1
+        return 3 if cid == 'failing' else 0
+
+    async def get_container_stats(self, cid):
+        return {'block_input': 100, 'block_output': 23}
+
+    async def remove_container(self, cid, *, force):
+        self.removed.append(cid)
+
+
+class FakePodcraft:
+    def __init__(self, root, jobs):
+        self.root = root
+        self.config = {'management': {'backup': {'job': jobs}}}
+        self.state = State(root / 'state.json')
+        self.pm = FakePodman()
+        self.snapshots = 0
+        (root / 'live').mkdir()
+        (root / 'live' / 'level.dat').write_bytes(b'level')
+
+    def __enter__(self):
+        self.state.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.state.__exit__(*exc)
+
+    def snapshotter(self):
+        return Snapshotter(self.root / 'live', self.root / 'snapshot', self.root / 'index')
+
+    def snapshot(self):
+        self.snapshots += 1
+        snap = self.snapshotter()
+        snap.load_index()
+        snap.sync()
+        snap.save_index()
+
+    def _config_volumes(self):
+        return {}
+
+    @contextlib.asynccontextmanager
+    async def aconnect(self):
+        yield self.pm
+
+
+@pytest.fixture
+def pc(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler, 'STATS_INTERVAL', 0.01)
+    names = ['job0', 'job1', 'job2', 'job3', 'failing']
+    # The fake podman names each container after its TARGET
+    pc = FakePodcraft(tmp_path, [
+        {'image': 'backup', 'name': name, 'target': name} for name in names
+    ])
+    with pc:
+        pc.state.data['pod'] = {'id': 'pod-id'}
+    return pc
+
+
+def test_cycle(pc):
+    records = Scheduler(pc, concurrency=2).cycle()
+    assert pc.snapshots == 1
+    assert sorted(records) == ['failing', 'job0', 'job1', 'job2', 'job3']
+    assert pc.pm.most == 2
+    assert sorted(pc.pm.removed) == sorted(records)
+    assert records['job0']['rc'] == 0
+    assert records['failing']['rc'] == 3
+
+    with pc:
+        jobs = pc.state.data['jobs']
+        assert jobs['job0']['history'] == [records['job0']['seconds']]
+        assert 'ran' in pc.state.data['schedule']
+
+
+def test_cycle_skipped_when_unchanged(pc):
+    Scheduler(pc).cycle()
+    assert Scheduler(pc).cycle() is None
+    assert pc.snapshots == 1
+    with pc:
+        assert 'skipped' in pc.state.data['schedule']
+
+    assert Scheduler(pc).cycle(force=True) is not None
+    assert pc.snapshots == 2
+    with pc:
+        assert len(pc.state.data['jobs']['job0']['history']) == 2
+
+    (pc.root / 'live' / 'r.0.0.mca').write_bytes(b'chunk')
+    assert Scheduler(pc).cycle() is not None
+    assert pc.snapshots == 3
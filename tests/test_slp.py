@@ -0,0 +1,61 @@
+import json
+import socket
+import threading
+
+from podcraft import slp
+
+STATUS = {
+    'version': {'name': '1.15.2', 'protocol': 578},
+    'players': {'max': 20, 'online': 1, 'sample': [{'name': 'alice', 'id': 'abc'}]},
+    'description': {'text': 'A ', 'extra': [{'text': 'server'}]},
+}
+
+
+def serve_status(listener):
+    conn, _ = listener.accept()
+    with conn:
+        reader = slp._Reader(conn)
+        packet_id, read = reader.packet()
+        assert packet_id == 0x00
+        assert slp.decode_varint(read) == slp.PROTOCOL
+        read(slp.decode_varint(read))  # host
+        read(2)  # port
+        assert slp.decode_varint(read) == slp.STATUS_STATE
+
+        packet_id, _ = reader.packet()
+        assert packet_id == 0x00
+        conn.sendall(slp.encode_packet(0x00, slp.encode_string(json.dumps(STATUS))))
+
+        packet_id, read = reader.packet()
+        assert packet_id == 0x01
+        conn.sendall(slp.encode_packet(0x01, read(8)))
+
+
+def test_varint():
+    for value in (0, 1, 127, 128, 255, 25565, 2147483647, -1):
+        data = slp.encode_varint(value)
+        buf = iter(data)
+        assert slp.decode_varint(lambda n: bytes([next(buf)])) == value
+    assert slp.encode_varint(-1) == b'\xff\xff\xff\xff\x0f'
+
+
+def test_query():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    thread = threading.Thread(target=serve_status, args=(listener,), daemon=True)
+    thread.start()
+    status, latency = slp.query('127.0.0.1', listener.getsockname()[1])
+    thread.join()
+    assert status == STATUS
+    assert latency >= 0
+    assert slp.description_text(status['description']) == 'A server'
+
+
+def test_latency_stats():
+    samples = [i / 1000 for i in range(1, 101)]
+    low, avg, p99 = slp.latency_stats(samples)
+    assert low == 0.001
+    assert abs(avg - 0.0505) < 1e-9
+    assert p99 == 0.099
+    assert slp.latency_stats([0.5]) == (0.5, 0.5, 0.5)
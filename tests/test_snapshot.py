@@ -0,0 +1,131 @@
+import os
+import time
+
+import pytest
+
+from podcraft.snapshot import Snapshotter, take_snapshot
+
+
+@pytest.fixture
+def world(tmp_path):
+    live = tmp_path / 'live'
+    (live / 'region').mkdir(parents=True)
+    (live / 'level.dat').write_bytes(b'level')
+    (live / 'region' / 'r.0.0.mca').write_bytes(b'a' * 8192)
+    (live / 'region' / 'r.0.1.mca').write_bytes(b'b' * 8192)
+    return tmp_path
+
+
+def make(world):
+    return Snapshotter(world / 'live', world / 'snapshot', world / 'index')
+
+
+def test_incremental(world):
+    snap = make(world)
+    stats = snap.sync()
+    assert stats['changed'] == 3
+    assert (world / 'snapshot' / 'region' / 'r.0.1.mca').read_bytes() == b'b' * 8192
+
+    assert snap.sync()['changed'] == 0
+
+    region = world / 'live' / 'region' / 'r.0.0.mca'
+    region.write_bytes(b'c' * 4096)
+    (world / 'live' / 'level.dat').unlink()
+    stats = snap.sync()
+    assert stats['changed'] == 1
+    assert stats['bytes'] == 4096
+    assert stats['removed'] == 1
+    assert (world / 'snapshot' / 'region' / 'r.0.0.mca').read_bytes() == b'c' * 4096
+    assert not (world / 'snapshot' / 'level.dat').exists()
+    assert not any(f.name.endswith('.podcraft-tmp') for f in (world / 'snapshot').rglob('*'))
+
+
+def test_missing_world_is_not_a_deletion(world, tmp_path):
+    snap = make(world)
+    snap.sync()
+    os.rename(world / 'live', tmp_path / 'elsewhere')
+    with pytest.raises(FileNotFoundError):
+        snap.sync()
+    assert (world / 'snapshot' / 'level.dat').exists()
+
+
+def test_take_snapshot(world):
+    commands = []
+
+    def command(cmd):
+        commands.append(cmd)
+        if cmd == 'save-all flush':
+            # The flush writes out a new chunk
+            (world / 'live' / 'region' / 'r.1.0.mca').write_bytes(b'd')
+
+    stats = take_snapshot(make(world), command)
+    assert commands == ['save-off', 'save-all flush', 'save-on']
+    assert stats['warm']['changed'] == 3
+    assert stats['final']['changed'] == 1
+    assert stats['pause'] >= 0
+    assert (world / 'snapshot' / 'region' / 'r.1.0.mca').read_bytes() == b'd'
+
+    # The index was saved, so the next one copies nothing
+    stats = take_snapshot(make(world), lambda cmd: None)
+    assert stats['warm']['changed'] == 0
+
+
+def test_saving_resumed_on_failure(world):
+    commands = []
+
+    def command(cmd):
+        commands.append(cmd)
+        if cmd == 'save-all flush':
+            raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        take_snapshot(make(world), command)
+    assert commands[-1] == 'save-on'
+
+
+def test_has_changes(world):
+    snap = make(world)
+    assert snap.has_changes()
+    snap.sync()
+    snap.save_index()
+
+    snap = make(world)
+    snap.load_index()
+    assert not snap.has_changes()
+
+    # Rewritten on every save, whether or not anything changed
+    (world / 'live' / 'level.dat').write_bytes(b'level, later')
+    assert not snap.has_changes()
+    # Which is done by writing a new one and renaming it into place
+    time.sleep(0.01)
+    os.replace(world / 'live' / 'level.dat', world / 'live' / 'level.dat_old')
+    (world / 'live' / 'level.dat_new').write_bytes(b'level, even later')
+    os.replace(world / 'live' / 'level.dat_new', world / 'live' / 'level.dat')
+    assert snap.dirs['.'] != os.stat(world / 'live').st_mtime_ns
+    assert not snap.has_changes()
+
+    (world / 'live' / 'region' / 'r.5.5.mca').write_bytes(b'new')
+    assert snap.has_changes()
+    snap.sync()
+    assert not snap.has_changes()
+
+    (world / 'live' / 'region' / 'r.0.0.mca').write_bytes(b'x' * 10)
+    assert snap.has_changes()
+
+
+def test_full_snapshot_removes_stale_files(world):
+    snap = make(world)
+    snap.sync()
+    snap.save_index()
+    # Deleted behind the index's back, eg with the index lost or stale
+    (world / 'live' / 'region' / 'r.0.1.mca').unlink()
+    snap.index = {}
+    snap.save_index()
+    (world / 'snapshot' / 'junk.podcraft-tmp').write_bytes(b'half')
+
+    stats = take_snapshot(make(world), lambda cmd: None, full=True)
+    assert stats['warm']['changed'] == 2
+    assert stats['warm']['removed'] == 2
+    assert not (world / 'snapshot' / 'region' / 'r.0.1.mca').exists()
+    assert not (world / 'snapshot' / 'junk.podcraft-tmp').exists()
+    assert (world / 'snapshot' / 'region' / 'r.0.0.mca').exists()
@@ -0,0 +1,41 @@
+import json
+import pathlib
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).parent.parent
+
+#: Microseconds that importing the CLI may take
+BUDGET = 150000
+
+#: Things only some commands need, that are slow to import
+HEAVY = ['podman', 'requests', 'tarfile', 'asyncio', 'podcraft.images', 'podcraft.cache']
+
+
+def run_python(*args):
+    return subprocess.run(
+        [sys.executable, *args], cwd=ROOT, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+
+
+def cumulative_import_time(module):
+    proc = run_python('-X', 'importtime', '-c', f'import {module}')
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1])
+    raise AssertionError(f"{module} not in importtime output")
+
+
+def test_cli_does_not_import_heavy_modules():
+    proc = run_python('-c', 'import json, sys, podcraft.cli; print(json.dumps(sorted(sys.modules)))')
+    loaded = set(json.loads(proc.stdout))
+    assert not loaded & set(HEAVY)
+
+
+def test_cli_import_time():
+    # Best of a few, to ride out a busy machine
+    best = min(cumulative_import_time('podcraft.cli') for _ in range(3))
+    assert best < BUDGET, f"importing podcraft.cli took {best}us"
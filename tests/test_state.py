@@ -0,0 +1,109 @@
+import os
+import threading
+
+from podcraft.state import State, merge
+
+
+def test_unchanged_state_not_written(tmp_path):
+    fname = tmp_path / 'state'
+    with State(fname) as state:
+        state.save_image('server', 'abc')
+    os.utime(fname, ns=(0, 0))
+    with State(fname) as state:
+        assert state.get_image('server') == 'abc'
+    assert os.stat(fname).st_mtime_ns == 0
+
+
+def test_backup_recovery(tmp_path):
+    fname = tmp_path / 'state'
+    with State(fname) as state:
+        state.save_image('server', 'abc')
+    with State(fname) as state:
+        state.save_image('server', 'def')
+    # The last write is damaged, so we fall back to the one before it
+    fname.write_text('{"images": ')
+    with State(fname) as state:
+        assert state.get_image('server') == 'abc'
+    with State(fname) as state:
+        state.save_image('manager', 'ghi')
+    # Recovering must not have replaced the good backup with the damaged file
+    with State(fname) as state:
+        assert state.data['images'] == {'server': {'id': 'abc'}, 'manager': {'id': 'ghi'}}
+    assert not (tmp_path / 'state.tmp').exists()
+
+
+def test_interrupted_write(tmp_path):
+    fname = tmp_path / 'state'
+    with State(fname) as state:
+        state.save_image('server', 'abc')
+    with State(fname) as state:
+        state.save_image('server', 'def')
+    os.unlink(fname)
+    with State(fname) as state:
+        assert state.get_image('server') == 'abc'
+
+
+def test_concurrent_changes_merged(tmp_path):
+    fname = tmp_path / 'state'
+    with State(fname) as state:
+        state.save_image('server', 'abc')
+        state.save_image('manager', 'old')
+    order = []
+
+    def other():
+        with State(fname) as state:
+            order.append('other')
+            state.save_image('manager', 'xyz')
+            state.data['snapshot'] = {'seconds': 1}
+
+    with State(fname) as state:
+        # The other run doesn't wait for this one to finish
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join(timeout=5)
+        order.append('first')
+        state.save_image('server', 'def')
+        state.save_image('addon-0', 'ghi')
+    assert order == ['other', 'first']
+    with State(fname) as state:
+        assert state.data['images'] == {
+            'server': {'id': 'def'}, 'manager': {'id': 'xyz'}, 'addon-0': {'id': 'ghi'},
+        }
+        assert state.data['snapshot'] == {'seconds': 1}
+
+
+def test_merge():
+    base = {'a': 1, 'b': {'x': 1, 'y': 2}, 'c': 3}
+    ours = {'a': 2, 'b': {'x': 1}, 'c': 3}
+    theirs = {'b': {'x': 5, 'y': 2, 'z': 1}, 'c': 4}
+    assert merge(base, ours, theirs) == {'a': 2, 'b': {'x': 5, 'z': 1}, 'c': 4}
+    assert merge(base, base, theirs) is theirs
+
+
+def test_generations(tmp_path):
+    def gen(number, server_image):
+        return {
+            'images': {'server': {'id': server_image}, 'manager': {'id': 'm1'}},
+            'containers': {'server': {'id': f'c{number}'}},
+            'pod': {'id': f'p{number}'},
+            'fingerprints': {},
+            'generation': {'number': number},
+        }
+
+    with State(tmp_path / 'state') as state:
+        assert state.switch_generation(gen(1, 's1')) is None
+        assert state.switch_generation(gen(2, 's2')) is None
+        assert state.generation_number() == 2
+        assert state.generation_images() == {'s1', 's2', 'm1'}
+
+        # The oldest generation is handed back to be removed
+        retired = state.switch_generation(gen(3, 's3'))
+        assert retired['pod'] == {'id': 'p1'}
+        assert state.get_previous()['pod'] == {'id': 'p2'}
+
+        # Rolling back keeps both
+        assert state.switch_generation(state.get_previous()) is None
+        assert state.get_pod() == 'p2'
+        assert state.get_image('server') == 's2'
+        assert state.get_previous()['pod'] == {'id': 'p3'}
+        assert state.generation_number() == 3
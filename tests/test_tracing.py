@@ -0,0 +1,41 @@
+import threading
+
+from podcraft import tracing
+
+
+def test_off_by_default():
+    assert tracing.span('anything') is tracing.span('something else')
+    with tracing.span('anything', arg=1):
+        pass
+
+
+def build():
+    with tracing.span('podman build'):
+        pass
+
+
+def test_spans():
+    recorder = tracing.start()
+    try:
+        with tracing.span('build images', names=['server']):
+            thread = threading.Thread(target=build)
+            thread.start()
+            thread.join()
+        build()
+    finally:
+        assert tracing.stop() is recorder
+    assert tracing.span('after') is tracing.span('off again')
+
+    events = recorder.trace_events()
+    assert [e['name'] for e in events] == ['podman build', 'build images', 'podman build']
+    assert events[1]['args'] == {'names': ['server']}
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in events)
+    # The inner span ran in another thread, inside the outer one
+    assert events[0]['tid'] != events[1]['tid']
+    assert events[1]['ts'] <= events[0]['ts'] <= events[1]['ts'] + events[1]['dur']
+
+    summary = {name: count for name, count, _, _ in recorder.summary()}
+    assert summary == {'podman build': 2, 'build images': 1}
+    lines = list(tracing.format_summary(recorder))
+    assert lines[0].split() == ['span', 'count', 'total', 'longest']
+    assert len(lines) == 3